@@ -0,0 +1,479 @@
+"""Test de charge : combien de comptables une seule instance de l'app peut servir en même temps.
+
+Chaque session est un AppTest (l'API de test sans navigateur de Streamlit) qui tourne dans son
+propre thread, comme une session du serveur. Supabase (auth, tables, stockage) et Gemini sont
+remplacés par des doublures en mémoire, avec une latence réseau simulée.
+
+Usage : python load_test.py --sessions 1,5,10 --factures 300 --tours 2
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+
+# ==============================================================================
+# 1. DOUBLURES (Supabase, auth, Gemini)
+# ==============================================================================
+# Clés d'upsert quand l'app ne donne pas de on_conflict (= clés primaires des tables)
+CLES_TABLES = {
+    "audit_results": ["user_id", "file_name"],
+    "accords_commerciaux": ["article"],
+    "user_configs": ["user_id", "fournisseur"],
+    "references_articles": ["user_id", "article"],
+}
+# Colonnes remplies par la base à chaque écriture (défaut + déclencheur des migrations)
+HORODATAGES = {"audit_results": "date_maj"}
+
+class Reponse:
+    def __init__(self, data):
+        self.data = data
+
+class BaseMemoire:
+    """Tables Supabase en mémoire. Chaque requête attend LATENCE_DB (aller-retour réseau)
+    et renvoie une copie JSON des lignes, comme le vrai client."""
+    def __init__(self, latence_db=0.0):
+        self.tables = {}
+        self.fichiers = {}
+        self.verrou = threading.Lock()
+        self.latence_db = latence_db
+        self.nb_requetes = 0
+
+class Requete:
+    def __init__(self, base, table):
+        self.base, self.table = base, table
+        self.operation, self.donnees, self.conflit = "select", None, None
+        self.colonnes, self.filtres, self.tri, self.nb_max = "*", [], None, None
+
+    def select(self, colonnes="*", **kwargs):
+        self.colonnes = colonnes
+        return self
+
+    def eq(self, col, val):
+        self.filtres.append(lambda r: r.get(col) == val)
+        return self
+
+    def gt(self, col, val):
+        self.filtres.append(lambda r: r.get(col) is not None and r.get(col) > val)
+        return self
+
+    def in_(self, col, vals):
+        vals = set(vals)
+        self.filtres.append(lambda r: r.get(col) in vals)
+        return self
+
+    def is_(self, col, val):
+        self.filtres.append(lambda r: r.get(col) is None if val == "null" else r.get(col) == val)
+        return self
+
+    def order(self, col, desc=False):
+        self.tri = (col, desc)
+        return self
+
+    def limit(self, n):
+        self.nb_max = n
+        return self
+
+    def upsert(self, donnees, on_conflict=None, **kwargs):
+        self.operation, self.donnees, self.conflit = "upsert", donnees, on_conflict
+        return self
+
+    def insert(self, donnees, **kwargs):
+        self.operation, self.donnees = "insert", donnees
+        return self
+
+    def update(self, donnees):
+        self.operation, self.donnees = "update", donnees
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def execute(self):
+        if self.base.latence_db:
+            time.sleep(self.base.latence_db)
+        with self.base.verrou:
+            self.base.nb_requetes += 1
+            lignes = self.base.tables.setdefault(self.table, [])
+            garder = lambda r: all(f(r) for f in self.filtres)
+
+            if self.operation == "select":
+                res = [r for r in lignes if garder(r)]
+                if self.tri:
+                    res.sort(key=lambda r: (r.get(self.tri[0]) is None, r.get(self.tri[0])), reverse=self.tri[1])
+                if self.nb_max:
+                    res = res[:self.nb_max]
+                if self.colonnes != "*":
+                    cols = [c.strip().split("::")[0] for c in self.colonnes.split(",")]
+                    res = [{c: r.get(c) for c in cols} for r in res]
+                return Reponse(json.loads(json.dumps(res)))
+
+            if self.operation in ("upsert", "insert"):
+                nouvelles = self.donnees if isinstance(self.donnees, list) else [self.donnees]
+                cles = [c.strip() for c in self.conflit.split(",")] if self.conflit else CLES_TABLES.get(self.table)
+                for n in nouvelles:
+                    n = copy.deepcopy(n)
+                    if self.table in HORODATAGES:
+                        n[HORODATAGES[self.table]] = datetime.now().isoformat()
+                    if self.operation == "upsert" and cles:
+                        existante = next((r for r in lignes if all(r.get(c) == n.get(c) for c in cles)), None)
+                        if existante is not None:
+                            existante.update(n)
+                            continue
+                    lignes.append(n)
+                return Reponse(nouvelles)
+
+            if self.operation == "update":
+                for r in lignes:
+                    if garder(r):
+                        if self.table in HORODATAGES and r.get("analyse_complete") != self.donnees.get("analyse_complete", r.get("analyse_complete")):
+                            r[HORODATAGES[self.table]] = datetime.now().isoformat()
+                        r.update(copy.deepcopy(self.donnees))
+                return Reponse([])
+
+            self.base.tables[self.table] = [r for r in lignes if not garder(r)]
+            return Reponse([])
+
+class Seau:
+    def __init__(self, base):
+        self.base = base
+
+    def upload(self, nom, contenu, options=None):
+        with self.base.verrou:
+            self.base.fichiers[nom] = bytes(contenu)
+
+    def download(self, nom):
+        if self.base.latence_db:
+            time.sleep(self.base.latence_db)
+        return self.base.fichiers.get(nom, b"%PDF-1.4 /Type /Page")
+
+class ClientMemoire:
+    def __init__(self, base):
+        self.base = base
+        self.postgrest = types.SimpleNamespace(auth=lambda jeton: None)
+        self.storage = types.SimpleNamespace(from_=lambda nom: Seau(base))
+
+    def table(self, nom):
+        return Requete(self.base, nom)
+
+def installer_doublures(base, latence_ia):
+    """Remplace supabase, streamlit_supabase_auth et google.generativeai dans sys.modules"""
+    module_sb = types.ModuleType("supabase")
+    module_sb.create_client = lambda url, cle: ClientMemoire(base)
+    sys.modules["supabase"] = module_sb
+
+    # L'utilisateur connecté est posé dans la session par le scénario (un compte par comptable)
+    module_auth = types.ModuleType("streamlit_supabase_auth")
+    def login_form(**kwargs):
+        import streamlit as st
+        return {"access_token": "jeton", "user": {"id": st.session_state.get("_charge_utilisateur", "comptable-0")}}
+    module_auth.login_form = login_form
+    sys.modules["streamlit_supabase_auth"] = module_auth
+
+    compteur = iter(range(10**9))
+    class ModeleGemini:
+        def __init__(self, nom, generation_config=None, **kwargs):
+            self.nom = nom
+
+        def generate_content(self, contenu, **kwargs):
+            time.sleep(latence_ia)
+            data = facture_synthetique(random.Random(next(compteur)), 10**6)
+            return types.SimpleNamespace(
+                text=json.dumps(data),
+                usage_metadata=types.SimpleNamespace(prompt_token_count=1800, candidates_token_count=900, total_token_count=2700)
+            )
+
+    module_genai = types.ModuleType("google.generativeai")
+    module_genai.configure = lambda **kwargs: None
+    module_genai.GenerativeModel = ModeleGemini
+    try:
+        import google
+    except ImportError:
+        google = types.ModuleType("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    google.generativeai = module_genai
+    sys.modules["google.generativeai"] = module_genai
+
+# ==============================================================================
+# 2. DOSSIERS SYNTHÉTIQUES
+# ==============================================================================
+FOURNISSEURS = ["YESSS ELECTRIQUE SAS", "REXEL FRANCE", "SONEPAR", "CGED", "PARTEDIS"]
+REMISES = ["60+10", "60", "55", "64", "50+5", ""]
+
+def facture_synthetique(rng, num):
+    """Une facture au format renvoyé par Gemini (quelques lignes sans référence, des frais de port)"""
+    fourn = rng.choice(FOURNISSEURS)
+    jour = date(2023, 1, 1) + timedelta(days=rng.randint(0, 3 * 365))
+    lignes = []
+    for _ in range(rng.randint(3, 15)):
+        a = rng.randint(0, 300)
+        brut = round(5 + a * 1.7, 2)
+        remise = rng.choice(REMISES)
+        coef = 1.0
+        for part in filter(None, remise.split("+")):
+            coef *= 1 - float(part) / 100
+        net = round(brut * coef * rng.choice([1, 1, 1, 1.08, 1.25]), 2)
+        qte = rng.randint(1, 20)
+        lignes.append({
+            "quantite": qte,
+            "article": f"REF{a:04d}" if a % 9 else None,
+            "designation": f"CABLE RIGIDE U1000 {a} MM2 GRIS" if a % 2 else f"DISJONCTEUR {a}A COURBE C",
+            "prix_brut_unitaire": brut,
+            "base_facturation": 1,
+            "remise": remise,
+            "prix_net_unitaire": net,
+            "montant": round(net * qte, 2),
+            "num_bl_ligne": f"BL{rng.randint(1000, 9999)}",
+        })
+    if rng.random() < 0.3:
+        lignes.append({"quantite": 1, "article": "FRAIS_ANNEXE", "designation": "Frais de port",
+                       "prix_brut_unitaire": 15, "remise": "", "prix_net_unitaire": 15, "montant": 15})
+    return {"fournisseur": fourn, "date": jour.isoformat(), "num_facture": f"FA{num}",
+            "ref_commande": "-", "lignes": lignes}
+
+def remplir_compte(base, user_id, nb_factures, graine):
+    rng = random.Random(graine)
+    lignes = base.tables.setdefault("audit_results", [])
+    for i in range(nb_factures):
+        data = facture_synthetique(rng, i)
+        lignes.append({"file_name": f"{user_id}_{i:05d}.pdf", "user_id": user_id,
+                       "analyse_complete": data, "raw_text": json.dumps(data), "raw_text_z": None,
+                       "date_maj": datetime.now().isoformat()})
+
+# ==============================================================================
+# 3. SCÉNARIO D'UN COMPTABLE
+# ==============================================================================
+def memoire_mo():
+    """Mémoire résidente du process (Mo) : actuelle si /proc est lisible, sinon le pic"""
+    try:
+        with open("/proc/self/status") as f:
+            for ligne in f:
+                if ligne.startswith("VmRSS:"):
+                    return int(ligne.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def preparer_streamlit_multisession():
+    """AppTest est prévu pour un test à la fois : à chaque affichage il remplace le Runtime global,
+    les secrets et recompile le script, puis remet tout à zéro. On lui donne ce qu'un vrai serveur
+    partage entre ses sessions (un Runtime, un cache de bytecode, des secrets), une fois pour toutes."""
+    from unittest.mock import MagicMock
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1 import app_test
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    try:
+        from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+        runtime.dataframe_source_mgr = DataframeSourceManager()
+    except ImportError:
+        pass
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    # Un seul bytecode pour toutes les sessions (compiler le script en parallèle plante en 3.11)
+    cache_script = ScriptCache()
+    app_test.ScriptCache = lambda: cache_script
+
+    config.set_option("global.appTest", True)
+    secrets = Secrets()
+    secrets._secrets = {"SUPABASE_URL": "http://local", "SUPABASE_KEY": "anon", "GEMINI_API_KEY": "local"}
+    st.secrets = secrets
+
+def parcours_comptable(num, args, mesures, erreurs, barriere):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=args.timeout)
+    at.session_state["_charge_utilisateur"] = f"comptable-{num}"
+
+    def relancer(etape):
+        t0 = time.perf_counter()
+        at.run()
+        mesures.append((num, etape, time.perf_counter() - t0))
+        for exc in at.exception:
+            erreurs.append((num, etape, str(exc.value)[:200]))
+
+    try:
+        # 1. Ouverture de l'analyse (chargement du dossier, synthèse, podium)
+        relancer("ouverture")
+    finally:
+        try:
+            barriere.wait(timeout=args.timeout)
+        except threading.BrokenBarrierError:
+            pass
+
+    for tour in range(args.tours):
+        # 2. Filtre sur une facture
+        filtres = [s for s in at.selectbox if s.label.startswith("👁️")]
+        if filtres and len(filtres[0].options) > 1:
+            options = filtres[0].options
+            filtres[0].set_value(options[1 + tour % (len(options) - 1)])
+            relancer("filtre_facture")
+
+        # 3. Verrouillage d'un contrat (bouton "🚀 Verrouiller Contrat")
+        verrous = [b for b in at.button if (b.key or "").startswith("v_")]
+        if verrous:
+            verrous[tour % len(verrous)].click()
+            relancer("verrou_contrat")
+
+        # 4. Import d'un lot de PDF (Gemini simulé), puis retour sur l'analyse
+        if args.lot and at.file_uploader:
+            at.file_uploader[0].set_value([
+                (f"comptable-{num}_import_{tour}_{i}.pdf", b"%PDF-1.4 /Type /Page /Type /Page", "application/pdf")
+                for i in range(args.lot)
+            ])
+            relancer("selection_lot")
+            lancer = [b for b in at.button if b.label == "🚀 LANCER"]
+            if lancer:
+                lancer[0].click()
+                relancer("import_lot")
+
+def chauffer(args):
+    """Un premier affichage hors mesure : imports (pandas, pyarrow...) et compilation du script"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=args.timeout)
+    at.session_state["_charge_utilisateur"] = "comptable-chauffe"
+    at.run()
+
+def mesurer(nb_sessions, args):
+    import streamlit as st
+
+    base = BaseMemoire(latence_db=args.latence_db / 1000)
+    installer_doublures(base, latence_ia=args.latence_ia / 1000)
+    remplir_compte(base, "comptable-chauffe", 20, graine=-1)
+    chauffer(args)
+    for num in range(nb_sessions):
+        remplir_compte(base, f"comptable-{num}", args.factures, graine=num)
+    st.cache_data.clear()
+    base.nb_requetes = 0
+
+    mesures, erreurs = [], []
+    barriere = threading.Barrier(nb_sessions + 1)
+    threads = [threading.Thread(target=parcours_comptable, args=(num, args, mesures, erreurs, barriere), daemon=True)
+               for num in range(nb_sessions)]
+
+    mem_avant = memoire_mo()
+    cpu_avant, t_avant = time.process_time(), time.perf_counter()
+    for t in threads:
+        t.start()
+    try:
+        # Toutes les sessions ont ouvert leur dossier : c'est la mémoire "au repos" de N comptables
+        barriere.wait(timeout=args.timeout)
+    except threading.BrokenBarrierError:
+        pass
+    mem_ouvert = memoire_mo()
+    for t in threads:
+        t.join()
+    cpu = time.process_time() - cpu_avant
+    duree = time.perf_counter() - t_avant
+
+    return {
+        "sessions": nb_sessions,
+        "mesures": mesures,
+        "erreurs": erreurs,
+        "duree_s": duree,
+        "cpu_s": cpu,
+        "memoire_avant_mo": mem_avant,
+        "memoire_ouvert_mo": mem_ouvert,
+        "memoire_pic_mo": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "requetes_db": base.nb_requetes,
+    }
+
+# ==============================================================================
+# 4. RAPPORT
+# ==============================================================================
+def afficher_rapport(res):
+    n = res["sessions"]
+    print(f"\n=== {n} session(s) : {res['duree_s']:.1f} s, {res['requetes_db']} requêtes Supabase ===")
+    print(f"{'étape':<16}{'nb':>6}{'p50 (s)':>10}{'p95 (s)':>10}{'max (s)':>10}")
+    etapes = {}
+    for _, etape, duree in res["mesures"]:
+        etapes.setdefault(etape, []).append(duree)
+    etapes["(toutes)"] = [d for _, _, d in res["mesures"]]
+    for etape, durees in etapes.items():
+        if not durees: continue
+        p50, p95 = np.percentile(durees, [50, 95])
+        print(f"{etape:<16}{len(durees):>6}{p50:>10.2f}{p95:>10.2f}{max(durees):>10.2f}")
+
+    # Un seul process Python : le CPU utile plafonne vers 1 cœur (GIL), c'est ce chiffre qui sature
+    print(f"CPU : {res['cpu_s']:.1f} s au total, {res['cpu_s'] / n:.1f} s par session, "
+          f"{res['cpu_s'] / max(res['duree_s'], 1e-9):.2f} cœur(s) occupé(s) en moyenne")
+    print(f"Mémoire : {(res['memoire_ouvert_mo'] - res['memoire_avant_mo']) / n:.0f} Mo par session "
+          f"(dossier ouvert), pic du process {res['memoire_pic_mo']:.0f} Mo")
+    if res["erreurs"]:
+        print(f"⚠️ {len(res['erreurs'])} exception(s) dans l'app, ex. : {res['erreurs'][0]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge multi-sessions de l'app d'audit (sans navigateur).")
+    parser.add_argument("--sessions", default="1,5,10", help="Paliers de sessions simultanées, ex. 1,5,10")
+    parser.add_argument("--factures", type=int, default=300, help="Factures déjà en base par comptable")
+    parser.add_argument("--tours", type=int, default=2, help="Répétitions du scénario (filtre, contrat, import) par session")
+    parser.add_argument("--lot", type=int, default=2, help="PDF par import (0 pour ne pas importer)")
+    parser.add_argument("--latence-db", type=float, default=20, help="Aller-retour Supabase simulé (ms)")
+    parser.add_argument("--latence-ia", type=float, default=1500, help="Réponse Gemini simulée (ms)")
+    parser.add_argument("--timeout", type=float, default=600, help="Durée max d'un affichage (s)")
+    parser.add_argument("--json", help="Écrit aussi les mesures brutes dans ce fichier")
+    parser.add_argument("--palier", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.palier is not None:
+        # Process enfant : un seul palier, rapport sur la sortie standard, mesures brutes dans args.json
+        import streamlit.logger
+        preparer_streamlit_multisession()
+        # Les avertissements de Streamlit (mode sans serveur) noieraient le rapport
+        streamlit.logger.set_log_level("error")
+        logging.getLogger("audit.diagnostics").setLevel(logging.ERROR)
+        res = mesurer(args.palier, args)
+        afficher_rapport(res)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(res, f, default=str)
+        return
+
+    print(f"Dossier : {args.factures} factures par comptable, {args.tours} tour(s), lots de {args.lot} PDF, "
+          f"latence Supabase {args.latence_db:.0f} ms, Gemini {args.latence_ia:.0f} ms. "
+          "NB : l'import inclut la pause d'1 s de l'app avant son rafraîchissement.", flush=True)
+
+    # Chaque palier tourne dans un process neuf : mémoire, caches et imports repartent de zéro
+    resultats = []
+    for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+        with tempfile.TemporaryDirectory() as dossier:
+            chemin = os.path.join(dossier, "palier.json")
+            subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--palier", str(n), "--json", chemin])
+            if os.path.exists(chemin):
+                with open(chemin) as f:
+                    resultats.append(json.load(f))
+            else:
+                print(f"⚠️ Le palier à {n} session(s) n'a pas abouti.")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(resultats, f, indent=2, default=str)
+
+if __name__ == "__main__":
+    main()
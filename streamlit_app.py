@@ -3,12 +3,30 @@ from supabase import create_client
 from streamlit_supabase_auth import login_form
 import google.generativeai as genai
 import pandas as pd
+import numpy as np
 import re
 import json
 import time
 import os
+import logging
+import copy
+import zlib
+import hashlib
+import unicodedata
+import base64
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
 from io import BytesIO
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+# Décodeur JSON rapide si disponible (sinon le json standard fait le même travail, en plus lent)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ==============================================================================
 # 1. CONFIGURATION & REGISTRE
@@ -17,21 +35,98 @@ URL_SUPABASE = st.secrets["SUPABASE_URL"]
 CLE_ANON = st.secrets["SUPABASE_KEY"]
 GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
 
+# Au-delà de ce nombre de lignes, l'analyse s'ouvre en mode "à la demande" (fournisseur par fournisseur)
+SEUIL_LIGNES_MODE_DEMANDE = 20000
+
+# [MODIFICATION] : Passage à Gemini 3.0 Flash-preview (Stable & mais lent) la version 2 est trop pourrier pour le test
+# On remplace la version "3-preview" qui lag par la référence de vitesse actuelle.
+MODELE_GEMINI = "gemini-3-flash-preview"
+
+# Tarifs en $ par million de jetons (entrée, sortie) pour estimer le coût des extractions.
+# À ajuster si Google change sa grille ou si on teste un autre modèle.
+TARIFS_GEMINI = {
+    "gemini-3-flash-preview": (0.50, 3.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+
 try:
     supabase = create_client(URL_SUPABASE, CLE_ANON)
     genai.configure(api_key=GEMINI_API_KEY)
 except Exception as e:
     st.error(f"Erreur connexion : {e}") 
 
+# --- DIAGNOSTICS (Chronométrage des étapes) ---
+# Louis : Chaque étape lourde (chargement, JSON, normalisation, ref_map, analyse, rendu) est
+# chronométrée avec son nombre de lignes et la taille des données. Streamlit relance tout le
+# fichier à chaque clic, donc cette liste repart de zéro à chaque affichage.
+DIAGNOSTICS = []
+logger_diag = logging.getLogger("audit.diagnostics")
+if not logger_diag.handlers:
+    _handler_diag = logging.StreamHandler()
+    _handler_diag.setFormatter(logging.Formatter("%(message)s"))
+    logger_diag.addHandler(_handler_diag)
+    logger_diag.setLevel(logging.INFO)
+    logger_diag.propagate = False
+EXPORT_LOGS_DIAG = False
+# Les mesures coûteuses (taille des données reçues) ne sont faites que si le panneau est ouvert
+DIAGNOSTICS_ACTIFS = False
+
+def noter_etape(nom, duree_s, **infos):
+    """Enregistre une étape déjà chronométrée (utile pour les temps cumulés dans une boucle)"""
+    span = {"etape": nom, "duree_ms": round(duree_s * 1000, 1), **infos}
+    DIAGNOSTICS.append(span)
+    if EXPORT_LOGS_DIAG:
+        # Une ligne JSON par étape : lisible par n'importe quel collecteur de logs
+        logger_diag.info(json.dumps(span, default=str))
+
+@contextmanager
+def etape(nom, **infos):
+    """Chronomètre le bloc ; le dict renvoyé peut être complété dedans (lignes, octets...)"""
+    debut = time.perf_counter()
+    try:
+        yield infos
+    finally:
+        noter_etape(nom, time.perf_counter() - debut, **infos)
+
+def taille_payload(rows):
+    """Taille approximative (en octets) des champs texte ou JSON reçus de Supabase.
+    None si les diagnostics sont fermés : re-sérialiser chaque facture coûterait presque autant que la lire."""
+    if not DIAGNOSTICS_ACTIFS: return None
+    total = 0
+    for r in rows:
+        for v in r.values():
+            if isinstance(v, str): total += len(v)
+            elif isinstance(v, (dict, list)): total += len(orjson.dumps(v) if orjson else json.dumps(v))
+    return total
+
+# Louis : Un filtre in_ voyage dans l'URL de PostgREST (refusée au-delà de quelques Ko) et un insert
+# part en une seule requête : les longues listes d'articles et les gros inserts sont découpés en lots.
+TAILLE_LOT_FILTRE = 100
+TAILLE_LOT_INSERT = 500
+
+def par_lots(elements, taille):
+    """Découpe une liste en lots de `taille` éléments au plus"""
+    elements = list(elements)
+    for i in range(0, len(elements), taille):
+        yield elements[i:i + taille]
+
+def inserer_par_lots(table, lignes):
+    for lot in par_lots(lignes, TAILLE_LOT_INSERT):
+        supabase.table(table).insert(lot).execute()
+
 def charger_registre():
     """Louis : On récupère l'accord, sa valeur et son unité (EUR ou %) depuis Supabase"""
-    try:
-        # On lit la table SQL 'accords_commerciaux'
-        res = supabase.table("accords_commerciaux").select("*").execute()
-        # On stocke maintenant l'unité dans le dictionnaire pour que l'IA sache quoi comparer
-        return {r['article']: {'type': r['type_accord'], 'valeur': r['valeur'], 'unite': r['unite'], 'date': r['date_maj']} for r in res.data}
-    except:
-        return {}
+    with etape("charger_registre") as diag:
+        try:
+            # On lit la table SQL 'accords_commerciaux'
+            res = supabase.table("accords_commerciaux").select("*").execute()
+            diag.update(lignes=len(res.data), octets=taille_payload(res.data))
+            # On stocke maintenant l'unité dans le dictionnaire pour que l'IA sache quoi comparer
+            return {r['article']: {'type': r['type_accord'], 'valeur': r['valeur'], 'unite': r['unite'], 'date': r['date_maj']} for r in res.data}
+        except:
+            return {}
 
 def sauvegarder_accord(article, type_accord, valeur, unite="EUR"):
     """Louis : On enregistre la valeur ET l'unité (EUR ou %) pour ne plus faire de calculs à la toto"""
@@ -45,8 +140,134 @@ def sauvegarder_accord(article, type_accord, valeur, unite="EUR"):
             "date_maj": datetime.now().strftime("%Y-%m-%d"),
             "modifie_par": "Système"
         }).execute()
+        # Les pertes de cet article changent : les agrégats seront mis à jour au prochain affichage
+        marquer_agregats_a_jour(articles=[article])
     except Exception as e:
         st.error(f"Erreur sauvegarde Supabase : {e}")
+
+# --- CHARGEMENT DE DÉMARRAGE (en parallèle) ---
+# Louis : Avant, on attendait les factures, PUIS les réglages, PUIS le registre : le temps
+# d'affichage était la somme des allers-retours. Ces lectures ne dépendent pas les unes des
+# autres, donc on les lance en même temps : on n'attend plus que la plus lente.
+# (Rien de Streamlit dans les fonctions lancées ici : elles tournent hors du fil principal.)
+# Louis : Les factures arrivent par pages, triées par nom de fichier. On reprend après le dernier
+# nom vu (pagination par clé) : pas de réponse géante, et pas d'OFFSET qui ralentit au fil des
+# pages. Chaque page est normalisée dès son arrivée puis relâchée : en mémoire, il ne reste que
+# le tableau typé des lignes, plus le JSON d'UNE page (et non plus tout le dossier en double).
+TAILLE_PAGE_FACTURES = 500
+
+def pages_factures(user_id, taille_page=TAILLE_PAGE_FACTURES):
+    """Générateur : une page de {file_name, analyse_complete} à la fois"""
+    dernier = ""
+    while True:
+        # Le texte brut de Gemini ne voyage plus au démarrage : il est lu à la demande (SCAN TOTAL)
+        page = (supabase.table("audit_results").select("file_name, analyse_complete")
+                .eq("user_id", user_id).gt("file_name", dernier)
+                .order("file_name").limit(taille_page).execute().data)
+        if not page: return
+        yield page
+        if len(page) < taille_page: return
+        dernier = page[-1]['file_name']
+
+def charger_factures(user_id):
+    """Lit le dossier page par page et le normalise au fil de l'eau.
+    Renvoie {"noms": noms de fichiers, "lignes": DataFrame typé, "fournisseurs": fournisseurs vus}"""
+    noms, morceaux, fournisseurs = [], [], set()
+    duree_db, duree_json, duree_norm = 0.0, 0.0, 0.0
+    nb_pages, octets_db, octets_json = 0, 0, 0
+
+    pages = pages_factures(user_id)
+    while True:
+        t0 = time.perf_counter()
+        page = next(pages, None)
+        duree_db += time.perf_counter() - t0
+        if page is None: break
+        nb_pages += 1
+        if DIAGNOSTICS_ACTIFS: octets_db += taille_payload(page)
+
+        colonnes = nouvelles_colonnes()
+        for r in page:
+            noms.append(r['file_name'])
+            try:
+                t0 = time.perf_counter()
+                data = charger_json(r['analyse_complete'])
+                t1 = time.perf_counter()
+                duree_json += t1 - t0
+                if isinstance(r['analyse_complete'], str): octets_json += len(r['analyse_complete'])
+                # Chaque facture arrive dans un accumulateur à part : si elle plante à mi-chemin,
+                # on ne garde pas de colonnes de longueurs différentes
+                colonnes_fac = nouvelles_colonnes()
+                fournisseurs.add(normaliser_facture(r['file_name'], data, colonnes_fac))
+                for col, vals in colonnes_fac.items():
+                    colonnes[col].extend(vals)
+                duree_norm += time.perf_counter() - t1
+            except: continue
+        # La page passe tout de suite au schéma typé : les listes Python et le JSON sont relâchés
+        t0 = time.perf_counter()
+        morceaux.append(construire_df_lignes(colonnes))
+        duree_norm += time.perf_counter() - t0
+        del page, colonnes
+
+    noter_etape("audit_results", duree_db, lignes=len(noms), pages=nb_pages, octets=octets_db if DIAGNOSTICS_ACTIFS else None)
+    noter_etape("parse_json", duree_json, factures=len(noms), octets=octets_json)
+    t0 = time.perf_counter()
+    df = concatener_lignes(morceaux)
+    # Boucle ligne à ligne + passage au schéma typé, page par page
+    noter_etape("normalisation", duree_norm + time.perf_counter() - t0, lignes=len(df), octets=int(df.memory_usage(deep=True).sum()))
+    return {"noms": noms, "lignes": df, "fournisseurs": fournisseurs}
+
+def signature_dossier(user_id):
+    """Dernière facture écrite du compte (date_maj, nom) : bouge à chaque import ou rejeu qui change une extraction"""
+    with etape("signature_dossier"):
+        res = (supabase.table("audit_results").select("file_name, date_maj")
+               .eq("user_id", user_id).order("date_maj", desc=True).limit(1).execute())
+        return (res.data[0]['date_maj'], res.data[0]['file_name']) if res.data else None
+
+def charger_dossier(user_id, cache=None):
+    """Louis : Le dossier normalisé est gardé en session. À chaque relance, une seule petite requête
+    vérifie qu'aucune facture n'a été écrite depuis ; sinon on relit toutes les pages.
+    cache : {"user_id", "signature", "factures"} de la relance précédente (ou None)"""
+    try:
+        signature = signature_dossier(user_id)
+    except:
+        # Colonne date_maj absente (migration pas encore passée) : pas de cache, on relit tout
+        signature = None
+    if signature is not None and cache and cache['user_id'] == user_id and cache['signature'] == signature:
+        noter_etape("dossier_en_cache", 0.0, lignes=len(cache['factures']['lignes']))
+        return cache
+    return {"user_id": user_id, "signature": signature, "factures": charger_factures(user_id)}
+
+def charger_configs(user_id):
+    with etape("user_configs") as diag:
+        res = supabase.table("user_configs").select("*").eq("user_id", user_id).execute()
+        diag.update(lignes=len(res.data))
+        return res.data
+
+def charger_donnees_demarrage(user_id, avec_configs=True, dossier=None):
+    """Lance les lectures Supabase indépendantes en même temps.
+    dossier : dossier normalisé gardé en session (voir charger_dossier)
+    Renvoie {nom: résultat} et, à part, les erreurs {nom: exception} pour que l'appelant décide."""
+    lectures = {
+        "dossier": (charger_dossier, user_id, dossier),
+        "registre": (charger_registre,),
+        "references": (charger_references, user_id),
+        "agregats": (charger_agregats, user_id),
+        "empreintes": (charger_empreintes_articles, user_id),
+        "regroupement": (charger_regroupement, user_id),
+    }
+    if avec_configs:
+        lectures["configs"] = (charger_configs, user_id)
+
+    resultats, erreurs = {}, {}
+    with etape("demarrage_parallele", lectures=len(lectures)):
+        with ThreadPoolExecutor(max_workers=len(lectures)) as pool:
+            futurs = {nom: pool.submit(*args) for nom, args in lectures.items()}
+            for nom, futur in futurs.items():
+                try:
+                    resultats[nom] = futur.result()
+                except Exception as e:
+                    erreurs[nom] = e
+    return resultats, erreurs
 # ==============================================================================
 # 2. LOGIQUE MÉTIER
 # ==============================================================================
@@ -138,55 +359,370 @@ def detecter_famille(label, ref=""):
     return "AUTRE_PRODUIT"
 
 
-def extraire_json_robuste(texte):
+# --- SORTIE STRUCTURÉE DE GEMINI ---
+# Louis : Fini la regex qui allait pêcher le premier {...} dans le texte. Gemini doit répondre en
+# JSON selon SCHEMA_GEMINI (les mêmes champs que dans le prompt), et pydantic vérifie le résultat.
+# Si ça casse quand même (réponse coupée...), on fait UNE passe de réparation sur le texte seul,
+# sans renvoyer le PDF. Les deux schémas doivent rester alignés.
+def _objet_schema(champs, requis):
+    return {"type": "OBJECT", "properties": champs, "required": requis}
+
+SCHEMA_GEMINI = _objet_schema({
+    "fournisseur": {"type": "STRING"},
+    "adresse_fournisseur": {"type": "STRING", "nullable": True},
+    "tva_fournisseur": {"type": "STRING", "nullable": True},
+    "iban": {"type": "STRING", "nullable": True},
+    "date": {"type": "STRING"},
+    "num_facture": {"type": "STRING"},
+    "ref_commande": {"type": "STRING"},
+    # Frais Facture ("FF 8,99") lus dans le récapitulatif de TVA en bas de facture, hors tableau des lignes
+    "frais_facture": {"type": "NUMBER", "nullable": True},
+    "lignes": {"type": "ARRAY", "items": _objet_schema({
+        "quantite": {"type": "NUMBER"},
+        "article": {"type": "STRING", "nullable": True},
+        "designation": {"type": "STRING"},
+        "prix_brut_unitaire": {"type": "NUMBER"},
+        "base_facturation": {"type": "NUMBER"},
+        "remise": {"type": "STRING"},
+        "prix_net_unitaire": {"type": "NUMBER"},
+        "montant": {"type": "NUMBER"},
+        "num_bl_ligne": {"type": "STRING", "nullable": True},
+    }, ["quantite", "designation", "prix_net_unitaire", "montant"])},
+}, ["fournisseur", "date", "num_facture", "lignes"])
+
+CONFIG_GEMINI_JSON = {"response_mime_type": "application/json", "response_schema": SCHEMA_GEMINI}
+
+class LigneFacture(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    quantite: float = 1.0
+    article: str | None = None
+    designation: str = ""
+    prix_brut_unitaire: float = 0.0
+    base_facturation: float = 1.0
+    remise: str = ""
+    prix_net_unitaire: float = 0.0
+    montant: float = 0.0
+    num_bl_ligne: str | None = None
+
+    # Les chiffres passent par clean_float ("1 234,50 €" -> 1234.5), comme à l'affichage
+    @field_validator("quantite", "prix_brut_unitaire", "base_facturation", "prix_net_unitaire", "montant", mode="before")
+    @classmethod
+    def lire_nombre(cls, v):
+        return clean_float(v)
+
+    @field_validator("designation", "remise", mode="before")
+    @classmethod
+    def lire_texte(cls, v):
+        return "" if v is None else str(v)
+
+    @field_validator("article", "num_bl_ligne", mode="before")
+    @classmethod
+    def lire_reference(cls, v):
+        return None if v is None else str(v)
+
+class FactureExtraite(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    fournisseur: str = "INCONNU"
+    adresse_fournisseur: str = "-"
+    tva_fournisseur: str = "-"
+    iban: str = "-"
+    date: str = "Inconnue"
+    num_facture: str = "-"
+    ref_commande: str = "-"
+    frais_facture: float | None = None
+    lignes: list[LigneFacture]
+
+    @field_validator("frais_facture", mode="before")
+    @classmethod
+    def lire_frais(cls, v):
+        return None if v is None else clean_float(v)
+
+    @field_validator("fournisseur", "adresse_fournisseur", "tva_fournisseur", "iban", "date", "num_facture", "ref_commande", mode="before")
+    @classmethod
+    def lire_texte(cls, v, info):
+        return cls.model_fields[info.field_name].default if v is None else str(v)
+
+PROMPT_REPARATION = """
+Le JSON ci-dessous (extraction d'une facture) ne respecte pas le schéma attendu.
+Erreur relevée : {erreur}
+Corrige-le SANS inventer de données : garde toutes les lignes lisibles, referme ce qui est coupé,
+et renvoie uniquement le JSON corrigé.
+
+{texte}
+"""
+
+def valider_extraction(texte):
+    """Décode et vérifie une réponse de Gemini. Renvoie (dict, None) ou (None, message d'erreur)"""
     try:
-        match = re.search(r"(\{.*\})", texte, re.DOTALL)
-        if match: return json.loads(match.group(1))
-    except: pass
-    return None
+        return FactureExtraite.model_validate_json(texte).model_dump(), None
+    except ValidationError as e:
+        return None, str(e)[:2000]
+
+# --- STOCKAGE COMPACT DES FACTURES ---
+# Louis : analyse_complete est en JSONB côté Supabase : elle arrive déjà sous forme de dict, plus
+# de json.loads sur un gros texte à chaque affichage. Le texte brut de Gemini est compressé
+# (zlib + base64) dans raw_text_z. Les anciennes lignes (texte JSON, raw_text en clair) restent lisibles.
+def charger_json(val):
+    """Renvoie le dict d'une analyse, qu'elle soit stockée en JSONB ou en texte (anciennes lignes)"""
+    if val is None or isinstance(val, (dict, list)): return val
+    return orjson.loads(val) if orjson else json.loads(val)
+
+def compresser_texte(texte):
+    if not texte: return None
+    return base64.b64encode(zlib.compress(texte.encode("utf-8"), 6)).decode("ascii")
+
+def decompresser_texte(val):
+    return zlib.decompress(base64.b64decode(val)).decode("utf-8")
+
+def charger_analyse(user_id, nom_fichier):
+    """Va chercher l'analyse d'un seul fichier (ancienne version, avant écrasement)"""
+    res = supabase.table("audit_results").select("analyse_complete").eq("user_id", user_id).eq("file_name", nom_fichier).execute()
+    return charger_json(res.data[0]['analyse_complete']) if res.data else None
+
+def charger_texte_brut(user_id, nom_fichier):
+    """Va chercher le scan complet d'un seul fichier (compressé ou non)"""
+    res = supabase.table("audit_results").select("raw_text, raw_text_z").eq("user_id", user_id).eq("file_name", nom_fichier).execute()
+    if not res.data: return None
+    ligne = res.data[0]
+    if ligne.get('raw_text_z'): return decompresser_texte(ligne['raw_text_z'])
+    return ligne.get('raw_text')
+
+def compacter_textes_bruts(user_id, taille_lot=200):
+    """Compresse le raw_text des lignes écrites avant raw_text_z, par lots. Renvoie le nombre de lignes traitées."""
+    dernier, nb = "", 0
+    while True:
+        lot = (supabase.table("audit_results").select("file_name, raw_text")
+               .eq("user_id", user_id).is_("raw_text_z", "null").gt("file_name", dernier)
+               .order("file_name").limit(taille_lot).execute().data)
+        if not lot: return nb
+        for ligne in lot:
+            if ligne.get('raw_text'):
+                supabase.table("audit_results").update({
+                    "raw_text_z": compresser_texte(ligne['raw_text']),
+                    "raw_text": None
+                }).eq("user_id", user_id).eq("file_name", ligne['file_name']).execute()
+                nb += 1
+        dernier = lot[-1]['file_name']
+
+# --- CORRECTIFS PAR FOURNISSEUR ---
+# Louis : C'est ici que tu reprends le contrôle manuel. Si l'IA rate un truc connu sur un
+# fournisseur connu, on écrit une règle avec @correctif("NOM CANONIQUE") ("*" = tous les fournisseurs).
+# Les règles tournent après chaque extraction, et peuvent être rejouées sur toutes les factures
+# déjà stockées (bouton Maintenance) sans repayer Gemini. Une règle doit pouvoir tourner deux fois
+# sur la même facture sans rien changer la deuxième fois.
+CORRECTIFS = {}
+
+def correctif(*fournisseurs):
+    """Enregistre la règle décorée pour ces fournisseurs (noms canoniques, "*" = tous)"""
+    def enregistrer(regle):
+        for f in fournisseurs:
+            CORRECTIFS.setdefault(f, []).append(regle)
+        return regle
+    return enregistrer
+
+# Motifs compilés une seule fois (les règles tournent sur des milliers de factures au rejeu).
+# Le FF n'est accepté que dans une cellule qui ne contient QUE lui ("FF 8,99") : jamais au milieu
+# d'une désignation ("INTER DIFF 40A 30MA" ou "BLOC DIFF 63A" ne sont pas des frais).
+MOTIF_FF_YESSS = re.compile(r"^\s*FF\s*:?\s*(\d+(?:[.,]\d{1,2})?)\s*(?:€|EUR)?\s*$")
+DESIGNATION_FF_SCRIPT = "Frais Facturation (Détecté par Script)"
+
+@correctif("*")
+def effacer_commande_egale_facture(data, texte_complet):
+    """Si Facture = Commande, on efface la référence commande"""
+    n_fac = (data.get('num_facture') or '').strip()
+    n_cmd = (data.get('ref_commande') or '').strip()
+    if n_fac not in ("", "-") and n_cmd not in ("", "-") and (n_fac in n_cmd or n_cmd in n_fac):
+        data['ref_commande'] = "-"
+    return data
 
+def montants_ff(valeur, cle=""):
+    """Montants FF trouvés HORS des lignes de produits (champs en plus renvoyés par Gemini)"""
+    if isinstance(valeur, dict):
+        for k, v in valeur.items():
+            if k != 'lignes': yield from montants_ff(v, k)
+    elif isinstance(valeur, list):
+        for v in valeur: yield from montants_ff(v, cle)
+    elif str(cle).strip().upper() == "FF":
+        yield clean_float(valeur)
+    elif isinstance(valeur, str):
+        match_ff = MOTIF_FF_YESSS.match(valeur)
+        if match_ff: yield clean_float(match_ff.group(1))
+
+def montants_ff_texte(texte):
+    """Montants FF du texte brut stocké. Les anciennes réponses de Gemini sont du JSON entouré de
+    texte (```json ...```) : on relit ses champs hors lignes ; sinon, ligne par ligne."""
+    debut, fin = texte.find("{"), texte.rfind("}")
+    if 0 <= debut < fin:
+        try:
+            brut = json.loads(texte[debut:fin + 1])
+        except ValueError:
+            brut = None
+        if isinstance(brut, dict):
+            yield from montants_ff(brut)
+            return
+    for ligne in texte.splitlines():
+        match_ff = MOTIF_FF_YESSS.match(ligne)
+        if match_ff: yield clean_float(match_ff.group(1))
+
+@correctif("YESSS ELECTRIQUE")
+def frais_facture_yesss(data, texte_complet):
+    """Ils cachent le FF (Frais Facture) en bas dans le tableau de TVA"""
+    # 1. Le champ frais_facture du schéma Gemini (extractions récentes)
+    # 2. Sinon un champ en plus hors lignes (ex: "FF 8.99" dans un récap de TVA des anciennes analyses)
+    # 3. Sinon le texte brut stocké (anciennes extractions, avant le schéma)
+    # Jamais dans les désignations : "INTER DIFF 40A 30MA" n'est pas un frais.
+    # Les lignes ajoutées par un passage précédent sont recalculées (les fausses disparaissent au rejeu)
+    lignes = [l for l in data.get('lignes', []) if not (l.get('num_bl_ligne') == "Script" and l.get('designation') == DESIGNATION_FF_SCRIPT)]
+    montant_ff = clean_float(data.get('frais_facture'))
+    if montant_ff <= 0:
+        montant_ff = next((m for m in montants_ff(data) if m > 0), 0.0)
+    if montant_ff <= 0 and texte_complet:
+        montant_ff = next((m for m in montants_ff_texte(texte_complet) if m > 0), 0.0)
+    # On vérifie si la ligne existe déjà pour pas faire de doublon
+    existe = any(l.get('article') == "FRAIS_ANNEXE" or MOTIF_FF_YESSS.match(l.get('designation') or "") for l in lignes)
+    if montant_ff > 0 and not existe:
+        lignes.append({
+            "quantite": 1,
+            "article": "FRAIS_ANNEXE",
+            "designation": DESIGNATION_FF_SCRIPT,
+            "prix_brut_unitaire": montant_ff,
+            "base_facturation": 1,
+            "remise": "",
+            "prix_net_unitaire": montant_ff,
+            "montant": montant_ff,
+            "num_bl_ligne": "Script"
+        })
+    if 'lignes' in data or lignes:
+        data['lignes'] = lignes
+    return data
+
+# Louis : Les cas pièges déjà rencontrés (DIFF 40A, FF du récap de TVA...) sont dans
+# tests/test_correctifs.py : une règle qui les casse fait échouer les tests, pas l'appli.
 def appliquer_correctifs_specifiques(data, texte_complet):
-    """
-    C'est ici que tu reprends le contrôle manuel.
-    Si l'IA rate un truc connu sur un fournisseur connu, on le force par code.
-    """
-    fourn = data.get('fournisseur', '').upper()
-    
-    # --- CAS SPÉCIFIQUE : YESSS ELECTRIQUE ---
-    # Ils cachent le FF (Frais Facture) en bas dans le tableau de TVA
-    if "YESSS" in fourn:
-        # On cherche le motif "FF" suivi d'un montant (ex: FF 8.99) dans le texte brut
-        # Le regex cherche : FF, espaces, puis des chiffres avec point ou virgule
-        match_ff = re.search(r"FF\s+([\d\.,]+)", texte_complet)
-        
-        if match_ff:
-            montant_ff = clean_float(match_ff.group(1))
-            if montant_ff > 0:
-                # On vérifie si la ligne existe déjà pour pas faire de doublon
-                existe = any(l.get('article') == "FRAIS_ANNEXE" for l in data.get('lignes', []))
-                
-                if not existe:
-                    # On injecte la ligne manuellement
-                    data['lignes'].append({
-                        "quantite": 1,
-                        "article": "FRAIS_ANNEXE",
-                        "designation": "Frais Facturation (Détecté par Script)",
-                        "prix_brut": montant_ff,
-                        "remise": 0,
-                        "prix_net": montant_ff,
-                        "montant": montant_ff,
-                        "num_bl_ligne": "Script"
-                    })
-    
+    """Passe les règles génériques puis celles du fournisseur (nom canonique) sur la facture"""
+    fourn = canonaliser_fournisseur(data.get('fournisseur'))
+    for regle in CORRECTIFS.get("*", []) + CORRECTIFS.get(fourn, []):
+        data = regle(data, texte_complet)
     return data
 
-def traiter_un_fichier(nom_fichier, user_id):
+def rejouer_une_facture(user_id, ligne):
+    """Réapplique les correctifs à une facture stockée. Renvoie True si elle a changé."""
+    texte = decompresser_texte(ligne['raw_text_z']) if ligne.get('raw_text_z') else (ligne.get('raw_text') or "")
+    avant = charger_json(ligne['analyse_complete'])
+    # On repart de la réponse brute de Gemini si elle se relit, sinon de l'analyse stockée
+    data, _ = valider_extraction(texte) if texte else (None, None)
+    if data is None:
+        data = copy.deepcopy(avant)
+    data = appliquer_correctifs_specifiques(data, texte)
+    if data == avant:
+        return False
+    supabase.table("audit_results").update({"analyse_complete": data}).eq("user_id", user_id).eq("file_name", ligne['file_name']).execute()
+    return True
+
+def rejouer_correctifs(user_id, nb_workers=8, taille_lot=200):
+    """Rejoue les correctifs sur toutes les factures du compte (aucun appel à Gemini).
+    Renvoie (factures relues, factures modifiées, erreurs)"""
+    dernier, nb_lues, nb_modifiees, nb_erreurs = "", 0, 0, 0
+    with ThreadPoolExecutor(max_workers=nb_workers) as pool:
+        while True:
+            lot = (supabase.table("audit_results").select("file_name, analyse_complete, raw_text, raw_text_z")
+                   .eq("user_id", user_id).gt("file_name", dernier)
+                   .order("file_name").limit(taille_lot).execute().data)
+            if not lot: break
+            futurs = [pool.submit(rejouer_une_facture, user_id, ligne) for ligne in lot]
+            for futur in futurs:
+                try:
+                    nb_modifiees += futur.result()
+                except Exception:
+                    nb_erreurs += 1
+            nb_lues += len(lot)
+            dernier = lot[-1]['file_name']
+    # Les lignes ont pu changer : les records de référence seront recalculés à la prochaine analyse
+    if nb_modifiees:
+        supabase.table("references_articles").update({"valide": False}).eq("user_id", user_id).execute()
+        # Les agrégats sont reconstruits (en tâche de fond) à partir du prochain affichage
+        vider_agregats(user_id)
+    return nb_lues, nb_modifiees, nb_erreurs
+
+# --- TÉLÉMÉTRIE DES EXTRACTIONS ---
+# Louis : Pour chaque facture envoyée à Gemini, on garde le temps de téléchargement, le temps de
+# réponse de l'IA, les jetons consommés, si le JSON était lisible, le nombre de pages et le fournisseur.
+# C'est ce qui permet de choisir le modèle (et le nombre d'imports en parallèle) avec des chiffres.
+def compter_pages_pdf(file_data):
+    """Compte les objets /Type /Page du PDF (None si les pages sont dans des flux compressés)"""
+    try:
+        nb = len(re.findall(rb"/Type\s*/Page(?!s)", file_data))
+        return nb or None
+    except:
+        return None
+
+def jetons_usage(res):
+    """Jetons facturés par Gemini (usage_metadata de la réponse)"""
+    usage = getattr(res, 'usage_metadata', None)
+    return {
+        "jetons_prompt": getattr(usage, 'prompt_token_count', None),
+        "jetons_reponse": getattr(usage, 'candidates_token_count', None),
+        "jetons_total": getattr(usage, 'total_token_count', None),
+    }
+
+def enregistrer_telemetrie(tele):
+    """Une ligne par extraction dans 'telemetrie_extractions' (jamais bloquant pour l'import)"""
+    try:
+        supabase.table("telemetrie_extractions").insert(tele).execute()
+    except:
+        pass
+
+def charger_telemetrie(user_id):
+    try:
+        res = supabase.table("telemetrie_extractions").select("*").eq("user_id", user_id).execute()
+        return pd.DataFrame(res.data)
+    except:
+        return pd.DataFrame()
+
+def cout_extraction(df_tele):
+    """Coût estimé en $ de chaque extraction, selon TARIFS_GEMINI"""
+    prix = df_tele['modele'].map(lambda m: TARIFS_GEMINI.get(m, (0.0, 0.0)))
+    return (df_tele['jetons_prompt'].fillna(0) * prix.str[0] + df_tele['jetons_reponse'].fillna(0) * prix.str[1]) / 1_000_000
+
+def resumer_telemetrie(df_tele, par):
+    """p50 / p95 des latences, taux de JSON valide et coût, regroupés par fournisseur ou par modèle"""
+    df_tele = df_tele.copy()
+    df_tele['cout'] = cout_extraction(df_tele)
+    df_tele['duree_totale_ms'] = df_tele['duree_download_ms'].fillna(0) + df_tele['duree_gemini_ms'].fillna(0)
+    df_tele[par] = df_tele[par].fillna("INCONNU")
+    resume = df_tele.groupby(par).agg(
+        extractions=('file_name', 'count'),
+        json_ok=('json_ok', 'mean'),
+        gemini_p50_ms=('duree_gemini_ms', lambda x: x.quantile(0.50)),
+        gemini_p95_ms=('duree_gemini_ms', lambda x: x.quantile(0.95)),
+        total_p50_ms=('duree_totale_ms', lambda x: x.quantile(0.50)),
+        total_p95_ms=('duree_totale_ms', lambda x: x.quantile(0.95)),
+        pages_moy=('nb_pages', 'mean'),
+        jetons_moy=('jetons_total', 'mean'),
+        tentatives_moy=('tentatives', 'mean'),
+        cout_total=('cout', 'sum'),
+        cout_par_facture=('cout', 'mean'),
+    )
+    resume['json_ok'] = resume['json_ok'] * 100
+    return resume.sort_values('extractions', ascending=False)
+
+def traiter_un_fichier(nom_fichier, user_id, ancien_json=None, articles_regroupes=()):
+    tele = {
+        "file_name": nom_fichier,
+        "user_id": user_id,
+        "modele": MODELE_GEMINI,
+        "tentatives": 0,
+        "json_ok": False,
+        "date_extraction": datetime.now().isoformat(timespec="seconds")
+    }
     try:
         path_storage = f"{user_id}/{nom_fichier}"
+        t0 = time.perf_counter()
         file_data = supabase.storage.from_("factures_audit").download(nom_fichier)
-        # [MODIFICATION] : Passage à Gemini 3.0 Flash-preview (Stable & mais lent) la version 2 est trop pourrier pour le test
-        # On remplace la version "3-preview" qui lag par la référence de vitesse actuelle.
-        model = genai.GenerativeModel("gemini-3-flash-preview")
+        tele["duree_download_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        tele["octets_pdf"] = len(file_data)
+        tele["nb_pages"] = compter_pages_pdf(file_data)
+        model = genai.GenerativeModel(MODELE_GEMINI, generation_config=CONFIG_GEMINI_JSON)
         
         prompt = """
         Analyse cette facture et extrais TOUTES les données structurées.
@@ -211,6 +747,7 @@ def traiter_un_fichier(nom_fichier, user_id):
         3. RÈGLE "FRAIS CACHÉS" :
            - Scanne le bas de la facture pour "FF", "Frais", "Port". 
            - Si trouvé, crée une ligne avec l'article "FRAIS_ANNEXE".
+           - frais_facture : le montant "FF" du récapitulatif de TVA (ex: "FF 8,99" -> 8.99), sinon null.
 
         JSON ATTENDU :
         {
@@ -221,6 +758,7 @@ def traiter_un_fichier(nom_fichier, user_id):
             "date": "2025-01-01",
             "num_facture": "...",
             "ref_commande": "...",
+            "frais_facture": null,
             "lignes": [
                 {
                     "quantite": 1,
@@ -237,29 +775,1333 @@ def traiter_un_fichier(nom_fichier, user_id):
         }
         """
         
+        t0 = time.perf_counter()
+        tele["tentatives"] += 1
         res = model.generate_content([prompt, {"mime_type": "application/pdf", "data": file_data}])
-        if not res.text: return False, "Vide"
-        
-        data_json = extraire_json_robuste(res.text)
-        if not data_json: return False, "JSON Invalide"
-
-        # --- CORRECTIF : Si Facture = Commande, on efface ! ---
-        n_fac = data_json.get('num_facture', '').strip()
-        n_cmd = data_json.get('ref_commande', '').strip()
+        tele["duree_gemini_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        tele.update(jetons_usage(res))
+        if not res.text:
+            tele["statut"] = "Vide"
+            return False, "Vide"
         
-        if n_fac and n_cmd and (n_fac in n_cmd or n_cmd in n_fac):
-             data_json['ref_commande'] = "-"
-        # ------------------------------------------------------
-
-        # --- PATCH MANUEL : On repasse derrière l'IA pour les cas tordus ---
+        data_json, erreur = valider_extraction(res.text)
+        if data_json is None:
+            # Passe de réparation : on renvoie le texte et l'erreur, pas le PDF (bien moins cher)
+            t0 = time.perf_counter()
+            tele["tentatives"] += 1
+            res_rep = model.generate_content(PROMPT_REPARATION.format(erreur=erreur, texte=res.text))
+            tele["duree_gemini_ms"] += round((time.perf_counter() - t0) * 1000, 1)
+            for cle, val in jetons_usage(res_rep).items():
+                if val is not None: tele[cle] = (tele.get(cle) or 0) + val
+            data_json, erreur = valider_extraction(res_rep.text or "")
+            if data_json is None:
+                tele["statut"] = "JSON Invalide"
+                return False, f"JSON Invalide : {erreur[:300]}"
+        tele["json_ok"] = True
+        tele["fournisseur"] = canonaliser_fournisseur(data_json.get('fournisseur', 'INCONNU'))
+
+        # --- PATCH MANUEL : On repasse derrière l'IA pour les cas tordus (Facture = Commande, FF YESSS...) ---
+        data_json = appliquer_correctifs_specifiques(data_json, res.text)
         supabase.table("audit_results").upsert({
             "file_name": nom_fichier,
             "user_id": user_id,
-            "analyse_complete": json.dumps(data_json),
-            "raw_text": res.text
+            "analyse_complete": data_json,
+            "raw_text": None,
+            "raw_text_z": compresser_texte(res.text)
        }).execute()
+        # Les records de référence suivent l'import (seulement les articles de cette facture)
+        maj_references_import(user_id, nom_fichier, data_json, ancien_json, articles_regroupes)
+        maj_achats_import(user_id, nom_fichier, data_json, ancien_json)
+        tele["statut"] = "OK" if tele["tentatives"] == 1 else "OK (réparé)"
         return True, "OK"
-    except Exception as e: return False, str(e)
+    except Exception as e:
+        tele["statut"] = str(e)[:300]
+        return False, str(e)
+    finally:
+        enregistrer_telemetrie(tele)
+
+# --- SCHÉMA DES LIGNES ---
+# Louis : Les chiffres restent des chiffres (float64) jusqu'à l'affichage : plus de "64%" ou de
+# "12.3400" à re-parser avec clean_float. Les colonnes qui se répètent d'une ligne à l'autre
+# (fournisseur, famille, article, facture...) sont en 'category', et la date est une vraie date.
+SCHEMA_LIGNES = {
+    "Fichier": "category",
+    "Facture": "category",
+    "Date": "datetime64[ns]",
+    "Ref_Cmd": "category",
+    "BL": "category",
+    "Fournisseur": "category",
+    "IBAN": "category",
+    "TVA_Intra": "category",
+    "Adresse": "category",
+    "Quantité": "float64",
+    "Article": "category",
+    "Désignation": "str",
+    "Prix Brut": "float64",
+    "Remise": "float64",
+    "Prix Net": "float64",
+    "Montant": "float64",
+    "PU_Systeme": "float64",
+    "Famille": "category",
+    "Ref_Absente": "bool"
+}
+
+def nouvelles_colonnes():
+    """Accumulateur colonne par colonne (une liste par colonne, pas un dict par ligne)"""
+    return {col: [] for col in SCHEMA_LIGNES}
+
+# Formats de date acceptés, dans l'ordre : ISO (ce que demande le prompt), puis jour/mois/année
+# (factures françaises). Jamais de format "deviné" sur la première valeur : le résultat d'une
+# ligne ne dépend ni des autres lignes, ni de l'endroit où tombent les pages au chargement.
+FORMATS_DATE_FR = ["%d/%m/%Y", "%d/%m/%y"]
+
+def lire_dates(valeurs):
+    """Textes de date -> datetime64 (NaT si illisible), en ne parsant qu'une fois chaque valeur distincte"""
+    textes = pd.Series(valeurs, dtype=object)
+    textes = textes.where(textes.notna(), "").astype(str).str.strip()
+    uniques = pd.Index([t for t in textes.unique() if t], dtype=object)
+    dates = pd.Series(pd.to_datetime(uniques, format="ISO8601", errors='coerce'), index=uniques, dtype="datetime64[ns]")
+    # "15.03.2024" ou "15-03-2024" : mêmes règles que "15/03/2024"
+    slashs = uniques.str.replace(r"[.\-]", "/", regex=True) if len(uniques) else uniques
+    for fmt in FORMATS_DATE_FR:
+        dates = dates.fillna(pd.Series(pd.to_datetime(slashs, format=fmt, errors='coerce'), index=uniques, dtype="datetime64[ns]"))
+    return pd.Series(dates.reindex(textes).to_numpy(), index=textes.index, dtype="datetime64[ns]")
+
+def construire_df_lignes(colonnes):
+    """Passe les listes accumulées au schéma typé"""
+    df = pd.DataFrame(colonnes, columns=list(SCHEMA_LIGNES))
+    for col, dtype in SCHEMA_LIGNES.items():
+        if dtype == "datetime64[ns]":
+            df[col] = lire_dates(df[col])
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def concatener_lignes(morceaux):
+    """Recolle les pages typées. pd.concat repasse en 'object' les catégories qui diffèrent
+    d'une page à l'autre : on réunit donc les catégories colonne par colonne."""
+    if not morceaux: return construire_df_lignes(nouvelles_colonnes())
+    if len(morceaux) == 1: return morceaux[0]
+    colonnes = {}
+    for col, dtype in SCHEMA_LIGNES.items():
+        if dtype == "category":
+            colonnes[col] = pd.api.types.union_categoricals([m[col] for m in morceaux], sort_categories=True)
+        else:
+            colonnes[col] = pd.concat([m[col] for m in morceaux], ignore_index=True)
+    return pd.DataFrame(colonnes)
+
+def formater_date(d):
+    """Date -> texte pour l'affichage et le stockage ('Inconnue' si absente)"""
+    if isinstance(d, str): return d
+    return d.strftime("%Y-%m-%d") if pd.notna(d) else "Inconnue"
+
+def formater_remise(val):
+    """64.0 -> '64%' ; 0 -> '-' (ce qu'on stockait avant dans la colonne Remise)"""
+    return f"{val:g}%" if val > 0 else "-"
+
+def canonaliser_fournisseur(nom):
+    """Regroupe les variantes de nom lues par l'IA sous un seul fournisseur"""
+    fourn = (nom or 'INCONNU').upper()
+    if "YESSS" in fourn: fourn = "YESSS ELECTRIQUE"
+    elif "AUSTRAL" in fourn: fourn = "AUSTRAL HORIZON"
+    elif "PARTEDIS" in fourn: fourn = "PARTEDIS"
+    return fourn
+
+def normaliser_facture(f_name, data, colonnes):
+    """Ajoute les lignes d'une facture à l'accumulateur et renvoie le fournisseur canonique"""
+    fourn = canonaliser_fournisseur(data.get('fournisseur', 'INCONNU'))
+    date_fac = data.get('date', 'Inconnue')
+    num_fac = data.get('num_facture', '-')
+    ref_cmd = data.get('ref_commande', '-')
+
+    iban_f = data.get('iban', '-')
+    tva_f = data.get('tva_fournisseur', '-')
+    adr_f = data.get('adresse_fournisseur', '-')
+
+    for l in data.get('lignes', []):
+        qte_ia = clean_float(l.get('quantite', 1))
+        if qte_ia == 0: qte_ia = 1
+
+        montant = clean_float(l.get('montant', 0))
+
+        # --- NOUVELLE LOGIQUE UNIVERSELLE DE CALCUL ---
+        base_fac = float(l.get('base_facturation', 1))
+        if base_fac <= 0: base_fac = 1
+
+        # Calcul du Net Réel
+        p_net_lu = clean_float(l.get('prix_net_unitaire', l.get('prix_net', 0)))
+        p_net = p_net_lu / base_fac
+
+        # Sécurité Rétro-compatibilité (si l'IA a mis le slash dans l'ancien champ)
+        raw_net = str(l.get('prix_net', '0'))
+        if '/' in raw_net and base_fac == 1:
+            try: p_net = clean_float(raw_net.split('/')[0]) / float(raw_net.split('/')[1])
+            except: pass
+
+        # Calcul du Brut Réel
+        p_brut_lu = clean_float(l.get('prix_brut_unitaire', l.get('prix_brut', 0)))
+        p_brut = p_brut_lu / base_fac
+
+        if '/' in str(l.get('prix_brut', '')) and base_fac == 1:
+            try: p_brut = clean_float(str(l.get('prix_brut')).split('/')[0]) / float(str(l.get('prix_brut')).split('/')[1])
+            except: pass
+
+        # ----------------------------------------------
+
+        raw_remise = str(l.get('remise', '0'))
+        val_remise = calculer_remise_combine(raw_remise)
+        num_bl = l.get('num_bl_ligne', '-')
+        qte_finale = qte_ia
+        if montant > 0 and p_net > 0:
+            ratio = montant / p_net
+            if abs(ratio - round(ratio)) < 0.05: 
+                 qte_math = round(ratio)
+                 if qte_math != qte_ia and qte_math > 0:
+                     qte_finale = qte_math
+
+        if montant > 0 and qte_finale > 0:
+            pu_systeme = montant / qte_finale
+        elif p_net > 0:
+            pu_systeme = p_net 
+        else:
+            pu_systeme = 0
+
+        article = l.get('article', 'SANS_REF')
+        ref_absente = not article or article == "None" or article == "SANS_REF"
+        if ref_absente:
+            # Clé provisoire : regrouper_articles_sans_ref la remplace par celle du groupe de désignations
+            article = (l.get('designation') or 'SANS_NOM')[:20]
+
+        famille = detecter_famille(l.get('designation', ''), article)
+
+        ligne = {
+            "Fichier": f_name,
+            "Facture": num_fac,
+            "Date": date_fac,
+            "Ref_Cmd": ref_cmd,
+            "BL": num_bl,
+            "Fournisseur": fourn,
+            "IBAN": iban_f,
+            "TVA_Intra": tva_f,
+            "Adresse": adr_f,
+            "Quantité": qte_finale,
+            "Article": article,
+            "Désignation": l.get('designation', ''),
+            "Prix Brut": p_brut,
+            "Remise": val_remise,
+            "Prix Net": p_net, 
+            "Montant": montant,
+            "PU_Systeme": pu_systeme,
+            "Famille": famille,
+            "Ref_Absente": ref_absente
+        }
+        for col, val in ligne.items():
+            colonnes[col].append(val)
+    return fourn
+
+# --- ARTICLES SANS RÉFÉRENCE : REGROUPEMENT PAR DÉSIGNATION ---
+# Louis : Sans référence, l'article était rangé sous les 20 premiers caractères de la désignation :
+# le même produit écrit un peu différemment (autre facture, autre fournisseur) partait sous une
+# autre clé et échappait à la comparaison des prix. On regroupe maintenant les désignations proches
+# (trigrammes de caractères, MinHash + LSH) sans comparer toutes les paires entre elles.
+# Règle métier : les chiffres doivent être IDENTIQUES (calibre, section, longueur...), sinon
+# "DISJONCTEUR 16A" et "DISJONCTEUR 20A" finiraient ensemble.
+NB_PERMUTATIONS_MINHASH = 64
+BANDES_LSH = 16          # 16 bandes de 4 valeurs : les paires à ~50 % de similarité sont déjà candidates
+SEUIL_SIMILARITE_DESIGNATION = 0.75
+TAILLE_MAX_SEAU_LSH = 50
+_alea_minhash = np.random.default_rng(20261019)
+_MINHASH_A = _alea_minhash.integers(1, 2**63, NB_PERMUTATIONS_MINHASH, dtype=np.uint64) | np.uint64(1)
+_MINHASH_B = _alea_minhash.integers(0, 2**63, NB_PERMUTATIONS_MINHASH, dtype=np.uint64)
+MOTIF_NON_ALNUM = re.compile(r"[^A-Z0-9.]+")
+MOTIF_NOMBRE = re.compile(r"\d+(?:\.\d+)?")
+
+def normaliser_designation(texte):
+    """Majuscules, sans accents ni ponctuation ("Câble 3G2,5" -> "CABLE 3G2.5")"""
+    texte = unicodedata.normalize("NFKD", str(texte or "")).encode("ascii", "ignore").decode("ascii").upper()
+    texte = re.sub(r"(?<=\d),(?=\d)", ".", texte)
+    return MOTIF_NON_ALNUM.sub(" ", texte).strip()
+
+def trigrammes(texte):
+    texte = f" {texte} "
+    return frozenset(texte[i:i + 3] for i in range(len(texte) - 2))
+
+def signature_minhash(grammes):
+    # Hachage multiplier-décaler : une "permutation" aléatoire par ligne de _MINHASH_A / _MINHASH_B
+    x = np.fromiter((zlib.crc32(g.encode()) for g in grammes), dtype=np.uint64, count=len(grammes))
+    return ((_MINHASH_A[:, None] * x[None, :] + _MINHASH_B[:, None]) >> np.uint64(32)).min(axis=1)
+
+def regrouper_designations(designations):
+    """designations : liste de (désignation, article, ref_absente, nb_lignes) uniques.
+    Renvoie {désignation d'une ligne sans référence: clé article du groupe}"""
+    normes = [normaliser_designation(d) for d, _, _, _ in designations]
+    grammes = [trigrammes(n) for n in normes]
+    nombres = [tuple(sorted(MOTIF_NOMBRE.findall(n))) for n in normes]
+
+    # 1. Seaux LSH : deux désignations qui partagent une bande (et les mêmes chiffres) sont candidates
+    seaux = {}
+    lignes_bande = NB_PERMUTATIONS_MINHASH // BANDES_LSH
+    for i, n in enumerate(normes):
+        if not n: continue
+        sig = signature_minhash(grammes[i]).tobytes()
+        pas = lignes_bande * 8
+        for b in range(BANDES_LSH):
+            seaux.setdefault((nombres[i], b, sig[b * pas:(b + 1) * pas]), []).append(i)
+
+    # 2. Vérification exacte (Jaccard des trigrammes) et union des groupes
+    parent = list(range(len(designations)))
+    def racine(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    def similaires(i, j):
+        return len(grammes[i] & grammes[j]) >= SEUIL_SIMILARITE_DESIGNATION * len(grammes[i] | grammes[j])
+    for membres in seaux.values():
+        if len(membres) < 2: continue
+        # Seau énorme (désignations quasi identiques) : on compare chacun à son voisin plutôt que toutes les paires
+        paires = ((i, j) for k, i in enumerate(membres) for j in membres[k + 1:]) if len(membres) <= TAILLE_MAX_SEAU_LSH \
+            else zip(membres, membres[1:])
+        for i, j in paires:
+            ri, rj = racine(i), racine(j)
+            if ri != rj and similaires(i, j):
+                parent[max(ri, rj)] = min(ri, rj)
+
+    # 3. Clé de chaque groupe : la vraie référence si le groupe n'en contient qu'une,
+    # sinon la clé provisoire la plus fréquente du groupe (un accord déjà posé dessus reste valable)
+    groupes = {}
+    for i, (d, art, absente, nb) in enumerate(designations):
+        groupes.setdefault(racine(i), []).append((d, art, absente, nb))
+    cles, provisoires = {}, {}
+    for r, membres in groupes.items():
+        sans_ref = [m for m in membres if m[2]]
+        if not sans_ref: continue
+        refs = {art for _, art, absente, _ in membres if not absente}
+        if len(refs) == 1:
+            cles[r] = refs.pop()
+        else:
+            poids = {}
+            for _, art, _, nb in sans_ref:
+                poids[art] = poids.get(art, 0) + nb
+            provisoires[r] = min(poids, key=lambda a: (-poids[a], a))
+
+    # La clé provisoire n'est que designation[:20] : "CABLE RIGIDE U1000 R2V 3G1,5" et "... 3G2,5"
+    # donnent la même. Si plusieurs groupes (ou une vraie référence) la partagent, chacun de ces
+    # groupes prend la désignation complète de son représentant, pour ne jamais mélanger deux produits.
+    refs_connues = {art for _, art, absente, _ in designations if not absente}
+    partages = {}
+    for cle in provisoires.values():
+        partages[cle] = partages.get(cle, 0) + 1
+    prises = refs_connues | {cle for cle in provisoires.values() if partages[cle] == 1 and cle not in refs_connues}
+    for r, cle in sorted(provisoires.items(), key=lambda x: x[1]):
+        if partages[cle] > 1 or cle in refs_connues:
+            sans_ref = sorted((m for m in groupes[r] if m[2]), key=lambda m: (-m[3], m[0]))
+            cle = normaliser_designation(sans_ref[0][0]) or sans_ref[0][0]
+            if cle in prises:
+                cle = f"{cle} #{hashlib.sha1(chr(31).join(sorted(m[0] for m in sans_ref)).encode()).hexdigest()[:6]}"
+            prises.add(cle)
+        cles[r] = cle
+
+    correspondance = {}
+    for r, cle in cles.items():
+        for d, _, absente, _ in groupes[r]:
+            if absente: correspondance[d] = cle
+    return correspondance
+
+# Louis : Le regroupement est gardé dans 'regroupements_designations' avec l'empreinte des
+# désignations du dossier : une session neuve (ou un autre poste) le relit au lieu de refaire le
+# MinHash-LSH sur tout le dossier. Il n'est recalculé que si les désignations ont changé.
+VERSION_REGROUPEMENT = 2  # à monter si la règle de regroupement change (les regroupements stockés sont alors refaits)
+
+def charger_regroupement(user_id):
+    with etape("regroupement_stocke"):
+        res = supabase.table("regroupements_designations").select("empreinte, correspondance").eq("user_id", user_id).execute()
+        return res.data[0] if res.data else None
+
+def sauvegarder_regroupement(user_id, empreinte, correspondance):
+    try:
+        supabase.table("regroupements_designations").upsert({
+            "user_id": user_id, "empreinte": empreinte, "correspondance": correspondance,
+            "date_maj": datetime.now().strftime("%Y-%m-%d")
+        }, on_conflict="user_id").execute()
+    except:
+        # Table absente ou erreur réseau : le regroupement sera refait à la prochaine session
+        pass
+
+def regrouper_articles_sans_ref(df, user_id=None, stocke=None):
+    """Remplace la clé provisoire des lignes sans référence par celle de leur groupe de désignations.
+    stocke : regroupement lu au démarrage ({empreinte, correspondance}), réutilisé s'il est à jour"""
+    masque = df['Ref_Absente'] & ~df['Famille'].isin(FAMILLES_HORS_PRODUIT)
+    if not masque.any():
+        return df
+    with etape("regroupement_articles") as diag:
+        produits = df[~df['Famille'].isin(FAMILLES_HORS_PRODUIT)]
+        comptes = produits.groupby(['Désignation', 'Article', 'Ref_Absente'], observed=True).size()
+        designations = sorted((str(d), str(a), bool(r), int(nb)) for (d, a, r), nb in comptes.items() if nb > 0)
+        empreinte = hashlib.sha1(f"v{VERSION_REGROUPEMENT}\x1d".encode() + "\x1f".join(
+            f"{d}\x1e{a}\x1e{r}\x1e{nb}" for d, a, r, nb in designations).encode()).hexdigest()
+        # 1. Déjà calculé dans cette session  2. Stocké en base (autre session, autre poste)  3. Calcul
+        cache = st.session_state.get('regroupement')
+        if cache and cache['empreinte'] == empreinte:
+            correspondance, origine = cache['correspondance'], "session"
+        elif stocke and stocke.get('empreinte') == empreinte:
+            correspondance, origine = charger_json(stocke['correspondance']), "base"
+        else:
+            correspondance, origine = regrouper_designations(designations), "calcul"
+            if user_id:
+                sauvegarder_regroupement(user_id, empreinte, correspondance)
+        st.session_state['regroupement'] = {'empreinte': empreinte, 'correspondance': correspondance}
+
+        # Le dossier normalisé est gardé en session d'une relance à l'autre : on n'y touche pas sur place
+        df = df.copy()
+        nouvelles = df.loc[masque, 'Désignation'].map(correspondance)
+        nouvelles = nouvelles.fillna(df.loc[masque, 'Article'].astype(str))
+        a_changer = nouvelles != df.loc[masque, 'Article'].astype(str)
+        df['Article'] = df['Article'].cat.add_categories(sorted(set(nouvelles) - set(df['Article'].cat.categories)))
+        df.loc[nouvelles.index[a_changer], 'Article'] = nouvelles[a_changer]
+        df['Article'] = df['Article'].cat.remove_unused_categories()
+        diag.update(lignes=int(masque.sum()), designations=len(designations), rattachees=int(a_changer.sum()), origine=origine)
+    return df
+
+# --- RÉFÉRENCES ARTICLES (Records maintenus au fil de l'eau) ---
+# Louis : Avant, on recalculait les records de chaque article (meilleure remise, meilleur prix)
+# sur tout l'historique à chaque affichage. Maintenant on les garde dans la table
+# 'references_articles' : on les met à jour à l'import, et on ne recalcule un article
+# que si son record est périmé (nouvelles lignes, écrasement, passage en PROMO...).
+# Le registre (CONTRAT, correction Net/Brut) est appliqué à la lecture, dans finaliser_reference.
+FAMILLES_HORS_PRODUIT = ['FRAIS PORT', 'FRAIS GESTION', 'TAXE']
+
+def record_depuis_ligne(ligne):
+    """Record d'un article qui n'a qu'une seule ligne (équivaut au group.iloc[0] de secours)"""
+    return {
+        'remise_best': float(ligne['Remise']),
+        'pu_best_remise': float(ligne['PU_Systeme']),
+        'brut_best_remise': float(ligne['Prix Brut']),
+        'date_best_remise': formater_date(ligne['Date']),
+        'pu_best_prix': float(ligne['PU_Systeme']),
+        'remise_best_prix': float(ligne['Remise']),
+        'date_best_prix': formater_date(ligne['Date']),
+        'nb_lignes': 1,
+        'promo': False
+    }
+
+def fusionner_ligne_record(rec, ligne):
+    """Mise à jour online : une nouvelle ligne ne peut qu'améliorer les records (hors PROMO)"""
+    remise_val = float(ligne['Remise'])
+    pu = float(ligne['PU_Systeme'])
+    # Un record à 0 % (ou à 0.01 €) est un record "de secours" : la première vraie valeur le remplace
+    if remise_val > 0 and (rec['remise_best'] <= 0 or remise_val > rec['remise_best']
+                           or (remise_val == rec['remise_best'] and pu < rec['pu_best_remise'])):
+        rec['remise_best'] = remise_val
+        rec['pu_best_remise'] = pu
+        rec['brut_best_remise'] = float(ligne['Prix Brut'])
+        rec['date_best_remise'] = formater_date(ligne['Date'])
+    if pu > 0.01 and (rec['pu_best_prix'] <= 0.01 or pu < rec['pu_best_prix']
+                      or (pu == rec['pu_best_prix'] and remise_val > rec['remise_best_prix'])):
+        rec['pu_best_prix'] = pu
+        rec['remise_best_prix'] = remise_val
+        rec['date_best_prix'] = formater_date(ligne['Date'])
+    rec['nb_lignes'] += 1
+    return rec
+
+def calculer_record_article(group, accord):
+    """Recalcul complet d'un article depuis son historique"""
+    # Logique de sélection des records (à égalité, le meilleur prix / la meilleure remise départage,
+    # comme dans fusionner_ligne_record, pour que l'ordre d'import ne change rien)
+    valid_remises = group[group['Remise'] > 0].sort_values(['Remise', 'PU_Systeme'], ascending=[False, True], kind='stable')
+    valid_prices = group[group['PU_Systeme'] > 0.01].sort_values(['PU_Systeme', 'Remise'], ascending=[True, False], kind='stable')
+
+    # --- CORRECTION PROMO ---
+    # Louis : Si tu marques un article comme "PROMO", on identifie le prix de cette promo
+    # (le moins cher de la liste) et on ignore TOUTES les factures qui ont ce prix promo.
+    # De cette façon, il va chercher le prix suivant (ton prix normal à 129 €) pour calculer la perte.
+    est_promo = bool(accord and accord['type'] == "PROMO")
+    if est_promo and not valid_prices.empty:
+        prix_promo = valid_prices.iloc[0]['PU_Systeme']
+        valid_prices = valid_prices[abs(valid_prices['PU_Systeme'] - prix_promo) > 0.10]
+        valid_remises = valid_remises[abs(valid_remises['PU_Systeme'] - prix_promo) > 0.10]
+    # -------------------------
+
+    best_r_row = valid_remises.iloc[0] if not valid_remises.empty else group.iloc[0]
+    best_p_row = valid_prices.iloc[0] if not valid_prices.empty else group.iloc[0]
+
+    return {
+        'remise_best': float(best_r_row['Remise']),
+        'pu_best_remise': float(best_r_row['PU_Systeme']),
+        'brut_best_remise': float(best_r_row['Prix Brut']),
+        'date_best_remise': formater_date(best_r_row['Date']),
+        'pu_best_prix': float(best_p_row['PU_Systeme']),
+        'remise_best_prix': float(best_p_row['Remise']),
+        'date_best_prix': formater_date(best_p_row['Date']),
+        'nb_lignes': int(len(group)),
+        'promo': est_promo
+    }
+
+def record_perime(rec, nb_lignes, accord):
+    """Un record est à recalculer s'il manque, s'il a été invalidé ou s'il ne colle plus à l'historique"""
+    if not rec or not rec.get('valide', True):
+        return True
+    est_promo = bool(accord and accord['type'] == "PROMO")
+    return rec['nb_lignes'] != nb_lignes or bool(rec['promo']) != est_promo
+
+def finaliser_reference(rec, accord):
+    """Applique le registre au record brut et renvoie l'entrée du ref_map"""
+    # Si c'est un CONTRAT forcé, on écrase la remise par celle du registre
+    est_contrat = bool(accord and accord['type'] == "CONTRAT")
+    remise_finale = accord['valeur'] if est_contrat else rec['remise_best']
+
+    # --- CORRECTION LOGIQUE "PRIX NET" vs "PRIX BRUT" ---
+    # Si le meilleur prix est un "Net" (0 remise) et qu'il est meilleur que le prix remisé habituel
+    # Alors on recalcule la remise théorique en utilisant le Brut du prix remisé.
+    p_net_record = rec['pu_best_prix']
+    p_net_standard = rec['pu_best_remise']
+
+    if p_net_record < (p_net_standard - 0.05) and rec['remise_best_prix'] == 0:
+        brut_ref = rec['brut_best_remise']
+        if brut_ref > 0:
+            # Calcul inverse : Quelle remise donne ce prix net sur ce brut ?
+            taux_virtuel = (1 - (p_net_record / brut_ref)) * 100
+            remise_finale = round(taux_virtuel, 2)
+    # ----------------------------------------------------
+
+    return {
+        'Best_Remise': remise_finale,
+        'Best_Brut_Associe': rec['brut_best_remise'],
+        'Best_Price_Net': rec['pu_best_prix'],
+        'Price_At_Best_Remise': rec['pu_best_remise'],
+        'Date_Remise': accord['date'] if est_contrat else rec['date_best_remise'],
+        'Date_Price': rec['date_best_prix']
+    }
+
+def charger_references(user_id, articles=None):
+    """Lit les records stockés du compte (éventuellement limités à quelques articles)"""
+    with etape("charger_references") as diag:
+        try:
+            if articles is None:
+                data = supabase.table("references_articles").select("*").eq("user_id", user_id).execute().data
+            else:
+                data = []
+                for lot in par_lots(sorted(set(articles)), TAILLE_LOT_FILTRE):
+                    data += supabase.table("references_articles").select("*").eq("user_id", user_id).in_("article", lot).execute().data
+            diag.update(lignes=len(data))
+            return {r['article']: r for r in data}
+        except:
+            return {}
+
+def sauvegarder_references(user_id, records):
+    """Upserts groupés (par lots) pour tous les articles touchés"""
+    if not records: return
+    try:
+        lignes = [
+            {
+                "user_id": user_id,
+                "article": art,
+                "remise_best": rec['remise_best'],
+                "pu_best_remise": rec['pu_best_remise'],
+                "brut_best_remise": rec['brut_best_remise'],
+                "date_best_remise": rec['date_best_remise'],
+                "pu_best_prix": rec['pu_best_prix'],
+                "remise_best_prix": rec['remise_best_prix'],
+                "date_best_prix": rec['date_best_prix'],
+                "nb_lignes": rec['nb_lignes'],
+                "promo": rec['promo'],
+                "valide": rec.get('valide', True),
+                "date_maj": datetime.now().strftime("%Y-%m-%d")
+            } for art, rec in records.items()
+        ]
+        for lot in par_lots(lignes, TAILLE_LOT_INSERT):
+            supabase.table("references_articles").upsert(lot).execute()
+    except:
+        # Table absente ou erreur réseau : l'analyse recalculera depuis l'historique
+        pass
+
+def maj_references_import(user_id, nom_fichier, data_json, ancien_json=None, articles_regroupes=()):
+    """Louis : Appelé après chaque import, on ne touche QUE les articles de la facture.
+    articles_regroupes : clés de groupe des lignes sans référence de l'ancienne version (écrasement)"""
+    colonnes = nouvelles_colonnes()
+    normaliser_facture(nom_fichier, data_json, colonnes)
+    df_new = construire_df_lignes(colonnes)
+    # Une ligne sans référence n'a ici que sa clé provisoire : la clé de son groupe de désignations
+    # n'est connue qu'en regroupant tout le dossier. On ne crée donc pas de record pour elle : le
+    # groupe compte une ligne de plus et l'analyse recalcule son record (nb_lignes ne colle plus).
+    df_new = df_new[~df_new['Famille'].isin(FAMILLES_HORS_PRODUIT) & (df_new['Article'] != 'SANS_REF') & ~df_new['Ref_Absente']]
+
+    # En cas d'écrasement, les anciennes lignes disparaissent : un record ne sait pas "reculer",
+    # donc on invalide les articles concernés et l'analyse les recalculera.
+    articles_ecrases = set()
+    if ancien_json:
+        anciennes = nouvelles_colonnes()
+        normaliser_facture(nom_fichier, ancien_json, anciennes)
+        articles_ecrases = {a for a, absente in zip(anciennes['Article'], anciennes['Ref_Absente']) if not absente}
+        articles_ecrases |= set(articles_regroupes)
+
+    touches = set(df_new['Article']) | articles_ecrases
+    if not touches: return
+    records = charger_references(user_id, touches)
+
+    for _, l in df_new.iterrows():
+        art = l['Article']
+        rec = records.get(art)
+        if rec is None:
+            records[art] = record_depuis_ligne(l)
+        elif rec['promo'] or art in articles_ecrases:
+            # Le filtre PROMO dépend de tout l'historique : on laisse l'analyse recalculer
+            rec['valide'] = False
+        else:
+            fusionner_ligne_record(rec, l)
+
+    for art in articles_ecrases:
+        if art in records:
+            records[art]['valide'] = False
+
+    sauvegarder_references(user_id, {a: records[a] for a in touches if a in records})
+
+def construire_ref_map(df, registre, user_id, articles=None, references=None):
+    """Louis : Le "Cerveau". On lit les records déjà calculés au lieu de tout rescanner,
+    et on ne recalcule que les articles dont le record est absent ou périmé.
+    articles : si renseigné, on ne prépare que ces articles (analyse d'un seul fournisseur)
+    references : records déjà lus au démarrage (sinon on va les chercher)"""
+    ref_map = {}
+    df_produits = df[~df['Famille'].isin(FAMILLES_HORS_PRODUIT)]
+    if df_produits.empty:
+        return ref_map
+
+    df_clean = df_produits[df_produits['Article'] != 'SANS_REF']
+    nb_par_article = df_clean['Article'].value_counts()
+    nb_par_article = nb_par_article[nb_par_article > 0]
+    if articles is not None:
+        nb_par_article = nb_par_article[nb_par_article.index.isin(list(articles))]
+    if nb_par_article.empty:
+        return ref_map
+
+    if references is None:
+        references = charger_references(user_id, None if articles is None else nb_par_article.index)
+
+    with etape("ref_map", articles=len(nb_par_article)) as diag:
+        a_recalculer = [art for art, nb in nb_par_article.items() if record_perime(references.get(art), nb, registre.get(art))]
+        diag.update(recalcules=len(a_recalculer))
+
+        if a_recalculer:
+            for art, group in df_clean[df_clean['Article'].isin(a_recalculer)].groupby('Article', observed=True):
+                references[art] = calculer_record_article(group, registre.get(art))
+            sauvegarder_references(user_id, {art: references[art] for art in a_recalculer})
+
+        for art in nb_par_article.index:
+            # On vérifie si Marcel a déjà pris une décision sur cet article
+            ref_map[art] = finaliser_reference(references[art], registre.get(art))
+    return ref_map
+
+# --- RÉFÉRENCE "À LA DATE DE LA FACTURE" ---
+# Louis : Le ref_map garde le meilleur prix JAMAIS vu, y compris sur des factures plus récentes que
+# celle qu'on juge. En mode "à la date", on ne compare qu'à ce qui était connu ce jour-là.
+# Pour chaque article, l'historique est trié par date et on précalcule, position par position,
+# l'indice du meilleur record connu jusque-là (tableaux "préfixes"). Une ligne retrouve sa
+# référence par recherche dichotomique sur les dates, au lieu de refiltrer tout l'historique.
+def construire_index_asof(df, registre, articles=None):
+    """Index par article : dates triées + meilleurs records cumulés (mêmes règles que calculer_record_article)"""
+    index = {}
+    df_clean = df[~df['Famille'].isin(FAMILLES_HORS_PRODUIT) & (df['Article'] != 'SANS_REF') & df['Date'].notna()]
+    if articles is not None:
+        df_clean = df_clean[df_clean['Article'].isin(list(articles))]
+
+    with etape("index_asof") as diag:
+        for art, group in df_clean.sort_values('Date', kind='stable').groupby('Article', observed=True):
+            accord = registre.get(art)
+            remises = group['Remise'].to_numpy()
+            pus = group['PU_Systeme'].to_numpy()
+            remise_ok = remises > 0
+            prix_ok = pus > 0.01
+            # PROMO : le prix promo est le moins cher de tout l'historique, ignoré à toutes les dates
+            est_promo = bool(accord and accord['type'] == "PROMO")
+            if est_promo and prix_ok.any():
+                hors_promo = np.abs(pus - pus[prix_ok].min()) > 0.10
+                remise_ok &= hors_promo
+                prix_ok &= hors_promo
+
+            # À égalité, le meilleur prix / la meilleure remise départage (comme fusionner_ligne_record).
+            # Tant qu'aucune ligne n'est valable, le secours est la première ligne connue.
+            best_r = np.zeros(len(group), dtype=np.int64)
+            best_p = np.zeros(len(group), dtype=np.int64)
+            ir = ip = -1
+            for i in range(len(group)):
+                if remise_ok[i] and (ir < 0 or remises[i] > remises[ir] or (remises[i] == remises[ir] and pus[i] < pus[ir])):
+                    ir = i
+                if prix_ok[i] and (ip < 0 or pus[i] < pus[ip] or (pus[i] == pus[ip] and remises[i] > remises[ip])):
+                    ip = i
+                best_r[i] = max(ir, 0)
+                best_p[i] = max(ip, 0)
+
+            index[art] = {
+                'dates': group['Date'].to_numpy(),
+                'best_r': best_r, 'best_p': best_p,
+                'remises': remises, 'pus': pus, 'bruts': group['Prix Brut'].to_numpy(),
+                'accord': accord, 'promo': est_promo, 'cache': {}
+            }
+        diag.update(articles=len(index), lignes=len(df_clean))
+    return index
+
+def reference_a_date(index, art, date):
+    """Entrée du ref_map pour cet article, limitée à l'historique connu à cette date (None si rien)"""
+    entree = index.get(art)
+    if entree is None or pd.isna(date):
+        return None
+    pos = np.searchsorted(entree['dates'], np.datetime64(date), side='right') - 1
+    if pos < 0:
+        return None
+    ir, ip = int(entree['best_r'][pos]), int(entree['best_p'][pos])
+    cache = entree['cache']
+    if (ir, ip) not in cache:
+        rec = {
+            'remise_best': float(entree['remises'][ir]),
+            'pu_best_remise': float(entree['pus'][ir]),
+            'brut_best_remise': float(entree['bruts'][ir]),
+            'date_best_remise': formater_date(pd.Timestamp(entree['dates'][ir])),
+            'pu_best_prix': float(entree['pus'][ip]),
+            'remise_best_prix': float(entree['remises'][ip]),
+            'date_best_prix': formater_date(pd.Timestamp(entree['dates'][ip])),
+            'nb_lignes': pos + 1,
+            'promo': entree['promo']
+        }
+        cache[(ir, ip)] = finaliser_reference(rec, entree['accord'])
+    return cache[(ir, ip)]
+
+def analyser_lignes(df_lignes, ref_map, config_dict, facture_totals, index_asof=None):
+    """Passe chaque ligne au crible (frais, port, prix) et renvoie la liste des anomalies.
+    index_asof : si renseigné, chaque ligne est jugée sur l'historique connu à la date de sa facture"""
+    debut = time.perf_counter()
+    anomalies = []
+
+    for idx, row in df_lignes.iterrows():
+        f_name = row['Fichier']
+        num_facture = row['Facture']
+        fourn = row['Fournisseur']
+
+        rules = config_dict.get(fourn, {"Franco (Seuil €)": 0.0, "Max Gestion (€)": 0.0})
+        seuil_franco = rules.get("Franco (Seuil €)", 0.0)
+        max_gestion = rules.get("Max Gestion (€)", 0.0)
+
+        perte = 0
+        motif = ""
+        cible = 0.0                 
+        source_cible = "-"
+        # Louis : On crée une variable vide au début de chaque ligne.
+        # Elle servira à stocker le "Vrai Prix Historique" si on en trouve un.
+        prix_historique_ref = 0.
+        detail_tech = ""
+        # 2. INITIALISATION (Corrigée : Placée ICI, avant les IF)
+        remise_cible_str = "-" 
+        remise_cible_val = 0.0
+
+        # --- LOGIQUE 1 : FRAIS (Gestion & Port) ---
+        if row['Famille'] == "FRAIS GESTION":
+            if row['Montant'] > max_gestion:
+                perte = row['Montant'] - max_gestion
+                cible = max_gestion
+                motif = "Frais Facturation Abusifs"
+                detail_tech = f"(Max autorisé: {max_gestion}€)"
+
+        elif row['Famille'] == "FRAIS PORT":
+            total_fac = facture_totals.get(f_name, 0)
+            if total_fac >= seuil_franco:
+                perte = row['Montant']
+                motif = "Port facturé malgré Franco"
+                cible = 0.0
+                detail_tech = f"(Total Facture: {total_fac:.2f}€ > Franco: {seuil_franco}€)"
+                remise_cible_str = "100%"
+                remise_cible_val = 100.0
+
+        # --- LOGIQUE HYBRIDE V3 : LE NET EST JUGE ---
+        else:
+            art = row['Article']
+            remise_actuelle = row['Remise']
+            pu_paye = row['PU_Systeme']
+
+            if art in ref_map and art != 'SANS_REF':
+                m = ref_map[art]
+                if index_asof is not None:
+                    # Sans date lisible, on retombe sur l'historique complet
+                    m = reference_a_date(index_asof, art, row['Date']) or m
+
+# --- AJOUT SPECIAL LOUIS : RECUPERATION DU PRIX ---
+                # Louis : C'est ICI qu'on va chercher l'info dans le "Cerveau" (ref_map).
+                # On lui dit : "Ressors-moi le prix net en Euros qui correspond à la meilleure remise qu'on a jamais eue".
+                # Comme ça, on a le VRAI chiffre (56.75€) et pas un calcul théorique foireux.
+                prix_historique_ref = m['Price_At_Best_Remise']
+
+                # REGLE 1 : SECURITE ABSOLUE (Berner)
+                # Si on paye le prix record ou moins, perte = 0
+                if pu_paye <= m['Best_Price_Net'] + 0.05:
+                    perte = 0
+
+                # REGLE 2 : RESPECT DE LA REMISE (Thermor)
+                elif m['Best_Remise'] > 0 and remise_actuelle >= m['Best_Remise'] - 0.1:
+                    perte = 0
+
+                # REGLE 2.5 : TOLERANCE HAUSSE ANNUELLE
+                # Si même remise (±0.5 point) et brut augmente de max 5%, on tolère
+                elif m['Best_Remise'] > 0 and abs(remise_actuelle - m['Best_Remise']) <= 0.5:
+                    brut_actuel = row['Prix Brut']
+                    brut_ref = m['Best_Brut_Associe']
+                    if brut_ref > 0:
+                        hausse_brut = ((brut_actuel / brut_ref) - 1) * 100
+                        if 0 <= hausse_brut <= 5:
+                            perte = 0
+
+                # REGLE 3 : CALCUL DE LA PERTE
+
+                # REGLE 3 : CALCUL DE LA PERTE
+                else:
+                    # On cherche la meilleure cible possible entre le prix record et la remise théorique
+                    cible_remise = 999999.0
+                    if m['Best_Brut_Associe'] > 0:
+                        cible_remise = row['Prix Brut'] * (1 - m['Best_Remise']/100)
+                        if (row['Prix Brut'] / m['Best_Brut_Associe']) < 0.5:
+                            cible_remise = m['Best_Brut_Associe'] * (1 - m['Best_Remise']/100)
+
+                    cible = min(m['Best_Price_Net'], cible_remise)
+
+                    if pu_paye > cible + 0.05:
+                        perte = (pu_paye - cible) * row['Quantité']
+                        motif = "Hausse de prix"
+                        source_cible = m['Date_Price'] if m['Best_Price_Net'] < cible_remise else m['Date_Remise']
+                        remise_cible_str = f"{m['Best_Remise']:g}%"
+                        remise_cible_val = m['Best_Remise']
+
+        # Seuil 3% : on ignore le bruit (arrondis, écotaxe) - SAUF frais et port
+        if row['Famille'] in ["FRAIS GESTION", "FRAIS PORT"]:
+            filtre_ok = perte > 0.01
+        else:
+            ecart_pourcent = (perte / (cible * row['Quantité'])) * 100 if (cible > 0 and row['Quantité'] > 0) else 0
+            filtre_ok = perte > 0.01 and ecart_pourcent >= 3
+        if filtre_ok:
+            if remise_cible_str == "-" and row['Famille'] not in ["FRAIS GESTION", "FRAIS PORT"]:
+                 remise_cible_str = "?"
+
+            anomalies.append({
+                "Fichier_Source": f_name, # Pour le filtre d'affichage
+                "Fournisseur": fourn,                        
+                "Num Facture": row['Facture'],
+                "Ref_Cmd": row['Ref_Cmd'], 
+                "BL": row['BL'], 
+                "Famille": row['Famille'],
+                "PU_Systeme": row['PU_Systeme'],
+                "Montant": row['Montant'],
+                "Prix Brut": row['Prix Brut'],
+                "Remise": row['Remise'],
+                "Remise Cible": remise_cible_str, # 4. AFFICHAGE (Corrigé)
+                "Remise_Cible_Val": remise_cible_val,
+                "Qte": row['Quantité'],
+                "Ref": row['Article'],
+                "Désignation": row['Désignation'],
+                "Payé (U)": row['PU_Systeme'],
+                "Cible (U)": cible,
+                # Le format "x.xxxx €" est appliqué seulement à l'affichage
+                "Prix Cible": row['Prix Brut'] * (1 - remise_cible_val/100),
+                "Perte": perte,                        
+# --- AJOUT SPECIAL LOUIS : ON MET L'INFO DANS LE TUYAU ---
+                # Louis : On ajoute une colonne invisible "Prix_Ref_Hist" dans les données.
+                # Elle sert juste à transporter le prix de 56.75€ jusqu'à l'affichage du titre plus bas.
+                "Prix_Ref_Hist": prix_historique_ref,
+                "Motif": motif,
+                "Date Facture": row['Date'],
+                "Source Cible": source_cible,     
+                # --- LIGNE DE REPÈRE AVANT ---
+                "Détails Techniques": detail_tech
+
+            })
+    noter_etape("analyse_lignes", time.perf_counter() - debut, lignes=len(df_lignes), anomalies=len(anomalies))
+    return anomalies
+
+def empreinte_dossier(df, registre, a_date=False):
+    """Empreinte de ce dont dépend l'analyse : les lignes du dossier, le registre et le mode de référence"""
+    # Le contenu de chaque ligne compte (remise, prix, article, date...), pas seulement le nombre
+    # de lignes et le total : un rejeu des correctifs peut changer une remise sans bouger le total.
+    with etape("empreinte_dossier", lignes=len(df)):
+        colonnes = [c for c in SCHEMA_LIGNES if c in df.columns]
+        lignes_sig = hashlib.sha1(pd.util.hash_pandas_object(df[colonnes], index=False).to_numpy().tobytes()).hexdigest()
+    registre_sig = hash(tuple(sorted((a, v['type'], str(v['valeur']), v.get('unite')) for a, v in registre.items())))
+    return (len(df), lignes_sig, registre_sig, a_date)
+
+def signature_analyse(empreinte, config_dict, fourn):
+    """Clé du cache d'analyse d'un fournisseur (dossier + registre + ses réglages)"""
+    regles = config_dict.get(fourn, {})
+    return (empreinte, tuple(sorted((k, str(v)) for k, v in regles.items())))
+
+def annee_texte(dates):
+    """Colonne 'Année' du podium et de la synthèse ('Inconnue' si pas de date)"""
+    return dates.dt.year.fillna(0).astype(int).astype(str).replace('0', 'Inconnue')
+
+# --- AGRÉGATS FOURNISSEUR x ANNÉE (matérialisés) ---
+# Louis : La synthèse des achats et le podium des dettes ne relisent plus toutes les lignes à chaque
+# affichage : les totaux Fournisseur x Année sont gardés dans 'agregats_fournisseur_annee'.
+# - Achats : mis à jour à l'import (on ajoute la nouvelle facture, on retire l'ancienne version).
+# - Pertes : la part de chaque article est gardée dans 'pertes_articles'. Après un import, un
+#   arbitrage ou un changement de réglages, on ne recalcule QUE les articles touchés et on reporte
+#   la différence sur les totaux.
+# Les pertes stockées sont celles du mode "Historique complet". Si des fournisseurs manquent (premier
+# passage, rejeu des correctifs), ils sont reconstruits depuis les lignes en tâche de fond.
+# Louis : Ce qui a servi au calcul est stocké avec les totaux (nombre de lignes et accord de chaque
+# article, réglages de chaque fournisseur). Au démarrage on compare à la base, pas à la mémoire de
+# la session : un import ou un accord posé depuis une autre session est vu même dans une session neuve.
+TAILLE_PAGE_EMPREINTES = 1000
+
+def charger_agregats(user_id):
+    with etape("agregats") as diag:
+        res = supabase.table("agregats_fournisseur_annee").select("fournisseur, annee, achats, pertes, regles").eq("user_id", user_id).execute()
+        diag.update(lignes=len(res.data))
+        return {(r['fournisseur'], r['annee']): {"achats": r['achats'] or 0.0, "pertes": r['pertes'] or 0.0, "regles": r.get('regles') or ""}
+                for r in res.data}
+
+def charger_empreintes_articles(user_id, taille_page=TAILLE_PAGE_EMPREINTES):
+    """Empreinte stockée de chaque article : {article: (nombre de lignes, accord appliqué)}"""
+    empreintes, dernier = {}, ""
+    with etape("empreintes_articles") as diag:
+        while True:
+            page = (supabase.table("pertes_articles").select("article, nb_lignes, accord")
+                    .eq("user_id", user_id).gt("article", dernier)
+                    .order("article").limit(taille_page).execute().data)
+            complete = len(page) < taille_page
+            if not complete:
+                # Un article peut être coupé entre deux pages : on le relit en entier à la page suivante
+                dernier_article = page[-1]['article']
+                page = [r for r in page if r['article'] != dernier_article]
+                if not page:
+                    # Page remplie par un seul article : on lit toutes ses lignes d'un coup
+                    page = (supabase.table("pertes_articles").select("article, nb_lignes, accord")
+                            .eq("user_id", user_id).eq("article", dernier_article).execute().data)
+            for r in page:
+                nb, accord = empreintes.get(r['article'], (0, r['accord'] or ""))
+                empreintes[r['article']] = (nb + (r['nb_lignes'] or 0), accord)
+            if complete or not page: break
+            dernier = page[-1]['article']
+        diag.update(lignes=len(empreintes))
+    return empreintes
+
+def signature_accord(accord):
+    """Ce qui, dans une entrée du registre, change les pertes d'un article"""
+    return f"{accord['type']}|{accord['valeur']}|{accord.get('unite')}" if accord else ""
+
+def signature_regles(config_dict, fourn):
+    """Réglages d'un fournisseur (franco, frais de gestion) ; absents = 0 comme dans analyser_lignes"""
+    regles = config_dict.get(fourn, {})
+    return "|".join(f"{float(regles.get(k) or 0.0):g}" for k in ("Franco (Seuil €)", "Max Gestion (€)"))
+
+def vider_agregats(user_id):
+    arreter_reconstruction(user_id)
+    supabase.table("agregats_fournisseur_annee").delete().eq("user_id", user_id).execute()
+    supabase.table("pertes_articles").delete().eq("user_id", user_id).execute()
+
+def reporter_ecarts(user_id, agregats, ecarts, colonne):
+    """Ajoute des écarts {(fournisseur, année): montant} aux totaux, en mémoire et dans Supabase"""
+    lignes = []
+    for (fourn, annee), ecart in ecarts.items():
+        if abs(ecart) < 1e-9: continue
+        total = agregats.setdefault((fourn, annee), {"achats": 0.0, "pertes": 0.0})
+        total[colonne] += ecart
+        lignes.append({"user_id": user_id, "fournisseur": fourn, "annee": annee,
+                       "achats": total["achats"], "pertes": total["pertes"],
+                       "date_maj": datetime.now().strftime("%Y-%m-%d")})
+    if lignes:
+        supabase.table("agregats_fournisseur_annee").upsert(lignes, on_conflict="user_id,fournisseur,annee").execute()
+
+def achats_facture(nom_fichier, data):
+    """Montants d'une facture par (fournisseur, année)"""
+    colonnes = nouvelles_colonnes()
+    normaliser_facture(nom_fichier, data, colonnes)
+    df_fac = construire_df_lignes(colonnes)
+    return {(str(f), a): float(m) for (f, a), m in df_fac.groupby(['Fournisseur', annee_texte(df_fac['Date'])], observed=True)['Montant'].sum().items()}
+
+def maj_achats_import(user_id, nom_fichier, data_json, ancien_json=None):
+    """Louis : Appelé après chaque import, on ajoute la facture (et on retire l'ancienne version)"""
+    try:
+        ecarts = achats_facture(nom_fichier, data_json)
+        if ancien_json:
+            for cle, montant in achats_facture(nom_fichier, ancien_json).items():
+                ecarts[cle] = ecarts.get(cle, 0.0) - montant
+        agregats = charger_agregats(user_id)
+        # Pas encore construits : le premier affichage fera le calcul complet (cette facture comprise)
+        if agregats:
+            reporter_ecarts(user_id, agregats, ecarts, "achats")
+    except:
+        # Table absente ou erreur réseau : l'affichage retombe sur le calcul depuis les lignes
+        pass
+
+def marquer_agregats_a_jour(articles=(), fichiers=()):
+    """Note les articles (ou les factures) dont les pertes sont à recalculer au prochain affichage"""
+    st.session_state.setdefault('agregats_articles', set()).update(str(a) for a in articles)
+    st.session_state.setdefault('agregats_fichiers', set()).update(fichiers)
+
+def articles_facture(nom_fichier, data):
+    colonnes = nouvelles_colonnes()
+    normaliser_facture(nom_fichier, data, colonnes)
+    return set(colonnes['Article'])
+
+def pertes_par_article(df_ano):
+    """Pertes d'une liste d'anomalies regroupées par (article, fournisseur, année)"""
+    if df_ano.empty: return {}
+    annees = annee_texte(pd.to_datetime(df_ano['Date Facture']))
+    return {(str(art), str(f), a): float(p) for (art, f, a), p in
+            df_ano.groupby([df_ano['Ref'].astype(str), df_ano['Fournisseur'].astype(str), annees])['Perte'].sum().items()}
+
+def lignes_pertes_articles(user_id, lignes, pertes, registre):
+    """Lignes de 'pertes_articles' : une par (article, fournisseur, année) présent dans les lignes,
+    même sans perte, avec l'empreinte (nombre de lignes, accord) qui a servi au calcul"""
+    comptes = lignes.groupby([lignes['Article'].astype(str), lignes['Fournisseur'].astype(str), annee_texte(lignes['Date'])]).size()
+    cles = set(comptes.index) | set(pertes)
+    return [{"user_id": user_id, "article": art, "fournisseur": f, "annee": a, "pertes": pertes.get((art, f, a), 0.0),
+             "nb_lignes": int(comptes.get((art, f, a), 0)), "accord": signature_accord(registre.get(art))}
+            for art, f, a in sorted(cles)]
+
+def construire_agregats_fournisseur(user_id, fourn, df, registre, config_dict, facture_totals, references=None):
+    """Calcul depuis les lignes d'UN fournisseur : ses achats + ses pertes, écrits par lots"""
+    with etape("agregats_fournisseur", fournisseur=fourn) as diag:
+        lignes = df[df['Fournisseur'].astype(str) == fourn]
+        regles = signature_regles(config_dict, fourn)
+        agregats = {(fourn, a): {"achats": float(m), "pertes": 0.0, "regles": regles} for a, m in
+                    lignes.groupby(annee_texte(lignes['Date']))['Montant'].sum().items()}
+        # Les références viennent de tout le dossier (un article peut être acheté ailleurs moins cher)
+        ref_map = construire_ref_map(df, registre, user_id, articles=set(lignes['Article']), references=references)
+        pertes = pertes_par_article(pd.DataFrame(analyser_lignes(lignes, ref_map, config_dict, facture_totals)))
+        for (art, f, a), p in pertes.items():
+            agregats.setdefault((f, a), {"achats": 0.0, "pertes": 0.0, "regles": regles})["pertes"] += p
+
+        # Les articles d'abord, les totaux ensuite : une ligne de totaux veut dire "fournisseur terminé".
+        # Si la tâche s'arrête entre les deux, la reprise efface les articles déjà écrits.
+        supabase.table("pertes_articles").delete().eq("user_id", user_id).eq("fournisseur", fourn).execute()
+        articles = lignes_pertes_articles(user_id, lignes, pertes, registre)
+        inserer_par_lots("pertes_articles", articles)
+        date_maj = datetime.now().strftime("%Y-%m-%d")
+        # Upsert : un import pendant la reconstruction a pu créer une ligne de totaux pour ce fournisseur
+        supabase.table("agregats_fournisseur_annee").upsert([
+            {"user_id": user_id, "fournisseur": f, "annee": a, "achats": v["achats"], "pertes": v["pertes"], "regles": v["regles"], "date_maj": date_maj}
+            for (f, a), v in agregats.items()
+        ], on_conflict="user_id,fournisseur,annee").execute()
+        diag.update(lignes=len(lignes), articles=len(articles))
+    return agregats
+
+# --- RECONSTRUCTION EN TÂCHE DE FOND ---
+# Louis : Reconstruire tout le dossier demande l'analyse de chaque ligne : sur un gros compte, le
+# premier affichage (ou celui qui suit un rejeu) attendait ce calcul. Il tourne maintenant dans un
+# fil à part, fournisseur par fournisseur, et reprend là où il s'est arrêté. En attendant, la synthèse
+# vient des lignes et le podium (mode à la demande) des seuls fournisseurs déjà analysés.
+DELAI_ATTENTE_RECONSTRUCTION = 2.0  # secondes : un petit dossier est prêt avant le premier affichage
+
+@st.cache_resource
+def reconstructions():
+    """Tâches de reconstruction partagées entre les relances du script : une au plus par compte"""
+    return {"pool": ThreadPoolExecutor(max_workers=2), "taches": {}, "verrou": threading.Lock()}
+
+def reconstruire_agregats(user_id, fournisseurs, df, registre, config_dict, facture_totals, references, arret):
+    """Tâche de fond : les fournisseurs un par un, jusqu'au bout ou jusqu'à la demande d'arrêt"""
+    with etape("agregats_reconstruction", fournisseurs=len(fournisseurs)) as diag:
+        faits = 0
+        for fourn in fournisseurs:
+            if arret.is_set(): break
+            construire_agregats_fournisseur(user_id, fourn, df, registre, config_dict, facture_totals, references)
+            faits += 1
+        diag.update(faits=faits)
+    return faits
+
+def lancer_reconstruction(user_id, fournisseurs, df, registre, config_dict, facture_totals, references=None):
+    """Lance la reconstruction du compte si aucune ne tourne. Renvoie (tâche, erreur de la précédente)"""
+    etat = reconstructions()
+    with etat["verrou"]:
+        tache, erreur = etat["taches"].get(user_id), None
+        if tache is not None and tache["futur"].done():
+            erreur = tache["futur"].exception()
+            tache = None
+        if tache is None:
+            arret = threading.Event()
+            # Copie des records : le fil complète ceux qu'il recalcule, l'affichage lit les siens
+            futur = etat["pool"].submit(reconstruire_agregats, user_id, list(fournisseurs), df, registre, config_dict,
+                                        facture_totals, dict(references) if references else None, arret)
+            tache = etat["taches"][user_id] = {"futur": futur, "arret": arret}
+    return tache, erreur
+
+def reconstruction_en_cours(user_id):
+    tache = reconstructions()["taches"].get(user_id)
+    return tache is not None and not tache["futur"].done()
+
+def arreter_reconstruction(user_id):
+    """Arrête la reconstruction du compte (avant d'effacer ses totaux) : on attend le fournisseur en cours"""
+    etat = reconstructions()
+    with etat["verrou"]:
+        tache = etat["taches"].pop(user_id, None)
+    if tache is not None:
+        tache["arret"].set()
+        wait([tache["futur"]])
+
+def recalculer_pertes_articles(user_id, agregats, articles, df, registre, config_dict, facture_totals, references=None):
+    """Recalcule les pertes des seuls articles touchés et reporte la différence sur les totaux"""
+    articles = sorted(set(articles))
+    if not articles: return
+    with etape("agregats_articles", articles=len(articles)):
+        lignes = df[df['Article'].isin(articles)]
+        ref_map = construire_ref_map(df, registre, user_id, articles=articles, references=references)
+        nouvelles = pertes_par_article(pd.DataFrame(analyser_lignes(lignes, ref_map, config_dict, facture_totals)))
+
+        anciennes = []
+        for lot in par_lots(articles, TAILLE_LOT_FILTRE):
+            anciennes += supabase.table("pertes_articles").select("article, fournisseur, annee, pertes")\
+                .eq("user_id", user_id).in_("article", lot).execute().data
+        ecarts = {}
+        for r in anciennes:
+            ecarts[(r['fournisseur'], r['annee'])] = ecarts.get((r['fournisseur'], r['annee']), 0.0) - r['pertes']
+        for (art, f, a), p in nouvelles.items():
+            ecarts[(f, a)] = ecarts.get((f, a), 0.0) + p
+
+        for lot in par_lots(articles, TAILLE_LOT_FILTRE):
+            supabase.table("pertes_articles").delete().eq("user_id", user_id).in_("article", lot).execute()
+        inserer_par_lots("pertes_articles", lignes_pertes_articles(user_id, lignes, nouvelles, registre))
+        reporter_ecarts(user_id, agregats, ecarts, "pertes")
+
+def maj_regles_agregats(user_id, agregats, fournisseurs, config_dict):
+    """Note sur les totaux les réglages avec lesquels les frais des fournisseurs ont été recalculés"""
+    for fourn in fournisseurs:
+        regles = signature_regles(config_dict, fourn)
+        supabase.table("agregats_fournisseur_annee").update({"regles": regles}).eq("user_id", user_id).eq("fournisseur", fourn).execute()
+        for (f, a), total in agregats.items():
+            if f == fourn: total["regles"] = regles
+
+def preparer_agregats(user_id, df, demarrage, erreurs, registre, config_dict, facture_totals):
+    """Agrégats à jour pour cet affichage, ou None si la table n'est pas disponible"""
+    if "agregats" in erreurs or "empreintes" in erreurs:
+        return None
+    try:
+        agregats, empreintes = demarrage["agregats"], demarrage["empreintes"]
+        fournisseurs = set(df['Fournisseur'].astype(str))
+        manquants = sorted(fournisseurs - {f for f, a in agregats})
+        if manquants or reconstruction_en_cours(user_id):
+            tache, erreur = lancer_reconstruction(user_id, manquants, df, registre, config_dict, facture_totals, demarrage.get("references"))
+            if erreur is not None:
+                st.warning(f"Reconstruction des totaux interrompue ({erreur}), elle reprend.")
+            with st.spinner("Construction des totaux Fournisseur x Année..."):
+                wait([tache["futur"]], timeout=DELAI_ATTENTE_RECONSTRUCTION)
+            if not tache["futur"].done():
+                # Les repères d'import restent en session : ils serviront une fois les totaux complets
+                st.info(f"⏳ Totaux Fournisseur x Année en construction en tâche de fond "
+                        f"({len(fournisseurs) - len(manquants)}/{len(fournisseurs)} fournisseurs prêts). "
+                        "En attendant, la synthèse et le podium sont calculés depuis les lignes.")
+                return None
+            tache["futur"].result()
+            agregats, empreintes = charger_agregats(user_id), charger_empreintes_articles(user_id)
+
+        articles = st.session_state.pop('agregats_articles', set())
+        fichiers = st.session_state.pop('agregats_fichiers', set())
+
+        # Réglages modifiés (franco, frais de gestion) : seules les lignes de frais du fournisseur bougent
+        regles_stockees = {}
+        for (f, a), total in agregats.items():
+            regles_stockees.setdefault(f, set()).add(total.get("regles", ""))
+        changes = [f for f, regles in regles_stockees.items() if regles != {signature_regles(config_dict, f)}]
+        frais = df['Famille'].isin(["FRAIS GESTION", "FRAIS PORT"]) & df['Fournisseur'].isin(changes)
+        articles |= set(df.loc[frais, 'Article'].astype(str))
+
+        # Articles dont le nombre de lignes (import, regroupement des lignes sans référence) ou l'accord
+        # du registre (partagé : il a pu bouger depuis une autre session) ne colle plus à la base
+        comptes = df['Article'].astype(str).value_counts().to_dict()
+        articles |= {a for a in set(comptes) | set(empreintes)
+                     if empreintes.get(a) != (comptes.get(a, 0), signature_accord(registre.get(a)))}
+
+        if fichiers:
+            articles |= set(df.loc[df['Fichier'].isin(list(fichiers)), 'Article'].astype(str))
+        recalculer_pertes_articles(user_id, agregats, articles, df, registre, config_dict, facture_totals, demarrage.get("references"))
+        maj_regles_agregats(user_id, agregats, changes, config_dict)
+        return agregats
+    except Exception as e:
+        st.warning(f"Totaux matérialisés indisponibles, calcul depuis les lignes : {e}")
+        return None
+
+def stats_depuis_agregats(agregats):
+    """(ventes, pertes) au format des agrégats du podium, sans toucher aux lignes"""
+    stats = pd.DataFrame([(f, a, v["achats"], v["pertes"]) for (f, a), v in agregats.items()],
+                         columns=['Fournisseur', 'Année', 'Montant', 'Perte'])
+    stats_ventes = stats[stats['Montant'].abs() > 0.005][['Fournisseur', 'Année', 'Montant']].reset_index(drop=True)
+    stats_pertes = stats[stats['Perte'] > 0.005][['Fournisseur', 'Année', 'Perte']].reset_index(drop=True)
+    return stats_ventes, stats_pertes
+
+def construire_podium(stats_ventes, stats_pertes, fournisseurs_analyses=None):
+    """Tableau du podium à partir des agrégats Fournisseur x Année (Montant / Perte).
+    fournisseurs_analyses : en mode à la demande, les autres fournisseurs sont marqués 'à analyser'"""
+    # 3. Fusion et Calcul
+    merge_stats = pd.merge(stats_ventes, stats_pertes, on=['Fournisseur', 'Année'], how='left').fillna(0)
+    # Une analyse vide arrive avec des colonnes 'object' : on repasse en float avant la division
+    merge_stats['Perte'] = pd.to_numeric(merge_stats['Perte']).astype(float)
+    montants = pd.to_numeric(merge_stats['Montant']).to_numpy(dtype=float)
+    merge_stats['Taux'] = np.divide(merge_stats['Perte'].to_numpy(dtype=float) * 100, montants, out=np.zeros(len(merge_stats)), where=montants > 0)
+
+    # Cellule "Combo" (Texte pour l'affichage)
+    merge_stats['Affiche'] = [
+        f"{p:.2f} € ({t:.1f}%)" if p > 0.01 else "-"
+        for p, t in zip(merge_stats['Perte'], merge_stats['Taux'])
+    ]
+    if fournisseurs_analyses is not None:
+        merge_stats.loc[~merge_stats['Fournisseur'].isin(fournisseurs_analyses), 'Affiche'] = "⏳ à analyser"
+
+    # 4. Pivot
+    pivot_combo = merge_stats.pivot(index='Fournisseur', columns='Année', values='Affiche').fillna("-")
+    
+    # Ajout de la colonne Total (Floats pour le tri) à la FIN (Droite)
+    total_dette_fourn = stats_pertes.groupby('Fournisseur')['Perte'].sum()
+    pivot_combo["Dette Totale (€)"] = total_dette_fourn
+    
+    # On trie les fournisseurs par dette décroissante
+    pivot_combo = pivot_combo.sort_values("Dette Totale (€)", ascending=False)
+
+    # --- AJOUT LIGNE TOTAL GÉNÉRAL (BAS DE TABLEAU) ---
+    row_total = {"Dette Totale (€)": total_dette_fourn.sum()}
+    
+    # Calcul des totaux par année (pour avoir les bons %)
+    cols_annee = [c for c in pivot_combo.columns if c != "Dette Totale (€)"]
+    for c_annee in cols_annee:
+        # On filtre les stats brutes pour l'année concernée
+        sub = merge_stats[merge_stats['Année'] == c_annee]
+        sum_p = sub['Perte'].sum()
+        sum_m = sub['Montant'].sum()
+        
+        if sum_m > 0:
+            t_glo = (sum_p / sum_m) * 100
+            row_total[c_annee] = f"{sum_p:.2f} € ({t_glo:.1f}%)"
+        elif sum_p > 0:
+             row_total[c_annee] = f"{sum_p:.2f} € (-)"
+        else:
+             row_total[c_annee] = "-"
+
+    # Insertion de la ligne TOTAL en bas
+    df_total_row = pd.DataFrame([row_total], index=["TOTAL GÉNÉRAL"])
+    pivot_combo = pd.concat([pivot_combo, df_total_row])
+
+    # --- FINITION ---
+    # Suppression des noms d'index parasites (Ligne rose)
+    pivot_combo.index.name = None
+    pivot_combo.columns.name = None
+    return pivot_combo, total_dette_fourn
+
+def afficher_podium(pivot_combo, na_rep=None):
+    # --- SUPPRESSION DU DOUBLE AFFICHAGE (st.metric retiré) ---
+    # On affiche directement le tableau HTML sans les colonnes parasites
+    debut = time.perf_counter()
+    html_podium = pivot_combo.style.format({'Dette Totale (€)': "{:.2f} €"}, na_rep=na_rep)\
+    .set_properties(**{
+        'text-align': 'center', 
+        'border': '2px solid black', 
+        'color': 'black', 
+        'font-weight': 'bold',
+        'white-space': 'pre-wrap'
+    })\
+    .set_table_styles([
+        {'selector': 'th', 'props': [('background-color', '#ffcccb'), ('color', 'black'), ('text-align', 'center'), ('border', '2px solid black')]},
+        {'selector': 'table', 'props': [('border-collapse', 'collapse'), ('width', '100%')]}
+    ]).to_html()
+    noter_etape("rendu_podium", time.perf_counter() - debut, lignes=len(pivot_combo), octets=len(html_podium))
+    
+    st.markdown(html_podium, unsafe_allow_html=True)
+
+def afficher_litiges_fournisseur(fourn_nom, df_litiges_fourn, registre):
+    """Un bloc par article en litige : titre, boutons d'arbitrage de Marcel et tableau de preuves"""
+    duree_rendu, octets_rendu = 0.0, 0
+    for article, group in df_litiges_fourn.groupby('Ref'):
+        # On ne récupère plus le prix_ref pour l'affichage
+        date_ref = group['Source Cible'].iloc[0]
+        remise_ref = group['Remise Cible'].iloc[0]
+        remise_ref_val = group['Remise_Cible_Val'].iloc[0]
+        nom_art = group['Désignation'].iloc[0]
+
+# --- CORRECTION FINALE TITRE (SPECIAL LOUIS) ---
+        # Louis : Au lieu de faire un calcul (Prix * %), on lit juste la valeur qu'on a transportée.
+        try:
+            val_hist = group['Prix_Ref_Hist'].iloc[0]
+
+            # Si on a un prix historique (ex: 56.75), on l'affiche.
+            if val_hist > 0:
+                txt_prix_cible = f" 👉 Soit **{val_hist:.4f} €**"
+            else:
+                txt_prix_cible = ""
+        except:
+            txt_prix_cible = ""
+
+        st.markdown(f"**📦 {article}** - {nom_art} | 🎯 Objectif Remise : **{remise_ref}**{txt_prix_cible} (Vu le {date_ref})")
+
+        # --- INTERFACE D'ARBITRAGE MARCEL (CORRECTIF CLÉ UNIQUE) ---
+        c_bt1, c_bt2, c_bt3 = st.columns(3)
+        # On crée une clé unique en combinant Fournisseur + Article
+        # Cela empêche l'erreur "DuplicateKey" si une ref existe chez 2 fournisseurs
+        cle_unique = f"{fourn_nom}_{article}".replace(" ", "_")
+
+        with c_bt1:
+
+# --- REMPLACEMENT AVEC COMMENTAIRES POUR LOUIS ---
+            # 1. On interroge le registre : Est-ce qu'on a déjà signé un truc pour cet article ?
+            accord_existant = registre.get(article)
+
+            if accord_existant and accord_existant['type'] == "CONTRAT": # <--- LIGNE DE REPERE AVANT
+                # Louis : Si un contrat est déjà signé, on affiche sa valeur verrouillée.
+                st.write(f"🔒 Contrat actuel : **{accord_existant['valeur']}{accord_existant['unite']}**")
+
+                col_mod_input, col_mod_btn = st.columns([2, 3])
+                with col_mod_input:
+                    nouvelle_remise_val = st.number_input(
+                        label="Modif Remise",
+                        value=float(accord_existant['valeur']),
+                        step=0.5,
+                        format="%.2f",
+                        key=f"input_mod_{cle_unique}",
+                        label_visibility="collapsed"
+                    )
+                with col_mod_btn:
+                    if st.button(f"💾 Valider {nouvelle_remise_val}%", key=f"btn_mod_{cle_unique}"):
+                        # On met à jour le contrat avec l'unité % par défaut
+                        sauvegarder_accord(article, "CONTRAT", nouvelle_remise_val, "%")
+                        st.rerun()
+            else:
+                # Louis : Si c'est libre, on propose de verrouiller la remise cible calculée par l'IA.
+                if st.button(f"🚀 Verrouiller Contrat ({remise_ref})", key=f"v_{cle_unique}"):
+                    sauvegarder_accord(article, "CONTRAT", float(remise_ref_val), "%")
+                    st.rerun()
+
+        with c_bt2:
+            # Louis : On décide intelligemment si on stocke un % (YESSS) ou un prix Net (EUR).
+            val_promo_sql = float(remise_ref_val)
+            unite_promo_sql = "%"
+
+            if val_promo_sql <= 0:
+                val_promo_sql = val_hist
+                unite_promo_sql = "EUR"
+
+            if st.button("🎁 Marquer comme Promo", key=f"p_{cle_unique}"):
+                sauvegarder_accord(article, "PROMO", val_promo_sql, unite_promo_sql)
+                st.rerun()
+
+        with c_bt3:
+            if st.button("❌ Ignorer Erreur", key=f"e_{cle_unique}"):
+                sauvegarder_accord(article, "ERREUR", 0, "EUR")
+                st.rerun()
+
+        # Louis : On prépare l'affichage du petit tableau avec les colonnes de preuves techniques.
+        sub_df = group[['Num Facture', 'Date Facture', 'Qte', 'Remise', 'Payé (U)', 'Perte', 'Prix Cible']] # <--- LIGNE DE REPERE APRES
+
+        debut = time.perf_counter()
+        html_detail = (
+            sub_df.style.format({
+                'Date Facture': formater_date, 'Qte': "{:g}", 'Remise': formater_remise,
+                'Payé (U)': "{:.4f} €", 'Perte': "{:.2f} €", 'Prix Cible': "{:.4f} €"
+            })
+            .set_properties(**{
+                'text-align': 'center', 'border': '1px solid black', 'color': 'black'
+            })
+            .set_table_styles([
+                {'selector': 'th', 'props': [('background-color', '#e0e0e0'), ('color', 'black'), ('text-align', 'center'), ('border', '1px solid black')]},
+                {'selector': 'table', 'props': [('border-collapse', 'collapse'), ('width', '100%'), ('margin-bottom', '20px')]}
+            ])
+            .hide(axis="index")
+            .to_html()
+        )
+
+        duree_rendu += time.perf_counter() - debut
+        octets_rendu += len(html_detail)
+
+        st.markdown(html_detail, unsafe_allow_html=True)
+    noter_etape("rendu_details", duree_rendu, fournisseur=fourn_nom, lignes=len(df_litiges_fourn), octets=octets_rendu)
 
 def afficher_rapport_sql(fournisseur_nom):
 
@@ -287,7 +2129,193 @@ def afficher_rapport_sql(fournisseur_nom):
                     "Perte": st.column_config.NumberColumn("Perte", format="%.2f €")
                 }
             )
-            
+
+# --- EXPORT (XLSX / CSV / PARQUET) ---
+# Louis : Le fichier est écrit sur disque par paquets de lignes, jamais construit en entier en
+# mémoire : même un dossier de plusieurs centaines de milliers de lignes passe.
+TAILLE_BLOC_EXPORT = 50000
+LIGNES_MAX_FEUILLE_XLSX = 1048576  # limite d'Excel, on continue sur une nouvelle feuille au-delà
+FORMATS_EXPORT = {
+    "XLSX": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": (".csv", "text/csv"),
+    "Parquet": (".parquet", "application/octet-stream"),
+}
+
+# Colonnes du rapport de litiges, arrondies comme à l'écran (les colonnes techniques restent dans l'appli)
+COLONNES_RAPPORT_LITIGES = {
+    'Fournisseur': None, 'Num Facture': None, 'Date Facture': None, 'Ref': None, 'Désignation': None,
+    'Qte': None, 'Remise': 2, 'Remise Cible': None, 'Payé (U)': 4, 'Prix Cible': 4, 'Perte': 2,
+    'Source Cible': None, 'Motif': None, 'Détails Techniques': None,
+}
+PREFIXE_EXPORT = "audit_export_"
+DUREE_VIE_EXPORT = 24 * 3600  # secondes : les fichiers des sessions fermées sont balayés au-delà
+# Louis : Le fichier fini part dans le stockage Supabase (envoyé depuis le disque, par morceaux) et
+# le navigateur le télécharge par un lien signé : il ne repasse jamais en entier dans la mémoire de l'appli.
+SEAU_EXPORTS = "factures_audit"
+DUREE_LIEN_EXPORT = 3600  # secondes
+
+def rapport_litiges(df_ano):
+    """Anomalies brutes -> tableau exporté : colonnes du rapport, montants arrondis"""
+    colonnes = [c for c in COLONNES_RAPPORT_LITIGES if c in df_ano.columns]
+    rapport = df_ano[colonnes].copy()
+    for col in colonnes:
+        decimales = COLONNES_RAPPORT_LITIGES[col]
+        if decimales is not None:
+            rapport[col] = pd.to_numeric(rapport[col], errors='coerce').round(decimales)
+    return rapport
+
+def chemin_export(suffixe):
+    """Chemin fixe par session : un nouvel export écrase le précédent au lieu d'empiler des fichiers"""
+    id_export = st.session_state.setdefault('export_id', hashlib.sha1(os.urandom(16)).hexdigest()[:16])
+    dossier = tempfile.gettempdir()
+    # Les exports des sessions fermées (jamais relancés) sont effacés au passage
+    limite = time.time() - DUREE_VIE_EXPORT
+    try:
+        for nom in os.listdir(dossier):
+            chemin = os.path.join(dossier, nom)
+            if nom.startswith(PREFIXE_EXPORT) and os.path.getmtime(chemin) < limite:
+                os.remove(chemin)
+    except OSError:
+        pass
+    return os.path.join(dossier, f"{PREFIXE_EXPORT}{id_export}{suffixe}")
+
+def blocs_export(df, taille=TAILLE_BLOC_EXPORT):
+    for debut in range(0, len(df), taille):
+        yield df.iloc[debut:debut + taille]
+
+def ecrire_xlsx(df, chemin, nom_feuille, taille_bloc=TAILLE_BLOC_EXPORT):
+    import xlsxwriter
+    # constant_memory : chaque ligne part sur le disque dès qu'elle est écrite
+    classeur = xlsxwriter.Workbook(chemin, {"constant_memory": True, "default_date_format": "dd/mm/yyyy"})
+    colonnes = [str(c) for c in df.columns]
+    feuille, num_feuille, ligne = None, 0, LIGNES_MAX_FEUILLE_XLSX
+    for bloc in blocs_export(df, taille_bloc):
+        # Cases vides (NaN, NaT) -> None, que xlsxwriter laisse en blanc
+        bloc = bloc.astype(object).where(bloc.notna(), None)
+        for valeurs in bloc.itertuples(index=False, name=None):
+            if ligne >= LIGNES_MAX_FEUILLE_XLSX:
+                num_feuille += 1
+                feuille = classeur.add_worksheet(nom_feuille if num_feuille == 1 else f"{nom_feuille} ({num_feuille})")
+                feuille.write_row(0, 0, colonnes)
+                ligne = 1
+            feuille.write_row(ligne, 0, valeurs)
+            ligne += 1
+    if feuille is None:
+        classeur.add_worksheet(nom_feuille).write_row(0, 0, colonnes)
+    classeur.close()
+
+def ecrire_csv(df, chemin, taille_bloc=TAILLE_BLOC_EXPORT):
+    # Séparateur ";" et virgule décimale : s'ouvre directement dans un Excel français
+    with open(chemin, "w", encoding="utf-8-sig", newline="") as f:
+        premier = True
+        for bloc in blocs_export(df, taille_bloc):
+            bloc.to_csv(f, index=False, header=premier, sep=";", decimal=",")
+            premier = False
+        if premier:
+            df.head(0).to_csv(f, index=False, sep=";")
+
+def ecrire_parquet(df, chemin, taille_bloc=TAILLE_BLOC_EXPORT):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # Schéma fixé sur tout le tableau : un bloc où une colonne est vide ne change pas son type
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(chemin, schema) as writer:
+        for bloc in blocs_export(df, taille_bloc):
+            writer.write_table(pa.Table.from_pandas(bloc, schema=schema, preserve_index=False))
+
+def exporter_tableau(df, format_export, nom_feuille="Export"):
+    """Écrit df dans un fichier temporaire au format demandé et renvoie son chemin"""
+    suffixe, _ = FORMATS_EXPORT[format_export]
+    chemin = chemin_export(suffixe)
+    with etape("export", format=format_export, lignes=len(df)):
+        if format_export == "XLSX": ecrire_xlsx(df, chemin, nom_feuille)
+        elif format_export == "CSV": ecrire_csv(df, chemin)
+        else: ecrire_parquet(df, chemin)
+    return chemin
+
+def publier_export(user_id, chemin, nom, mime):
+    """Envoie l'export dans le stockage Supabase et renvoie (chemin dans le seau, lien signé)"""
+    seau = supabase.storage.from_(SEAU_EXPORTS)
+    # Un seul export par session dans le seau aussi : le suivant écrase celui-ci
+    chemin_seau = f"exports/{user_id}/{os.path.basename(chemin)}"
+    with open(chemin, "rb") as f:
+        seau.upload(chemin_seau, f, {"upsert": "true", "content-type": mime})
+    try:
+        return chemin_seau, lien_export(chemin_seau, nom)
+    except Exception:
+        seau.remove([chemin_seau])
+        raise
+
+def lien_export(chemin_seau, nom):
+    lien = supabase.storage.from_(SEAU_EXPORTS).create_signed_url(chemin_seau, DUREE_LIEN_EXPORT, {"download": nom})
+    url = lien.get("signedURL") or lien.get("signedUrl")
+    if not url:
+        raise ValueError(f"Lien signé absent : {lien}")
+    return url
+
+def effacer_export(export):
+    """Efface le fichier d'export précédent (disque et stockage)"""
+    if os.path.exists(export['chemin']):
+        os.remove(export['chemin'])
+    if export.get('chemin_seau'):
+        try:
+            supabase.storage.from_(SEAU_EXPORTS).remove([export['chemin_seau']])
+        except:
+            pass
+
+def lire_fichier(chemin):
+    """Pour st.download_button : le fichier n'est lu qu'au clic, pas à chaque affichage"""
+    def lire():
+        with open(chemin, "rb") as f:
+            return f.read()
+    return lire
+
+def afficher_export(user_id, df_lignes, df_litiges, note_litiges=None):
+    """Bloc de téléchargement : rapport des litiges ou toutes les lignes normalisées"""
+    with st.expander("📥 Exporter (litiges / lignes)", expanded=False):
+        col_contenu, col_format = st.columns(2)
+        with col_contenu:
+            contenu = st.radio("Contenu", ["Rapport des litiges", "Toutes les lignes"], horizontal=True, key="export_contenu")
+        with col_format:
+            format_export = st.radio("Format", list(FORMATS_EXPORT), horizontal=True, key="export_format")
+        if contenu == "Rapport des litiges" and note_litiges:
+            st.caption(note_litiges)
+
+        if st.button("🛠️ Préparer le fichier"):
+            # Un seul fichier d'export par session : on efface le précédent (il peut avoir un autre format)
+            ancien = st.session_state.pop('export', None)
+            if ancien:
+                effacer_export(ancien)
+            tableau, nom = (rapport_litiges(df_litiges), "Litiges") if contenu == "Rapport des litiges" else (df_lignes, "Lignes")
+            try:
+                with st.spinner(f"Écriture de {len(tableau)} lignes..."):
+                    chemin = exporter_tableau(tableau, format_export, nom)
+                suffixe, mime = FORMATS_EXPORT[format_export]
+                export = {'chemin': chemin, 'mime': mime, 'nom': f"audit_{nom.lower()}_{datetime.now():%Y%m%d_%H%M}{suffixe}"}
+                try:
+                    export['chemin_seau'], export['url'] = publier_export(user_id, chemin, export['nom'], mime)
+                    export['expire'] = time.time() + DUREE_LIEN_EXPORT
+                    os.remove(chemin)
+                except Exception as e:
+                    # Stockage indisponible : on sert le fichier depuis le disque (voir plus bas)
+                    logger_diag.warning(f"Export non publié dans le stockage : {e}")
+                st.session_state['export'] = export
+            except Exception as e:
+                st.error(f"Erreur export : {e}")
+
+        export = st.session_state.get('export')
+        if export and export.get('url'):
+            if time.time() > export['expire'] - 60:
+                # Lien expiré (ou presque) : on en signe un nouveau, le fichier est toujours dans le seau
+                try:
+                    export['url'], export['expire'] = lien_export(export['chemin_seau'], export['nom']), time.time() + DUREE_LIEN_EXPORT
+                except Exception as e:
+                    st.error(f"Erreur export : {e}")
+            st.link_button(f"⬇️ Télécharger {export['nom']}", export['url'])
+        elif export and os.path.exists(export['chemin']):
+            # Secours sans stockage : Streamlit lit tout le fichier en mémoire au moment du clic
+            st.download_button(f"⬇️ Télécharger {export['nom']}", lire_fichier(export['chemin']), file_name=export['nom'], mime=export['mime'])
+
 # ==============================================================================
 # 3. INTERFACE PRINCIPALE
 # ==============================================================================
@@ -300,123 +2328,45 @@ if session:
     user_id = session["user"]["id"]
     st.title("🏗️ Audit V21 - Logique Universelle")
 
+    # Louis : Panneau de diagnostic en option (chronos de chaque étape), caché par défaut
+    with st.sidebar:
+        diag_actif = st.toggle("🩺 Diagnostics", value=False, key="diag_actif")
+        DIAGNOSTICS_ACTIFS = diag_actif
+        EXPORT_LOGS_DIAG = diag_actif and st.checkbox("Exporter en logs JSON", value=False, key="diag_logs")
+
+    # Louis : Factures, réglages, registre et records partent en même temps vers Supabase
+    demarrage, erreurs_demarrage = charger_donnees_demarrage(user_id, avec_configs='config_df' not in st.session_state,
+                                                             dossier=st.session_state.get('dossier'))
+
     try:
         # Louis : On interroge Supabase pour récupérer tes factures
-        res_db = supabase.table("audit_results").select("*").eq("user_id", user_id).execute()
-        # Louis : On prépare les données pour l'affichage (ne pas supprimer ces deux lignes !)
-        memoire_full = {r['file_name']: r for r in res_db.data}
-        memoire = {r['file_name']: r['analyse_complete'] for r in res_db.data}
+        if "dossier" in erreurs_demarrage:
+            raise erreurs_demarrage["dossier"]
+        # Louis : Le dossier arrive déjà normalisé (page par page). On ne garde que les noms de
+        # fichiers : l'ancienne analyse n'est relue qu'au moment d'écraser une facture.
+        st.session_state['dossier'] = demarrage["dossier"]
+        factures = demarrage["dossier"]["factures"]
+        noms_factures = set(factures["noms"])
+        df = factures["lignes"]
+        fournisseurs_detectes = factures["fournisseurs"]
     except Exception as e: 
         # Louis : Si ton badge de sécurité a expiré (erreur JWT), on vide tout et on te reconnecte
         if "JWT expired" in str(e):
             st.session_state.clear()
             st.rerun()
         st.error(f"Erreur chargement base : {e}")
-        memoire = {}
-        memoire_full = {}
+        noms_factures = set()
+        df = construire_df_lignes(nouvelles_colonnes())
+        fournisseurs_detectes = set()
 
-    all_rows = []
-    fournisseurs_detectes = set()
+    # Les lignes sans référence rejoignent l'article des désignations équivalentes
+    df = regrouper_articles_sans_ref(df, user_id, demarrage.get("regroupement"))
 
-    for f_name, json_str in memoire.items():
-        try:
-            data = json.loads(json_str)
-            fourn = data.get('fournisseur', 'INCONNU').upper()
-            date_fac = data.get('date', 'Inconnue')
-            num_fac = data.get('num_facture', '-')
-            ref_cmd = data.get('ref_commande', '-')
-            
-            iban_f = data.get('iban', '-')
-            tva_f = data.get('tva_fournisseur', '-')
-            adr_f = data.get('adresse_fournisseur', '-')
-
-            if "YESSS" in fourn: fourn = "YESSS ELECTRIQUE"
-            elif "AUSTRAL" in fourn: fourn = "AUSTRAL HORIZON"
-            elif "PARTEDIS" in fourn: fourn = "PARTEDIS"
-            fournisseurs_detectes.add(fourn)
-            
-            for l in data.get('lignes', []):
-                qte_ia = clean_float(l.get('quantite', 1))
-                if qte_ia == 0: qte_ia = 1
-                
-                montant = clean_float(l.get('montant', 0))
-                
-                # --- NOUVELLE LOGIQUE UNIVERSELLE DE CALCUL ---
-                base_fac = float(l.get('base_facturation', 1))
-                if base_fac <= 0: base_fac = 1
-
-                # Calcul du Net Réel
-                p_net_lu = clean_float(l.get('prix_net_unitaire', l.get('prix_net', 0)))
-                p_net = p_net_lu / base_fac
-                
-                # Sécurité Rétro-compatibilité (si l'IA a mis le slash dans l'ancien champ)
-                raw_net = str(l.get('prix_net', '0'))
-                if '/' in raw_net and base_fac == 1:
-                    try: p_net = clean_float(raw_net.split('/')[0]) / float(raw_net.split('/')[1])
-                    except: pass
-
-                # Calcul du Brut Réel
-                p_brut_lu = clean_float(l.get('prix_brut_unitaire', l.get('prix_brut', 0)))
-                p_brut = p_brut_lu / base_fac
-
-                if '/' in str(l.get('prix_brut', '')) and base_fac == 1:
-                    try: p_brut = clean_float(str(l.get('prix_brut')).split('/')[0]) / float(str(l.get('prix_brut')).split('/')[1])
-                    except: pass
-                
-                # On stocke le brut "propre" pour l'affichage
-                raw_brut = f"{p_brut:.4f}"
-                # ----------------------------------------------
-                
-                raw_remise = str(l.get('remise', '0'))
-                val_remise = calculer_remise_combine(raw_remise)
-                remise = f"{val_remise:g}%" if val_remise > 0 else "-"
-                num_bl = l.get('num_bl_ligne', '-')
-                qte_finale = qte_ia
-                if montant > 0 and p_net > 0:
-                    ratio = montant / p_net
-                    if abs(ratio - round(ratio)) < 0.05: 
-                         qte_math = round(ratio)
-                         if qte_math != qte_ia and qte_math > 0:
-                             qte_finale = qte_math
-
-                if montant > 0 and qte_finale > 0:
-                    pu_systeme = montant / qte_finale
-                elif p_net > 0:
-                    pu_systeme = p_net 
-                else:
-                    pu_systeme = 0
-
-                article = l.get('article', 'SANS_REF')
-                if not article or article == "None" or article == "SANS_REF":
-                    article = l.get('designation', 'SANS_NOM')[:20]
-
-                famille = detecter_famille(l.get('designation', ''), article)
-
-                all_rows.append({
-                    "Fichier": f_name,
-                    "Facture": num_fac,
-                    "Date": date_fac,
-                    "Ref_Cmd": ref_cmd,
-                    "BL": num_bl,
-                    "Fournisseur": fourn,
-                    "IBAN": iban_f,
-                    "TVA_Intra": tva_f,
-                    "Adresse": adr_f,
-                    "Quantité": qte_finale,
-                    "Article": article,
-                    "Désignation": l.get('designation', ''),
-                    "Prix Brut": raw_brut,
-                    "Remise": remise,
-                    "Prix Net": p_net, 
-                    "Montant": montant,
-                    "PU_Systeme": pu_systeme,
-                    "Famille": famille
-                })
-        except: continue
-
-    df = pd.DataFrame(all_rows)
-
-    tab_config, tab_analyse, tab_import, tab_brut = st.tabs(["⚙️ CONFIGURATION", "📊 ANALYSE & PREUVES", "📥 IMPORT", "🔍 SCAN TOTAL"])
+    noms_onglets = ["⚙️ CONFIGURATION", "📊 ANALYSE & PREUVES", "📥 IMPORT", "🔍 SCAN TOTAL"]
+    if diag_actif:
+        noms_onglets.append("🩺 DIAGNOSTICS")
+    onglets = st.tabs(noms_onglets)
+    tab_config, tab_analyse, tab_import, tab_brut = onglets[:4]
 
     with tab_config:
         st.header("🛠️ Réglages Fournisseurs")
@@ -424,9 +2374,12 @@ if session:
         # 1. Chargement initial depuis Supabase
         if 'config_df' not in st.session_state:
             try:
-                res_cfg = supabase.table("user_configs").select("*").eq("user_id", user_id).execute()
-                if res_cfg.data:
-                    st.session_state['config_df'] = pd.DataFrame(res_cfg.data).rename(
+                # Déjà lu au démarrage, en même temps que les factures
+                if "configs" in erreurs_demarrage:
+                    raise erreurs_demarrage["configs"]
+                configs_db = demarrage["configs"]
+                if configs_db:
+                    st.session_state['config_df'] = pd.DataFrame(configs_db).rename(
                         columns={'franco': 'Franco (Seuil €)', 'max_gestion': 'Max Gestion (€)', 'fournisseur': 'Fournisseur'}
                     )[['Fournisseur', 'Franco (Seuil €)', 'Max Gestion (€)']]
                 else:
@@ -470,14 +2423,22 @@ if session:
         else:
             # --- DEBUT AJOUT : TABLEAU HTML (FORCE BRUTE POUR LE STYLE) ---
             st.subheader("📈 Synthèse des Achats par Année")
-            
-            # 1. Préparation
-            df_calc = df.copy()
-            df_calc['Date_Ref'] = pd.to_datetime(df_calc['Date'], errors='coerce')
-            df_calc['Année'] = df_calc['Date_Ref'].dt.year.fillna(0).astype(int).astype(str).replace('0', 'Inconnue')
 
-            # 2. Pivot
-            df_pivot = df_calc.groupby(['Fournisseur', 'Année'])['Montant'].sum().reset_index()
+            registre = demarrage.get("registre", {})
+            facture_totals = df.groupby('Fichier', observed=True)['Montant'].sum().to_dict()
+            # Totaux Fournisseur x Année matérialisés (None : on recalcule depuis les lignes)
+            agregats = preparer_agregats(user_id, df, demarrage, erreurs_demarrage, registre, config_dict, facture_totals)
+
+            if agregats is not None:
+                df_pivot = stats_depuis_agregats(agregats)[0]
+            else:
+                # 1. Préparation (la date est déjà parsée dans le schéma des lignes)
+                df_calc = df[['Fournisseur', 'Montant']].copy()
+                df_calc['Année'] = annee_texte(df['Date'])
+
+                # 2. Pivot
+                df_pivot = df_calc.groupby(['Fournisseur', 'Année'], observed=True)['Montant'].sum().reset_index()
+                df_pivot['Fournisseur'] = df_pivot['Fournisseur'].astype(str)
             
             if not df_pivot.empty:
                 matrice_achats = df_pivot.pivot(index='Fournisseur', columns='Année', values='Montant').fillna(0)
@@ -487,6 +2448,7 @@ if session:
                 matrice_achats.index.name = None
                 matrice_achats.columns.name = None
                 
+                debut_rendu = time.perf_counter()
                 html_code = matrice_achats.style.format("{:.2f} €")\
                     .set_properties(**{
                         'text-align': 'center', 
@@ -509,436 +2471,166 @@ if session:
                             ('width', '100%')
                         ]}
                     ]).to_html()
+                noter_etape("rendu_synthese", time.perf_counter() - debut_rendu, lignes=len(matrice_achats), octets=len(html_code))
                 
                 # Injection du HTML
                 st.markdown(html_code, unsafe_allow_html=True)
                 st.divider()
                 # --- FIN AJOUT ---
 
-            df_produits = df[~df['Famille'].isin(['FRAIS PORT', 'FRAIS GESTION', 'TAXE'])]
-            ref_map = {}
-            registre = charger_registre()
-            
-            if not df_produits.empty:
-                df_clean = df_produits[df_produits['Article'] != 'SANS_REF'].copy()
-                df_clean['Remise_Val'] = df_clean['Remise'].apply(lambda x: clean_float(str(x).replace('%', '')))
-                
-                for art, group in df_clean.groupby('Article'):
-                    # On vérifie si Marcel a déjà pris une décision sur cet article
-                    accord = registre.get(art)
-                    
-                    # Logique de sélection des records
-                    valid_remises = group[group['Remise_Val'] > 0].sort_values('Remise_Val', ascending=False)
-                    valid_prices = group[group['PU_Systeme'] > 0.01].sort_values('PU_Systeme', ascending=True) # <--- LIGNE DE REPERE AVANT
-
-                    # --- CORRECTION PROMO ---
-                    # Louis : C'est ici qu'on résout le bug. Si tu marques un article comme "PROMO",
-                    # on identifie le prix de cette promo (le moins cher de la liste).
-                    # Ensuite, on dit au programme d'ignorer TOUTES les factures qui ont ce prix promo.
-                    # De cette façon, il va chercher le prix suivant (ton prix normal à 129 €) pour calculer la perte.
-                    idx_r, idx_p = 0, 0
-                    if accord and accord['type'] == "PROMO":
-                        if not valid_prices.empty:
-                            prix_promo = valid_prices.iloc[0]['PU_Systeme']
-                            # On filtre : on ne garde que les factures dont le prix est différent de la promo
-                            valid_prices = valid_prices[abs(valid_prices['PU_Systeme'] - prix_promo) > 0.10]
-                            valid_remises = valid_remises[abs(valid_remises['PU_Systeme'] - prix_promo) > 0.10]
-                    # -------------------------
-
-                    best_r_row = valid_remises.iloc[idx_r] if not valid_remises.empty else group.iloc[0] # <--- LIGNE DE REPERE APRES
-                    best_p_row = valid_prices.iloc[idx_p] if not valid_prices.empty else group.iloc[0]
-
-                    # Si c'est un CONTRAT forcé, on écrase la remise par celle du registre
-                    remise_finale = accord['valeur'] if (accord and accord['type'] == "CONTRAT") else best_r_row['Remise_Val']
-
-                    # --- CORRECTION LOGIQUE "PRIX NET" vs "PRIX BRUT" ---
-                    # Si le meilleur prix est un "Net" (0 remise) et qu'il est meilleur que le prix remisé habituel
-                    # Alors on recalcule la remise théorique en utilisant le Brut du prix remisé.
-                    p_net_record = best_p_row['PU_Systeme']
-                    p_net_standard = best_r_row['PU_Systeme']
-                    
-                    if p_net_record < (p_net_standard - 0.05) and best_p_row['Remise_Val'] == 0:
-                        brut_ref = clean_float(best_r_row['Prix Brut'])
-                        if brut_ref > 0:
-                            # Calcul inverse : Quelle remise donne ce prix net sur ce brut ?
-                            taux_virtuel = (1 - (p_net_record / brut_ref)) * 100
-                            remise_finale = round(taux_virtuel, 2)
-                    # ----------------------------------------------------
-
-                    ref_map[art] = {
-                        'Best_Remise': remise_finale,
-                        'Best_Brut_Associe': clean_float(best_r_row['Prix Brut']),
-                        'Best_Price_Net': best_p_row['PU_Systeme'],
-                        'Price_At_Best_Remise': best_r_row['PU_Systeme'],
-                        'Date_Remise': accord['date'] if (accord and accord['type'] == "CONTRAT") else best_r_row['Date'],
-                        'Date_Price': best_p_row['Date']
-                    }
-
-                    # --- MODIFICATION : ON COMMENTE TOUT POUR ARRETER LE LAG ---
-                    # if remise_finale > 0:
-                    #     try:
-                    #         supabase.table("market_rates").upsert({
-                    #             "user_id": user_id,
-                    #             "article": art,
-                    #             "fournisseur": best_r_row['Fournisseur'],
-                    #             "remise": remise_finale,
-                    #             "date_ref": best_r_row['Date']
-                    #         }).execute()
-                    #     except: pass
-                    # -----------------------------------------------------------
-            
-            facture_totals = df.groupby('Fichier')['Montant'].sum().to_dict()
-            anomalies = []
-
-            for idx, row in df.iterrows():
-                f_name = row['Fichier']
-                num_facture = row['Facture']
-                fourn = row['Fournisseur']
-                
-                rules = config_dict.get(fourn, {"Franco (Seuil €)": 0.0, "Max Gestion (€)": 0.0})
-                seuil_franco = rules.get("Franco (Seuil €)", 0.0)
-                max_gestion = rules.get("Max Gestion (€)", 0.0)
-                
-                perte = 0
-                motif = ""
-                cible = 0.0                 
-                source_cible = "-"
-                # Louis : On crée une variable vide au début de chaque ligne.
-                # Elle servira à stocker le "Vrai Prix Historique" si on en trouve un.
-                prix_historique_ref = 0.
-                detail_tech = ""
-                # 2. INITIALISATION (Corrigée : Placée ICI, avant les IF)
-                remise_cible_str = "-" 
-                
-                # --- LOGIQUE 1 : FRAIS (Gestion & Port) ---
-                if row['Famille'] == "FRAIS GESTION":
-                    if row['Montant'] > max_gestion:
-                        perte = row['Montant'] - max_gestion
-                        cible = max_gestion
-                        motif = "Frais Facturation Abusifs"
-                        detail_tech = f"(Max autorisé: {max_gestion}€)"
-                
-                elif row['Famille'] == "FRAIS PORT":
-                    total_fac = facture_totals.get(f_name, 0)
-                    if total_fac >= seuil_franco:
-                        perte = row['Montant']
-                        motif = "Port facturé malgré Franco"
-                        cible = 0.0
-                        detail_tech = f"(Total Facture: {total_fac:.2f}€ > Franco: {seuil_franco}€)"
-                        remise_cible_str = "100%"
-
-                # --- LOGIQUE HYBRIDE V3 : LE NET EST JUGE ---
-                else:
-                    art = row['Article']
-                    remise_actuelle = clean_float(str(row['Remise']).replace('%', ''))
-                    pu_paye = row['PU_Systeme']
-                    
-                    if art in ref_map and art != 'SANS_REF':
-                        m = ref_map[art]
+            # 1. Dénominateur du podium : Ventes (agrégat léger, commun aux deux modes)
+            if agregats is not None:
+                stats_ventes, stats_pertes_agregees = stats_depuis_agregats(agregats)
+            else:
+                df_ventes = df[['Fournisseur', 'Montant']].copy()
+                df_ventes['Année'] = annee_texte(df['Date'])
+                stats_ventes = df_ventes.groupby(['Fournisseur', 'Année'], observed=True)['Montant'].sum().reset_index()
+                stats_ventes['Fournisseur'] = stats_ventes['Fournisseur'].astype(str)
+
+            # --- MODE À LA DEMANDE ---
+            # Louis : Sur les gros dossiers multi-fournisseurs, on ne calcule plus toutes les anomalies
+            # d'un coup. Le podium sort des agrégats, et l'analyse ligne à ligne ne tourne que pour le
+            # fournisseur (ou la facture) qu'on inspecte. Le résultat est gardé en cache par fournisseur.
+            mode_demande = st.toggle(
+                "⚡ Analyse à la demande (fournisseur par fournisseur)",
+                value=len(df) > SEUIL_LIGNES_MODE_DEMANDE,
+                help="Recommandé pour les gros dossiers : seul le fournisseur inspecté est analysé en détail."
+            )
+            mode_reference = st.radio(
+                "📅 Prix de référence",
+                ["Historique complet", "À la date de la facture"],
+                horizontal=True,
+                help="Historique complet : meilleur prix / remise jamais obtenu, même sur des factures plus récentes. "
+                     "À la date de la facture : seulement ce qui était connu au jour de la facture jugée."
+            )
+            a_date = mode_reference == "À la date de la facture"
+
+            if not mode_demande:
+                ref_map = construire_ref_map(df, registre, user_id, references=demarrage.get("references"))
+                index_asof = construire_index_asof(df, registre) if a_date else None
+                anomalies = analyser_lignes(df, ref_map, config_dict, facture_totals, index_asof)
+                df_litiges_export = pd.DataFrame(anomalies)
+                note_export = None
+
+                if anomalies:
+                    df_ano = pd.DataFrame(anomalies)
+                    # --- BLOC PODIUM : MONTANT + % ---
+                    st.subheader("🏆 Podium des Dettes & Évolution")
+
+                    # 2. Numérateur : Pertes (les totaux matérialisés sont en "Historique complet")
+                    if agregats is not None and not a_date:
+                        stats_pertes = stats_pertes_agregees
+                    else:
+                        df_ano['Année'] = annee_texte(df_ano['Date Facture'])
+                        stats_pertes = df_ano.groupby(['Fournisseur', 'Année'])['Perte'].sum().reset_index()
+
+                    pivot_combo, total_dette_fourn = construire_podium(stats_ventes, stats_pertes)
+                    afficher_podium(pivot_combo)
+
+                    st.divider()
+                    # --- FILTRE AFFICHAGE (POUR LE FREROT) ---
+                    # Explication : On récupère la liste de toutes les factures qui ont des soucis
+                    # et on propose à l'utilisateur de choisir s'il veut tout voir ou juste une facture.
+                    liste_fichiers_avec_erreurs = sorted(df_ano['Fichier_Source'].unique().tolist(), reverse=True)
+
+                    choix_affichage = st.selectbox(
+                        "👁️ Filtrer les détails ci-dessous par facture :",
+                        ["TOUT LE DOSSIER (GLOBAL)"] + liste_fichiers_avec_erreurs
+                    )
+                    # -----------------------------------------
+                    st.subheader("🕵️ Détails par Fournisseur")
+
+                    # 6. Détails
+                    for fourn_nom in pivot_combo.index:
+                        # [CORRECTION] : On ignore la ligne de total pour les dossiers détails
+                        if fourn_nom == "TOTAL GÉNÉRAL": continue
+
+                        fourn_dette = total_dette_fourn.get(fourn_nom, 0)
+
+                        with st.expander(f"📂 {fourn_nom} - Dette : {fourn_dette:.2f} €", expanded=False):
+                            df_litiges_fourn = df_ano[df_ano['Fournisseur'] == fourn_nom]
+                            # --- FILTRE ACTIF (POUR LE FREROT) ---
+                            # Si l'utilisateur a choisi une facture précise dans le menu du dessus,
+                            # on ne garde QUE les lignes de cette facture.
+                            if choix_affichage != "TOUT LE DOSSIER (GLOBAL)":
+                                df_litiges_fourn = df_litiges_fourn[df_litiges_fourn['Fichier_Source'] == choix_affichage]
+
+                            # Si après le filtre le tableau est vide (ex: ce fournisseur n'a pas d'erreur sur cette facture),
+                            # on affiche un petit message et on passe au suivant.
+                            if df_litiges_fourn.empty:
+                                st.info(f"✅ Aucune erreur sur la facture {choix_affichage} pour ce fournisseur.")
+                                continue
+                            # -------------------------------------
+                            afficher_litiges_fournisseur(fourn_nom, df_litiges_fourn, registre)
 
-# --- AJOUT SPECIAL LOUIS : RECUPERATION DU PRIX ---
-                        # Louis : C'est ICI qu'on va chercher l'info dans le "Cerveau" (ref_map).
-                        # On lui dit : "Ressors-moi le prix net en Euros qui correspond à la meilleure remise qu'on a jamais eue".
-                        # Comme ça, on a le VRAI chiffre (56.75€) et pas un calcul théorique foireux.
-                        prix_historique_ref = m['Price_At_Best_Remise']
-                        
-                        # REGLE 1 : SECURITE ABSOLUE (Berner)
-                        # Si on paye le prix record ou moins, perte = 0
-                        if pu_paye <= m['Best_Price_Net'] + 0.05:
-                            perte = 0
-                        
-                        # REGLE 2 : RESPECT DE LA REMISE (Thermor)
-                        elif m['Best_Remise'] > 0 and remise_actuelle >= m['Best_Remise'] - 0.1:
-                            perte = 0
-                        
-                        # REGLE 2.5 : TOLERANCE HAUSSE ANNUELLE
-                        # Si même remise (±0.5 point) et brut augmente de max 5%, on tolère
-                        elif m['Best_Remise'] > 0 and abs(remise_actuelle - m['Best_Remise']) <= 0.5:
-                            brut_actuel = clean_float(row['Prix Brut'])
-                            brut_ref = m['Best_Brut_Associe']
-                            if brut_ref > 0:
-                                hausse_brut = ((brut_actuel / brut_ref) - 1) * 100
-                                if 0 <= hausse_brut <= 5:
-                                    perte = 0
-                        
-                        # REGLE 3 : CALCUL DE LA PERTE
-                            
-                        # REGLE 3 : CALCUL DE LA PERTE
-                        else:
-                            # On cherche la meilleure cible possible entre le prix record et la remise théorique
-                            cible_remise = 999999.0
-                            if m['Best_Brut_Associe'] > 0:
-                                cible_remise = clean_float(row['Prix Brut']) * (1 - m['Best_Remise']/100)
-                                if (clean_float(row['Prix Brut']) / m['Best_Brut_Associe']) < 0.5:
-                                    cible_remise = m['Best_Brut_Associe'] * (1 - m['Best_Remise']/100)
-                            
-                            cible = min(m['Best_Price_Net'], cible_remise)
-                            
-                            if pu_paye > cible + 0.05:
-                                perte = (pu_paye - cible) * row['Quantité']
-                                motif = "Hausse de prix"
-                                source_cible = m['Date_Price'] if m['Best_Price_Net'] < cible_remise else m['Date_Remise']
-                                remise_cible_str = f"{m['Best_Remise']:g}%"
-
-                # Seuil 3% : on ignore le bruit (arrondis, écotaxe) - SAUF frais et port
-                if row['Famille'] in ["FRAIS GESTION", "FRAIS PORT"]:
-                    filtre_ok = perte > 0.01
-                else:
-                    ecart_pourcent = (perte / (cible * row['Quantité'])) * 100 if (cible > 0 and row['Quantité'] > 0) else 0
-                    filtre_ok = perte > 0.01 and ecart_pourcent >= 3
-                if filtre_ok:
-                    # --- Nettoyage Affichage Prix Brut ---
-                    prix_brut_affiche = row['Prix Brut']
-                    try:
-                        val_float = float(str(prix_brut_affiche).replace(' ', '').replace(',', '.'))
-                        prix_brut_affiche = f"{val_float:.2f}"
-                    except: pass
-                    
-                    if remise_cible_str == "-" and row['Famille'] not in ["FRAIS GESTION", "FRAIS PORT"]:
-                         remise_cible_str = "?"
-
-                    anomalies.append({
-                        "Fichier_Source": f_name, # Pour le filtre d'affichage
-                        "Fournisseur": fourn,                        
-                        "Num Facture": row['Facture'],
-                        "Ref_Cmd": row['Ref_Cmd'], 
-                        "BL": row['BL'], 
-                        "Famille": row['Famille'],
-                        "PU_Systeme": row['PU_Systeme'],
-                        "Montant": row['Montant'],
-                        "Prix Brut": prix_brut_affiche,
-                        "Remise": row['Remise'],
-                        "Remise Cible": remise_cible_str, # 4. AFFICHAGE (Corrigé)
-                        "Qte": row['Quantité'],
-                        "Ref": row['Article'],
-                        "Désignation": row['Désignation'],
-                        "Payé (U)": row['PU_Systeme'],
-                        "Cible (U)": cible,
-                        # On utilise 'remise_cible_str' car c'est la seule variable qui existe ici.
-                        "Prix Cible": f"{(clean_float(str(row['Prix Brut'])) * (1 - clean_float(str(remise_cible_str).replace('%',''))/100)):.4f} €",
-                        "Perte": perte,                        
-# --- AJOUT SPECIAL LOUIS : ON MET L'INFO DANS LE TUYAU ---
-                        # Louis : On ajoute une colonne invisible "Prix_Ref_Hist" dans les données.
-                        # Elle sert juste à transporter le prix de 56.75€ jusqu'à l'affichage du titre plus bas.
-                        "Prix_Ref_Hist": prix_historique_ref,
-                        "Motif": motif,
-                        "Date Facture": row['Date'],
-                        "Source Cible": source_cible,     
-                        # --- LIGNE DE REPÈRE AVANT ---
-                        "Détails Techniques": detail_tech
-
-                    })
-            
-            if anomalies:
-                df_ano = pd.DataFrame(anomalies)
-                total_perte = df_ano['Perte'].sum()
-                # --- BLOC PODIUM : MONTANT + % ---
+            else:
                 st.subheader("🏆 Podium des Dettes & Évolution")
-                
-                # 1. Dénominateur : Ventes
-                df_ventes = df.copy()
-                df_ventes['Date_DT'] = pd.to_datetime(df_ventes['Date'], errors='coerce')
-                df_ventes['Année'] = df_ventes['Date_DT'].dt.year.fillna(0).astype(int).astype(str).replace('0', 'Inconnue')
-                stats_ventes = df_ventes.groupby(['Fournisseur', 'Année'])['Montant'].sum().reset_index()
-
-                # 2. Numérateur : Pertes
-                df_ano['Date_DT'] = pd.to_datetime(df_ano['Date Facture'], errors='coerce')
-                df_ano['Année'] = df_ano['Date_DT'].dt.year.fillna(0).astype(int).astype(str).replace('0', 'Inconnue')
-                stats_pertes = df_ano.groupby(['Fournisseur', 'Année'])['Perte'].sum().reset_index()
-
-                # 3. Fusion et Calcul
-                merge_stats = pd.merge(stats_ventes, stats_pertes, on=['Fournisseur', 'Année'], how='left').fillna(0)
-                merge_stats['Taux'] = merge_stats.apply(lambda x: (x['Perte'] / x['Montant'] * 100) if x['Montant'] > 0 else 0, axis=1)
-                
-                # Cellule "Combo" (Texte pour l'affichage)
-                merge_stats['Affiche'] = merge_stats.apply(
-                    lambda x: f"{x['Perte']:.2f} € ({x['Taux']:.1f}%)" if x['Perte'] > 0.01 else "-", 
-                    axis=1
-                )
-
-                # 4. Pivot
-                pivot_combo = merge_stats.pivot(index='Fournisseur', columns='Année', values='Affiche').fillna("-")
-                
-                # Ajout de la colonne Total (Floats pour le tri) à la FIN (Droite)
-                total_dette_fourn = df_ano.groupby('Fournisseur')['Perte'].sum()
-                pivot_combo["Dette Totale (€)"] = total_dette_fourn
-                
-                # On trie les fournisseurs par dette décroissante
-                pivot_combo = pivot_combo.sort_values("Dette Totale (€)", ascending=False)
+                zone_podium = st.container()
+                st.divider()
 
-                # --- AJOUT LIGNE TOTAL GÉNÉRAL (BAS DE TABLEAU) ---
-                row_total = {"Dette Totale (€)": total_perte}
-                
-                # Calcul des totaux par année (pour avoir les bons %)
-                cols_annee = [c for c in pivot_combo.columns if c != "Dette Totale (€)"]
-                for c_annee in cols_annee:
-                    # On filtre les stats brutes pour l'année concernée
-                    sub = merge_stats[merge_stats['Année'] == c_annee]
-                    sum_p = sub['Perte'].sum()
-                    sum_m = sub['Montant'].sum()
-                    
-                    if sum_m > 0:
-                        t_glo = (sum_p / sum_m) * 100
-                        row_total[c_annee] = f"{sum_p:.2f} € ({t_glo:.1f}%)"
-                    elif sum_p > 0:
-                         row_total[c_annee] = f"{sum_p:.2f} € (-)"
+                # Les fournisseurs sont proposés du plus gros acheteur au plus petit
+                achats_fourn = stats_ventes.groupby('Fournisseur')['Montant'].sum().sort_values(ascending=False)
+                col_f, col_fac = st.columns(2)
+                with col_f:
+                    fourn_choisi = st.selectbox("🔎 Fournisseur à inspecter :", achats_fourn.index.tolist())
+                df_fourn = df[df['Fournisseur'] == fourn_choisi]
+                with col_fac:
+                    factures_fourn = sorted(df_fourn['Fichier'].unique().tolist(), reverse=True)
+                    choix_affichage = st.selectbox(
+                        "👁️ Filtrer par facture :",
+                        ["TOUTES LES FACTURES"] + factures_fourn
+                    )
+
+                # Le cache est valable tant que le dossier, le registre et les réglages du fournisseur ne bougent pas
+                cache_analyse = st.session_state.setdefault('cache_analyse', {})
+                empreinte = empreinte_dossier(df, registre, a_date)
+                signature = signature_analyse(empreinte, config_dict, fourn_choisi)
+                en_cache = cache_analyse.get(fourn_choisi)
+
+                if en_cache and en_cache['signature'] == signature:
+                    df_ano_fourn = en_cache['df_ano']
+                elif choix_affichage != "TOUTES LES FACTURES":
+                    # Une seule facture demandée : on n'analyse que ses lignes (pas de mise en cache)
+                    df_fac = df_fourn[df_fourn['Fichier'] == choix_affichage]
+                    ref_map = construire_ref_map(df, registre, user_id, articles=set(df_fac['Article']), references=demarrage.get("references"))
+                    index_asof = construire_index_asof(df, registre, articles=set(df_fac['Article'])) if a_date else None
+                    df_ano_fourn = pd.DataFrame(analyser_lignes(df_fac, ref_map, config_dict, facture_totals, index_asof))
+                else:
+                    with st.spinner(f"Analyse de {fourn_choisi}..."):
+                        ref_map = construire_ref_map(df, registre, user_id, articles=set(df_fourn['Article']), references=demarrage.get("references"))
+                        index_asof = construire_index_asof(df, registre, articles=set(df_fourn['Article'])) if a_date else None
+                        df_ano_fourn = pd.DataFrame(analyser_lignes(df_fourn, ref_map, config_dict, facture_totals, index_asof))
+                    cache_analyse[fourn_choisi] = {'signature': signature, 'df_ano': df_ano_fourn}
+
+                # Podium : ventes pour tout le monde, pertes pour les fournisseurs déjà analysés
+                analyses = {f: c['df_ano'] for f, c in cache_analyse.items() if c['signature'] == signature_analyse(empreinte, config_dict, f)}
+                df_ano_connues = pd.concat([d for d in analyses.values() if not d.empty] or [pd.DataFrame(columns=['Fournisseur', 'Date Facture', 'Perte']).astype({'Perte': float})])
+                df_ano_connues['Année'] = annee_texte(pd.to_datetime(df_ano_connues['Date Facture']))
+                stats_pertes = df_ano_connues.groupby(['Fournisseur', 'Année'])['Perte'].sum().reset_index()
+                with zone_podium:
+                    if agregats is not None and not a_date:
+                        # Les pertes de tous les fournisseurs sont déjà dans les totaux matérialisés
+                        pivot_combo, total_dette_fourn = construire_podium(stats_ventes, stats_pertes_agregees)
+                        afficher_podium(pivot_combo)
                     else:
-                         row_total[c_annee] = "-"
-
-                # Insertion de la ligne TOTAL en bas
-                df_total_row = pd.DataFrame([row_total], index=["TOTAL GÉNÉRAL"])
-                pivot_combo = pd.concat([pivot_combo, df_total_row])
-
-                # --- FINITION ---
-                # Suppression des noms d'index parasites (Ligne rose)
-                pivot_combo.index.name = None
-                pivot_combo.columns.name = None
-                
-                # --- SUPPRESSION DU DOUBLE AFFICHAGE (st.metric retiré) ---
-                # On affiche directement le tableau HTML sans les colonnes parasites
-                html_podium = pivot_combo.style.format({'Dette Totale (€)': "{:.2f} €"})\
-                .set_properties(**{
-                    'text-align': 'center', 
-                    'border': '2px solid black', 
-                    'color': 'black', 
-                    'font-weight': 'bold',
-                    'white-space': 'pre-wrap'
-                })\
-                .set_table_styles([
-                    {'selector': 'th', 'props': [('background-color', '#ffcccb'), ('color', 'black'), ('text-align', 'center'), ('border', '2px solid black')]},
-                    {'selector': 'table', 'props': [('border-collapse', 'collapse'), ('width', '100%')]}
-                ]).to_html()
-                
-                st.markdown(html_podium, unsafe_allow_html=True)
-                
-                st.divider()
-                # --- FILTRE AFFICHAGE (POUR LE FREROT) ---
-                # Explication : On récupère la liste de toutes les factures qui ont des soucis
-                # et on propose à l'utilisateur de choisir s'il veut tout voir ou juste une facture.
-                liste_fichiers_avec_erreurs = sorted(df_ano['Fichier_Source'].unique().tolist(), reverse=True)
-                
-                choix_affichage = st.selectbox(
-                    "👁️ Filtrer les détails ci-dessous par facture :", 
-                    ["TOUT LE DOSSIER (GLOBAL)"] + liste_fichiers_avec_erreurs
-                )
-                # -----------------------------------------
-                st.subheader("🕵️ Détails par Fournisseur")
-        
-                # 6. Détails
-               # 6. Détails
-                for fourn_nom in pivot_combo.index:
-                    # [CORRECTION] : On ignore la ligne de total pour les dossiers détails
-                    if fourn_nom == "TOTAL GÉNÉRAL": continue
-                    
-                    fourn_dette = total_dette_fourn.get(fourn_nom, 0)
-                    
-                    with st.expander(f"📂 {fourn_nom} - Dette : {fourn_dette:.2f} €", expanded=False):
-                        df_litiges_fourn = df_ano[df_ano['Fournisseur'] == fourn_nom]
-                        # --- FILTRE ACTIF (POUR LE FREROT) ---
-                        # Si l'utilisateur a choisi une facture précise dans le menu du dessus,
-                        # on ne garde QUE les lignes de cette facture.
-                        if choix_affichage != "TOUT LE DOSSIER (GLOBAL)":
-                            df_litiges_fourn = df_litiges_fourn[df_litiges_fourn['Fichier_Source'] == choix_affichage]
-                        
-                        # Si après le filtre le tableau est vide (ex: ce fournisseur n'a pas d'erreur sur cette facture),
-                        # on affiche un petit message et on passe au suivant.
-                        if df_litiges_fourn.empty:
-                            st.info(f"✅ Aucune erreur sur la facture {choix_affichage} pour ce fournisseur.")
-                            continue
-                        # -------------------------------------
-                        for article, group in df_litiges_fourn.groupby('Ref'):
-                                    # On ne récupère plus le prix_ref pour l'affichage
-                                    date_ref = group['Source Cible'].iloc[0]
-                                    remise_ref = group['Remise Cible'].iloc[0]
-                                    nom_art = group['Désignation'].iloc[0]
+                        pivot_combo, total_dette_fourn = construire_podium(stats_ventes, stats_pertes, fournisseurs_analyses=set(analyses))
+                        afficher_podium(pivot_combo, na_rep="⏳")
+                        st.caption(f"{len(analyses)} fournisseur(s) analysé(s) sur {len(achats_fourn)} — choisissez-en un ci-dessous pour compléter.")
+
+                st.subheader(f"🕵️ Détails : {fourn_choisi}")
+                if not df_ano_fourn.empty and choix_affichage != "TOUTES LES FACTURES":
+                    df_ano_fourn = df_ano_fourn[df_ano_fourn['Fichier_Source'] == choix_affichage]
+                if df_ano_fourn.empty:
+                    st.info(f"✅ Aucune erreur détectée pour {fourn_choisi}.")
+                else:
+                    st.write(f"Dette : **{df_ano_fourn['Perte'].sum():.2f} €**")
+                    afficher_litiges_fournisseur(fourn_choisi, df_ano_fourn, registre)
 
-# --- CORRECTION FINALE TITRE (SPECIAL LOUIS) ---
-                                    # Louis : Au lieu de faire un calcul (Prix * %), on lit juste la valeur qu'on a transportée.
-                                    try:
-                                        val_hist = group['Prix_Ref_Hist'].iloc[0]
-                                        
-                                        # Si on a un prix historique (ex: 56.75), on l'affiche.
-                                        if val_hist > 0:
-                                            txt_prix_cible = f" 👉 Soit **{val_hist:.4f} €**"
-                                        else:
-                                            txt_prix_cible = ""
-                                    except:
-                                        txt_prix_cible = ""
-
-                                    st.markdown(f"**📦 {article}** - {nom_art} | 🎯 Objectif Remise : **{remise_ref}**{txt_prix_cible} (Vu le {date_ref})")
-                                    
-                                    # --- INTERFACE D'ARBITRAGE MARCEL (CORRECTIF CLÉ UNIQUE) ---
-                                    c_bt1, c_bt2, c_bt3 = st.columns(3)
-                                    # On crée une clé unique en combinant Fournisseur + Article
-                                    # Cela empêche l'erreur "DuplicateKey" si une ref existe chez 2 fournisseurs
-                                    cle_unique = f"{fourn_nom}_{article}".replace(" ", "_")
-                                    
-                                    with c_bt1:
+                df_litiges_export = df_ano_connues.drop(columns=['Année'])
+                note_export = f"Mode à la demande : seuls les {len(analyses)} fournisseur(s) déjà analysé(s) sont dans le rapport."
 
-# --- REMPLACEMENT AVEC COMMENTAIRES POUR LOUIS ---
-                                        # 1. On interroge le registre : Est-ce qu'on a déjà signé un truc pour cet article ?
-                                        accord_existant = registre.get(article)
-
-                                        if accord_existant and accord_existant['type'] == "CONTRAT": # <--- LIGNE DE REPERE AVANT
-                                            # Louis : Si un contrat est déjà signé, on affiche sa valeur verrouillée.
-                                            st.write(f"🔒 Contrat actuel : **{accord_existant['valeur']}{accord_existant['unite']}**")
-                                            
-                                            col_mod_input, col_mod_btn = st.columns([2, 3])
-                                            with col_mod_input:
-                                                nouvelle_remise_val = st.number_input(
-                                                    label="Modif Remise",
-                                                    value=float(accord_existant['valeur']),
-                                                    step=0.5,
-                                                    format="%.2f",
-                                                    key=f"input_mod_{cle_unique}",
-                                                    label_visibility="collapsed"
-                                                )
-                                            with col_mod_btn:
-                                                if st.button(f"💾 Valider {nouvelle_remise_val}%", key=f"btn_mod_{cle_unique}"):
-                                                    # On met à jour le contrat avec l'unité % par défaut
-                                                    sauvegarder_accord(article, "CONTRAT", nouvelle_remise_val, "%")
-                                                    st.rerun()
-                                        else:
-                                            # Louis : Si c'est libre, on propose de verrouiller la remise cible calculée par l'IA.
-                                            if st.button(f"🚀 Verrouiller Contrat ({remise_ref})", key=f"v_{cle_unique}"):
-                                                sauvegarder_accord(article, "CONTRAT", clean_float(remise_ref.replace('%','')), "%")
-                                                st.rerun()
-
-                                    with c_bt2:
-                                        # Louis : On décide intelligemment si on stocke un % (YESSS) ou un prix Net (EUR).
-                                        val_promo_sql = clean_float(remise_ref.replace('%',''))
-                                        unite_promo_sql = "%"
-                                        
-                                        if val_promo_sql <= 0:
-                                            val_promo_sql = val_hist
-                                            unite_promo_sql = "EUR"
-
-                                        if st.button("🎁 Marquer comme Promo", key=f"p_{cle_unique}"):
-                                            sauvegarder_accord(article, "PROMO", val_promo_sql, unite_promo_sql)
-                                            st.rerun()
-
-                                    with c_bt3:
-                                        if st.button("❌ Ignorer Erreur", key=f"e_{cle_unique}"):
-                                            sauvegarder_accord(article, "ERREUR", 0, "EUR")
-                                            st.rerun()
-
-                                    # Louis : On prépare l'affichage du petit tableau avec les colonnes de preuves techniques.
-                                    sub_df = group[['Num Facture', 'Date Facture', 'Qte', 'Remise', 'Payé (U)', 'Perte', 'Prix Cible']] # <--- LIGNE DE REPERE APRES
-                                    
-                                    html_detail = (
-                                        sub_df.style.format({'Qte': "{:g}", 'Payé (U)': "{:.4f} €", 'Perte': "{:.2f} €"})
-                                        .set_properties(**{
-                                            'text-align': 'center', 'border': '1px solid black', 'color': 'black'
-                                        })
-                                        .set_table_styles([
-                                            {'selector': 'th', 'props': [('background-color', '#e0e0e0'), ('color', 'black'), ('text-align', 'center'), ('border', '1px solid black')]},
-                                            {'selector': 'table', 'props': [('border-collapse', 'collapse'), ('width', '100%'), ('margin-bottom', '20px')]}
-                                        ])
-                                        .hide(axis="index")
-                                        .to_html()
-                                    )
-                                    
-                                    st.markdown(html_detail, unsafe_allow_html=True)
+            st.divider()
+            afficher_export(user_id, df, df_litiges_export, note_export)
                     
 
     with tab_import:
@@ -948,8 +2640,8 @@ if session:
         
         with col_info:
             st.write("📂 **En mémoire (Compte actuel) :**")
-            if memoire:
-                st.dataframe(pd.DataFrame({"Fichiers": list(memoire.keys())}), hide_index=True, height=300)
+            if noms_factures:
+                st.dataframe(pd.DataFrame({"Fichiers": sorted(noms_factures)}), hide_index=True, height=300)
             else:
                 st.info("Vide")
             
@@ -957,6 +2649,9 @@ if session:
             if st.button("🗑️ TOUT EFFACER (CE COMPTE)", type="primary"):
                 try:
                     supabase.table("audit_results").delete().eq("user_id", user_id).execute()
+                    supabase.table("references_articles").delete().eq("user_id", user_id).execute()
+                    vider_agregats(user_id)
+                    st.session_state.pop('dossier', None)
                     st.success("💥 Vos données sont vidées !")
                     st.session_state['uploader_key'] += 1 # 👈 C'est ça qui vide la liste
                     time.sleep(1)
@@ -964,6 +2659,29 @@ if session:
                 except Exception as e:
                     st.error(f"Erreur : {e}")
 
+            with st.expander("🛠️ Maintenance"):
+                # Louis : À lancer une fois après la migration : les vieux scans passent en version compressée
+                if st.button("🗜️ Compresser les anciens scans"):
+                    try:
+                        with st.spinner("Compression..."):
+                            nb = compacter_textes_bruts(user_id)
+                        st.success(f"{nb} scan(s) compressé(s).")
+                    except Exception as e:
+                        st.error(f"Erreur : {e}")
+
+                # Après l'ajout ou la modif d'un correctif : on le repasse sur tout le dossier, sans l'IA
+                if st.button("♻️ Rejouer les correctifs sur toutes les factures"):
+                    try:
+                        with st.spinner("Rejeu des correctifs..."):
+                            nb_lues, nb_modifiees, nb_erreurs = rejouer_correctifs(user_id)
+                        if nb_modifiees:
+                            st.session_state.pop('dossier', None)
+                        st.success(f"{nb_lues} facture(s) relue(s), {nb_modifiees} corrigée(s).")
+                        if nb_erreurs:
+                            st.warning(f"{nb_erreurs} facture(s) n'ont pas pu être relues.")
+                    except Exception as e:
+                        st.error(f"Erreur : {e}")
+
         with col_drop:
             # 👇 La clé magique est ici
             uploaded = st.file_uploader("PDFs", type="pdf", accept_multiple_files=True, key=f"uploader_{st.session_state['uploader_key']}")
@@ -974,16 +2692,21 @@ if session:
                     barre = st.progress(0)
                     for i, f in enumerate(uploaded):
                         with st.status(f"Analyse de {f.name}...", expanded=True) as status_box:
-                            if f.name in memoire and not force_rewrite:
+                            if f.name in noms_factures and not force_rewrite:
                                 status_box.update(label=f"⚠️ {f.name} ignoré", state="error")
                             else:
                                 status_box.write("📤 Étape 1 : Envoi vers Supabase...")
                                 try:
                                     supabase.storage.from_("factures_audit").upload(f.name, f.getvalue(), {"upsert": "true"})
                                     status_box.write("🧠 Étape 2 : L'IA calcule (15-20s)...")
-                                    ok, msg = traiter_un_fichier(f.name, user_id)
+                                    ancien_json = charger_analyse(user_id, f.name) if f.name in noms_factures else None
+                                    # Clés de groupe des lignes sans référence de l'ancienne version (records à invalider)
+                                    regroupes = df.loc[(df['Fichier'] == f.name) & df['Ref_Absente'], 'Article'].astype(str).unique() if ancien_json else ()
+                                    ok, msg = traiter_un_fichier(f.name, user_id, ancien_json, regroupes)
                                     
                                     if ok:
+                                        # Pertes à recalculer : lignes de la facture, et articles de l'ancienne version
+                                        marquer_agregats_a_jour(articles=articles_facture(f.name, ancien_json) if ancien_json else (), fichiers=[f.name])
                                         status_box.update(label=f"✅ {f.name} fini", state="complete", expanded=False)
                                     else:
                                         status_box.update(label=f"❌ Erreur {f.name}", state="error")
@@ -995,20 +2718,55 @@ if session:
                         barre.progress((i + 1) / len(uploaded))
 
                     st.session_state['uploader_key'] += 1 
+                    # Le dossier en session est relu (la signature aurait aussi vu l'import)
+                    st.session_state.pop('dossier', None)
                     time.sleep(1)
                     st.rerun()
 
     with tab_brut:
         st.header("🔍 Scan total des documents")
-        if memoire_full:
-            choix_file = st.selectbox("Choisir un fichier pour voir le scan complet :", list(memoire_full.keys()))
+        if noms_factures:
+            choix_file = st.selectbox("Choisir un fichier pour voir le scan complet :", sorted(noms_factures))
             if choix_file:
                 st.subheader(f"Texte brut extrait de : {choix_file}")
-                raw_txt = memoire_full[choix_file].get('raw_text', 'Aucun scan disponible')
+                raw_txt = charger_texte_brut(user_id, choix_file) or 'Aucun scan disponible'
                 st.text_area("Résultat Gemini (Full Scan)", raw_txt, height=400)
         else:
             st.info("Aucune donnée enregistrée pour ce compte.")
 
+    if diag_actif:
+        with onglets[4]:
+            st.header("🩺 Diagnostics de cet affichage")
+            # Louis : Les étapes sont listées dans l'ordre où elles ont tourné pendant CE passage.
+            # Rien n'est enregistré ailleurs, sauf si l'export en logs JSON est coché.
+            df_diag = pd.DataFrame(DIAGNOSTICS)
+            if df_diag.empty:
+                st.info("Aucune étape chronométrée.")
+            else:
+                st.metric("Temps total chronométré", f"{df_diag['duree_ms'].sum():.0f} ms")
+                st.bar_chart(df_diag.groupby('etape', sort=False)['duree_ms'].sum())
+                st.dataframe(df_diag, hide_index=True, use_container_width=True)
+                st.download_button(
+                    "💾 Télécharger (JSON lignes)",
+                    "\n".join(json.dumps(span, default=str) for span in DIAGNOSTICS),
+                    file_name=f"diagnostics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+                    mime="application/json"
+                )
 
-
-
+            # --- TÉLÉMÉTRIE DES EXTRACTIONS (Gemini) ---
+            st.divider()
+            st.subheader("🤖 Télémétrie des extractions")
+            df_tele = charger_telemetrie(user_id)
+            if df_tele.empty:
+                st.info("Aucune extraction enregistrée pour ce compte.")
+            else:
+                st.caption(f"{len(df_tele)} extraction(s) — latences en ms, coûts estimés en $ d'après TARIFS_GEMINI.")
+                formats_tele = {
+                    'json_ok': "{:.0f} %", 'gemini_p50_ms': "{:.0f}", 'gemini_p95_ms': "{:.0f}",
+                    'total_p50_ms': "{:.0f}", 'total_p95_ms': "{:.0f}", 'pages_moy': "{:.1f}",
+                    'jetons_moy': "{:.0f}", 'tentatives_moy': "{:.2f}", 'cout_total': "{:.4f} $", 'cout_par_facture': "{:.4f} $"
+                }
+                st.write("**Par fournisseur**")
+                st.dataframe(resumer_telemetrie(df_tele, 'fournisseur').style.format(formats_tele, na_rep="-"), use_container_width=True)
+                st.write("**Par modèle**")
+                st.dataframe(resumer_telemetrie(df_tele, 'modele').style.format(formats_tele, na_rep="-"), use_container_width=True)
@@ -0,0 +1,23 @@
+-- Records de référence par article (meilleure remise / meilleur prix), maintenus à l'import.
+-- Le registre (accords_commerciaux) est appliqué à la lecture par l'application.
+create table if not exists references_articles (
+    user_id uuid not null,
+    article text not null,
+    remise_best double precision not null default 0,
+    pu_best_remise double precision not null default 0,
+    brut_best_remise double precision not null default 0,
+    date_best_remise text,
+    pu_best_prix double precision not null default 0,
+    remise_best_prix double precision not null default 0,
+    date_best_prix text,
+    nb_lignes integer not null default 0,
+    promo boolean not null default false,
+    valide boolean not null default true,
+    date_maj date,
+    primary key (user_id, article)
+);
+
+alter table references_articles enable row level security;
+
+create policy "references_articles_proprietaire" on references_articles
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
@@ -0,0 +1,26 @@
+-- Une ligne par extraction Gemini (latences, jetons, succès du JSON, pages, fournisseur).
+create table if not exists telemetrie_extractions (
+    id bigint generated always as identity primary key,
+    user_id uuid not null,
+    file_name text not null,
+    fournisseur text,
+    modele text not null,
+    date_extraction timestamp,
+    duree_download_ms double precision,
+    duree_gemini_ms double precision,
+    octets_pdf integer,
+    nb_pages integer,
+    jetons_prompt integer,
+    jetons_reponse integer,
+    jetons_total integer,
+    tentatives integer not null default 0,
+    json_ok boolean not null default false,
+    statut text
+);
+
+create index if not exists telemetrie_extractions_user_idx on telemetrie_extractions (user_id, date_extraction);
+
+alter table telemetrie_extractions enable row level security;
+
+create policy "telemetrie_extractions_proprietaire" on telemetrie_extractions
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
@@ -0,0 +1,12 @@
+-- L'extraction Gemini est stockée en JSONB (plus de texte JSON à re-décoder côté client),
+-- et le texte brut compressé (zlib + base64) dans raw_text_z.
+alter table audit_results
+    alter column analyse_complete type jsonb using analyse_complete::jsonb;
+
+alter table audit_results
+    add column if not exists raw_text_z text;
+
+-- raw_text n'est plus rempli pour les nouvelles lignes ; les anciennes sont compressées
+-- depuis l'application (bouton "Compresser les anciens scans").
+alter table audit_results
+    alter column raw_text drop not null;
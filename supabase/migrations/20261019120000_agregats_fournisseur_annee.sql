@@ -0,0 +1,30 @@
+-- Totaux matérialisés Fournisseur x Année : achats (maintenus à l'import) et pertes
+-- (mode "Historique complet", maintenues article par article après import / arbitrage).
+create table if not exists agregats_fournisseur_annee (
+    user_id uuid not null,
+    fournisseur text not null,
+    annee text not null,
+    achats double precision not null default 0,
+    pertes double precision not null default 0,
+    date_maj date,
+    primary key (user_id, fournisseur, annee)
+);
+
+-- Part de chaque article dans les pertes : permet de ne recalculer que les articles touchés.
+create table if not exists pertes_articles (
+    user_id uuid not null,
+    article text not null,
+    fournisseur text not null,
+    annee text not null,
+    pertes double precision not null default 0,
+    primary key (user_id, article, fournisseur, annee)
+);
+
+alter table agregats_fournisseur_annee enable row level security;
+alter table pertes_articles enable row level security;
+
+create policy "agregats_fournisseur_annee_proprietaire" on agregats_fournisseur_annee
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
+
+create policy "pertes_articles_proprietaire" on pertes_articles
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
@@ -0,0 +1,18 @@
+-- Empreinte de ce qui a servi à calculer les totaux matérialisés, stockée avec eux : une session
+-- neuve compare le dossier, le registre et les réglages à ce qui est en base (et non à sa mémoire).
+-- Par article (et fournisseur x année) : nombre de lignes et accord du registre appliqué.
+-- Les articles sans perte ont aussi leur ligne (pertes = 0) pour que leur nombre de lignes soit suivi.
+alter table pertes_articles
+    add column if not exists nb_lignes integer not null default 0;
+
+alter table pertes_articles
+    add column if not exists accord text not null default '';
+
+-- Par fournisseur : réglages (franco, frais de gestion) utilisés pour ses lignes de frais.
+alter table agregats_fournisseur_annee
+    add column if not exists regles text not null default '';
+
+-- Les totaux existants n'ont pas d'empreinte : on les vide, l'application les reconstruit en tâche
+-- de fond, fournisseur par fournisseur, sans bloquer le premier affichage.
+delete from pertes_articles;
+delete from agregats_fournisseur_annee;
@@ -0,0 +1,14 @@
+-- Regroupement des lignes sans référence (désignation -> clé article du groupe), gardé par compte.
+-- empreinte : hachage de l'ensemble des désignations du dossier ; il change dès qu'une facture
+-- ajoute, retire ou modifie une désignation, et le regroupement est alors recalculé.
+create table if not exists regroupements_designations (
+    user_id uuid primary key,
+    empreinte text not null,
+    correspondance jsonb not null default '{}'::jsonb,
+    date_maj date
+);
+
+alter table regroupements_designations enable row level security;
+
+create policy "regroupements_designations_proprietaire" on regroupements_designations
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
@@ -0,0 +1,22 @@
+-- Date de la dernière écriture de chaque facture. L'application garde le dossier normalisé en
+-- session et ne relit toutes les pages que si la facture la plus récemment écrite du compte a changé.
+alter table audit_results
+    add column if not exists date_maj timestamptz not null default now();
+
+create index if not exists audit_results_user_date_maj on audit_results (user_id, date_maj desc);
+
+create or replace function audit_results_date_maj() returns trigger language plpgsql as $$
+begin
+    new.date_maj := now();
+    return new;
+end;
+$$;
+
+-- Seul un changement de l'extraction compte (import écrasé, rejeu des correctifs) : la compression
+-- du texte brut ne change pas les lignes du dossier.
+drop trigger if exists audit_results_date_maj on audit_results;
+create trigger audit_results_date_maj
+    before update on audit_results
+    for each row
+    when (old.analyse_complete is distinct from new.analyse_complete)
+    execute function audit_results_date_maj();
@@ -0,0 +1,35 @@
+"""Charge la logique de streamlit_app.py (sections 1 et 2) sans lancer l'interface.
+
+Supabase, l'authentification et Gemini sont remplacés par les doublures en mémoire de
+load_test.py : les tests tournent sans réseau et sans clés.
+"""
+import os
+import sys
+import types
+
+import pytest
+import streamlit
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+import load_test  # noqa: E402
+
+APP = os.path.join(RACINE, "streamlit_app.py")
+DEBUT_INTERFACE = "# 3. INTERFACE PRINCIPALE"
+
+@pytest.fixture(scope="session")
+def base():
+    return load_test.BaseMemoire()
+
+@pytest.fixture(scope="session")
+def app(base):
+    """Module contenant tout ce qui est défini avant l'interface (fonctions, schémas, règles)"""
+    load_test.installer_doublures(base, latence_ia=0.0)
+    streamlit.secrets = {"SUPABASE_URL": "http://local", "SUPABASE_KEY": "cle", "GEMINI_API_KEY": "cle"}
+    with open(APP, encoding="utf-8") as f:
+        source = f.read()
+    module = types.ModuleType("audit_app")
+    module.__file__ = APP
+    exec(compile(source[:source.index(DEBUT_INTERFACE)], APP, "exec"), module.__dict__)
+    return module
@@ -0,0 +1,50 @@
+"""Totaux Fournisseur x Année : reconstruction par fournisseur, requêtes par lots."""
+import math
+
+import load_test
+import pytest
+
+COMPTE = "compte_agregats"
+
+@pytest.fixture(scope="module")
+def lignes(app, base):
+    load_test.remplir_compte(base, COMPTE, 40, graine=7)
+    return app.charger_factures(COMPTE)["lignes"]
+
+def totaux(base):
+    return {(r['fournisseur'], r['annee']): (r['achats'], r['pertes'])
+            for r in base.tables.get("agregats_fournisseur_annee", []) if r['user_id'] == COMPTE}
+
+def test_filtre_in_par_lots(app, base):
+    articles = [f"ART{i:04d}" for i in range(250)]
+    base.tables["references_articles"] = [{"user_id": COMPTE, "article": a} for a in articles]
+    avant = base.nb_requetes
+    assert set(app.charger_references(COMPTE, articles)) == set(articles)
+    assert base.nb_requetes - avant == math.ceil(len(articles) / app.TAILLE_LOT_FILTRE)
+
+def test_reconstruction_en_tache_de_fond(app, base, lignes):
+    app.vider_agregats(COMPTE)
+    facture_totals = lignes.groupby('Fichier', observed=True)['Montant'].sum().to_dict()
+    fournisseurs = sorted(set(lignes['Fournisseur'].astype(str)))
+    tache, erreur = app.lancer_reconstruction(COMPTE, fournisseurs, lignes, {}, {}, facture_totals)
+    assert erreur is None
+    assert tache["futur"].result(timeout=60) == len(fournisseurs)
+    assert not app.reconstruction_en_cours(COMPTE)
+
+    stockes = totaux(base)
+    assert {f for f, a in stockes} == set(fournisseurs)
+    assert sum(achats for achats, pertes in stockes.values()) == pytest.approx(lignes['Montant'].sum())
+
+def test_reprise_efface_les_articles_orphelins(app, base, lignes):
+    # Tâche arrêtée entre l'écriture des articles et celle des totaux d'un fournisseur
+    fourn = str(lignes['Fournisseur'].iloc[0])
+    attendu = {k: v for k, v in totaux(base).items() if k[0] == fourn}
+    base.tables["agregats_fournisseur_annee"] = [r for r in base.tables["agregats_fournisseur_annee"]
+                                                 if not (r['user_id'] == COMPTE and r['fournisseur'] == fourn)]
+    base.tables["pertes_articles"].append({"user_id": COMPTE, "article": "ORPHELIN", "fournisseur": fourn,
+                                           "annee": "2024", "pertes": 99.0, "nb_lignes": 1, "accord": ""})
+
+    facture_totals = lignes.groupby('Fichier', observed=True)['Montant'].sum().to_dict()
+    app.construire_agregats_fournisseur(COMPTE, fourn, lignes, {}, {}, facture_totals)
+    assert not any(r['article'] == "ORPHELIN" for r in base.tables["pertes_articles"])
+    assert {k: v for k, v in totaux(base).items() if k[0] == fourn} == pytest.approx(attendu)
@@ -0,0 +1,109 @@
+"""Cas pièges des correctifs par fournisseur (anciennement rejoués à chaque lancement de l'appli)."""
+import copy
+import json
+
+import pytest
+
+def ligne(designation, montant, article="X"):
+    return {"quantite": 1, "article": article, "designation": designation, "prix_brut_unitaire": montant,
+            "base_facturation": 1, "remise": "", "prix_net_unitaire": montant, "montant": montant, "num_bl_ligne": "BL1"}
+
+def facture_yesss(lignes, **champs):
+    return {"fournisseur": "YESSS ELECTRIQUE SAS", "date": "2025-03-14", "num_facture": "F1", "ref_commande": "-",
+            "lignes": lignes, **champs}
+
+# Réponse de Gemini telle que stockée avant le schéma imposé : du JSON entouré de texte
+TEXTE_BRUT_YESSS = """Voici les données extraites de la facture :
+```json
+{
+  "fournisseur": "YESSS ELECTRIQUE SAS",
+  "adresse_fournisseur": "ZI de Kerpont, 56850 Caudan",
+  "tva_fournisseur": "FR12345678901",
+  "iban": "FR76 3000 4000 0500 0012 3456 789",
+  "date": "14/03/2025",
+  "num_facture": "FA250314-0042",
+  "ref_commande": "CHANTIER DUPONT",
+  "lignes": [
+    {"quantite": 2, "article": "HAG-CDA440F", "designation": "INTER DIFF 40A 30MA TYPE AC",
+     "prix_brut_unitaire": 130.25, "base_facturation": 1, "remise": "60", "prix_net_unitaire": 52.10,
+     "montant": 104.20, "num_bl_ligne": "BL778812"},
+    {"quantite": 1, "article": "LEG-406263", "designation": "BLOC DIFF 63A 30MA",
+     "prix_brut_unitaire": 200.00, "base_facturation": 1, "remise": "60", "prix_net_unitaire": 80.00,
+     "montant": 80.00, "num_bl_ligne": "BL778812"}
+  ],
+  "recapitulatif_tva": [
+    {"base_ht": "184,20", "taux": "20,00", "montant_tva": "36,84"},
+    "FF 8,99"
+  ]
+}
+```
+Le montant FF du récapitulatif a été relevé séparément."""
+
+def nb_frais(data):
+    return sum(l.get('article') == "FRAIS_ANNEXE" for l in data['lignes'])
+
+def appliquer_deux_fois(app, data, texte):
+    une_fois = app.appliquer_correctifs_specifiques(copy.deepcopy(data), texte)
+    deux_fois = app.appliquer_correctifs_specifiques(copy.deepcopy(une_fois), texte)
+    assert deux_fois == une_fois, "une règle doit pouvoir tourner deux fois sans rien changer"
+    return une_fois
+
+def test_designations_diff_ne_sont_pas_des_frais(app):
+    data = facture_yesss([ligne("INTER DIFF 40A 30MA", 52.1), ligne("BLOC DIFF 63A", 80.0), ligne("DIFF 25A", 40.0)])
+    resultat = appliquer_deux_fois(app, data, json.dumps(data))
+    assert nb_frais(resultat) == 0
+
+@pytest.mark.parametrize("designation", ["INTER DIFF 40A 30MA", "BLOC DIFF 63A", "DIFF 25A", "COFFRET FF 13 MODULES"])
+def test_motif_ff_ancre(app, designation):
+    assert app.MOTIF_FF_YESSS.match(designation) is None
+
+def test_frais_facture_du_schema(app):
+    data, erreur = app.valider_extraction(json.dumps(facture_yesss([ligne("BLOC DIFF 63A", 80.0)], frais_facture="8,99")))
+    assert erreur is None and data['frais_facture'] == pytest.approx(8.99)
+    resultat = appliquer_deux_fois(app, data, json.dumps(data))
+    assert nb_frais(resultat) == 1
+    assert resultat['lignes'][-1]['montant'] == pytest.approx(8.99)
+
+def test_schema_gemini_declare_les_frais(app):
+    assert "frais_facture" in app.SCHEMA_GEMINI["properties"]
+    assert "frais_facture" not in app.SCHEMA_GEMINI["required"]
+
+def test_ff_dans_un_champ_en_plus(app):
+    data = facture_yesss([ligne("BLOC DIFF 63A", 80.0)], recap_tva=["BASE 120,00", "FF 8,99"])
+    assert nb_frais(appliquer_deux_fois(app, data, json.dumps(data))) == 1
+
+def test_ff_deja_en_ligne(app):
+    data = facture_yesss([ligne("FF 8,99", 8.99)], frais_facture=8.99)
+    resultat = appliquer_deux_fois(app, data, json.dumps(data))
+    assert nb_frais(resultat) == 0 and len(resultat['lignes']) == 1
+
+def test_texte_brut_yesss(app):
+    # Analyse stockée sans le récapitulatif (validée sans le champ en plus) : le FF vient du texte brut
+    data = facture_yesss([ligne("INTER DIFF 40A 30MA TYPE AC", 52.1), ligne("BLOC DIFF 63A 30MA", 80.0)])
+    resultat = appliquer_deux_fois(app, data, TEXTE_BRUT_YESSS)
+    assert nb_frais(resultat) == 1
+    assert resultat['lignes'][-1]['montant'] == pytest.approx(8.99)
+
+def test_texte_brut_libre(app):
+    texte = "FACTURE FA250314-0042\nINTER DIFF 40A 30MA 2 52,10 104,20\nBASE HT 184,20\nFF 8,99\nTOTAL TTC 229,83"
+    data = facture_yesss([ligne("INTER DIFF 40A 30MA", 52.1)])
+    assert nb_frais(appliquer_deux_fois(app, data, texte)) == 1
+
+def test_texte_brut_sans_ff(app):
+    texte = TEXTE_BRUT_YESSS.replace('"FF 8,99"', '"ECO-PART 0,40"')
+    data = facture_yesss([ligne("INTER DIFF 40A 30MA TYPE AC", 52.1)])
+    assert nb_frais(appliquer_deux_fois(app, data, texte)) == 0
+
+def test_rejeu_retire_un_faux_frais(app):
+    # Ligne ajoutée à tort par l'ancienne règle non ancrée : elle disparaît au rejeu
+    data = facture_yesss([ligne("INTER DIFF 40A 30MA", 52.1),
+                          {**ligne(app.DESIGNATION_FF_SCRIPT, 40.0, "FRAIS_ANNEXE"), "num_bl_ligne": "Script"}])
+    assert nb_frais(appliquer_deux_fois(app, data, json.dumps(data))) == 0
+
+def test_autre_fournisseur_non_touche(app):
+    data = {**facture_yesss([ligne("BLOC DIFF 63A", 80.0)], frais_facture=8.99), "fournisseur": "REXEL FRANCE"}
+    assert nb_frais(appliquer_deux_fois(app, data, json.dumps(data))) == 0
+
+def test_commande_egale_facture(app):
+    data = facture_yesss([ligne("BLOC DIFF 63A", 80.0)], num_facture="FA123", ref_commande="FA123")
+    assert app.appliquer_correctifs_specifiques(data, "")['ref_commande'] == "-"
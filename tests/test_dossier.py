@@ -0,0 +1,30 @@
+"""Dossier normalisé gardé en session : relu seulement si une facture a été écrite."""
+import load_test
+
+COMPTE = "compte_dossier"
+
+def test_dossier_relu_apres_ecriture(app, base):
+    load_test.remplir_compte(base, COMPTE, 12, graine=3)
+    dossier = app.charger_dossier(COMPTE)
+    assert len(dossier["factures"]["noms"]) == 12
+
+    # Rien n'a bougé : une seule requête (la signature), le même dossier
+    avant = base.nb_requetes
+    assert app.charger_dossier(COMPTE, dossier) is dossier
+    assert base.nb_requetes - avant == 1
+
+    # Un autre compte en cache n'est pas réutilisé
+    assert app.charger_dossier("autre_compte", dossier)["factures"]["noms"] == []
+
+    # Rejeu ou import écrasé : l'extraction change, le dossier est relu
+    data = load_test.facture_synthetique(load_test.random.Random(1), 99)
+    app.supabase.table("audit_results").update({"analyse_complete": data})\
+        .eq("user_id", COMPTE).eq("file_name", f"{COMPTE}_00000.pdf").execute()
+    relu = app.charger_dossier(COMPTE, dossier)
+    assert relu is not dossier
+    assert relu["signature"][1] == f"{COMPTE}_00000.pdf"
+
+    # La compression du texte brut ne touche pas aux lignes : pas de relecture
+    app.supabase.table("audit_results").update({"raw_text": None})\
+        .eq("user_id", COMPTE).eq("file_name", f"{COMPTE}_00001.pdf").execute()
+    assert app.charger_dossier(COMPTE, relu) is relu
@@ -0,0 +1,25 @@
+"""Podium des dettes (Fournisseur x Année)."""
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def stats_ventes():
+    return pd.DataFrame({"Fournisseur": ["YESSS ELECTRIQUE", "REXEL FRANCE"], "Année": ["2024", "2024"], "Montant": [1200.0, 800.0]})
+
+def test_podium_analyse_vide(app, stats_ventes):
+    # Mode à la demande : aucun fournisseur analysé n'a d'anomalie (ou juste après un rejeu)
+    for df_ano in (pd.DataFrame(columns=['Fournisseur', 'Date Facture', 'Perte']),
+                   pd.DataFrame(columns=['Fournisseur', 'Date Facture', 'Perte']).astype({'Perte': float})):
+        df_ano['Année'] = app.annee_texte(pd.to_datetime(df_ano['Date Facture']))
+        stats_pertes = df_ano.groupby(['Fournisseur', 'Année'])['Perte'].sum().reset_index()
+        pivot, dette = app.construire_podium(stats_ventes, stats_pertes, fournisseurs_analyses={"REXEL FRANCE"})
+        assert pivot.loc["TOTAL GÉNÉRAL", "Dette Totale (€)"] == 0
+        assert pivot.loc["REXEL FRANCE", "2024"] == "-"
+        assert pivot.loc["YESSS ELECTRIQUE", "2024"] == "⏳ à analyser"
+
+def test_podium_taux(app, stats_ventes):
+    stats_pertes = pd.DataFrame({"Fournisseur": ["YESSS ELECTRIQUE"], "Année": ["2024"], "Perte": [60.0]})
+    pivot, dette = app.construire_podium(stats_ventes, stats_pertes)
+    assert pivot.loc["YESSS ELECTRIQUE", "2024"] == "60.00 € (5.0%)"
+    assert pivot.loc["TOTAL GÉNÉRAL", "2024"] == "60.00 € (3.0%)"
+    assert dette["YESSS ELECTRIQUE"] == 60.0
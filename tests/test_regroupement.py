@@ -0,0 +1,31 @@
+"""Regroupement des lignes sans référence par désignation (MinHash + LSH)."""
+
+def sans_ref(designation, nb=1):
+    return (designation, designation[:20], True, nb)
+
+def test_prefixe_commun_ne_fusionne_pas(app):
+    # Même clé provisoire (designation[:20] = "CABLE RIGIDE U1000 R") mais deux sections différentes
+    designations = sorted([sans_ref("CABLE RIGIDE U1000 R2V 3G1,5", 3), sans_ref("CABLE RIGIDE U1000 R2V 3G2,5", 2)])
+    correspondance = app.regrouper_designations(designations)
+    assert correspondance["CABLE RIGIDE U1000 R2V 3G1,5"] != correspondance["CABLE RIGIDE U1000 R2V 3G2,5"]
+
+def test_variantes_regroupees(app):
+    designations = sorted([sans_ref("Câble rigide U1000 R2V 3G2,5", 4), sans_ref("CABLE RIGIDE U1000 R2V 3G2.5 ", 1),
+                           sans_ref("CABLE RIGIDE U1000 R2V 3G1,5", 2)])
+    correspondance = app.regrouper_designations(designations)
+    assert correspondance["Câble rigide U1000 R2V 3G2,5"] == correspondance["CABLE RIGIDE U1000 R2V 3G2.5 "]
+    assert correspondance["Câble rigide U1000 R2V 3G2,5"] != correspondance["CABLE RIGIDE U1000 R2V 3G1,5"]
+
+def test_cle_unique_garde_la_cle_provisoire(app):
+    # Sans conflit, la clé provisoire reste celle du groupe (les accords déjà posés dessus restent valables)
+    designations = sorted([sans_ref("DISJONCTEUR 16A COURBE C", 2), sans_ref("Disjoncteur 16A courbe C", 1)])
+    assert set(app.regrouper_designations(designations).values()) == {"DISJONCTEUR 16A COUR"}
+
+def test_vraie_reference_du_groupe(app):
+    designations = sorted([("PRODUIT NUMERO 1 GRIS", "REF001", False, 5), sans_ref("Produit numéro 1  gris", 1)])
+    assert app.regrouper_designations(designations) == {"Produit numéro 1  gris": "REF001"}
+
+def test_cle_provisoire_egale_a_une_reference(app):
+    # Une vraie référence d'un autre produit porte déjà le nom de la clé provisoire
+    designations = sorted([("CONDUIT IRL 20 ROUGE", "TUBE IRL 16 GRIS 3M", False, 3), sans_ref("TUBE IRL 16 GRIS 3M", 1)])
+    assert app.regrouper_designations(designations)["TUBE IRL 16 GRIS 3M"] != "TUBE IRL 16 GRIS 3M"